@@ -1,30 +1,718 @@
+import io
 import os
+import csv
+import base64
+import time
+import socket
+import queue
+import random
+import hmac
+import atexit
+import bisect
+import hashlib
 import secrets
-from datetime import datetime, timedelta
-from functools import wraps
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory
+import struct
+import threading
+import zlib
+import tempfile
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from flask import Flask, Request, render_template, request, jsonify, redirect, url_for, session, send_from_directory, g
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import parse_content_range_header
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import sqlite3
 import json
+import math
 import re
 
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: chunk appends are not locked
+    fcntl = None
+
+class HashingSpool(io.FileIO):
+    """Upload spool that hashes and size-counts the body while it is written to disk.
+
+    Lives in the upload folder so publishing is a same-filesystem os.replace();
+    removed on close unless it was published.
+    """
+
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=folder, suffix='.part')
+        super().__init__(fd, 'r+')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return super().write(data)
+
+    def close(self):
+        super().close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Endpoints whose multipart file parts are spooled and hashed by HashingSpool
+SPOOLED_UPLOAD_ENDPOINTS = frozenset({'upload_release'})
+
+class PillyRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # firmware images only; every other form keeps Werkzeug's in-memory / temp-file default
+        if self.endpoint in SPOOLED_UPLOAD_ENDPOINTS:
+            return HashingSpool(incoming_folder())
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 app = Flask(__name__)
+app.request_class = PillyRequest
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 app.config['UPLOAD_FOLDER'] = 'uploads/firmwares'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['DATABASE'] = 'database/esp32_management.db'
 
+# SQLite connection tuning (DB_POOL=0 falls back to one plain connection per request)
+app.config['DB_POOL'] = os.environ.get('DB_POOL', '1') != '0'
+app.config['DB_BUSY_TIMEOUT_MS'] = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+app.config['DB_CACHE_SIZE_KB'] = int(os.environ.get('DB_CACHE_SIZE_KB', 20000))
+app.config['DB_MMAP_SIZE'] = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['DB_STATEMENT_CACHE'] = int(os.environ.get('DB_STATEMENT_CACHE', 256))
+
+# Heartbeat write-behind (HEARTBEAT_FLUSH_INTERVAL=0 writes every heartbeat straight away)
+app.config['HEARTBEAT_FLUSH_INTERVAL'] = float(os.environ.get('HEARTBEAT_FLUSH_INTERVAL', 2.0))
+app.config['HEARTBEAT_FLUSH_SIZE'] = int(os.environ.get('HEARTBEAT_FLUSH_SIZE', 500))
+
+# Device credential cache used by verify_device_request
+app.config['DEVICE_CACHE_SIZE'] = int(os.environ.get('DEVICE_CACHE_SIZE', 10000))
+app.config['DEVICE_CACHE_TTL'] = float(os.environ.get('DEVICE_CACHE_TTL', 300))
+app.config['DEVICE_CACHE_CHECK_INTERVAL'] = float(os.environ.get('DEVICE_CACHE_CHECK_INTERVAL', 0.5))
+
+# Firmware downloads: Cache-Control max-age and optional X-Sendfile offload to the front proxy
+app.config['FIRMWARE_CACHE_MAX_AGE'] = int(os.environ.get('FIRMWARE_CACHE_MAX_AGE', 86400))
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+
+# OTA bandwidth: at most OTA_MAX_DOWNLOADS update downloads in flight (0 = no cap), each slot
+# valid OTA_SLOT_SECONDS; devices turned away are told to retry within OTA_RETRY_SECONDS
+app.config['OTA_MAX_DOWNLOADS'] = int(os.environ.get('OTA_MAX_DOWNLOADS', 20))
+app.config['OTA_SLOT_SECONDS'] = int(os.environ.get('OTA_SLOT_SECONDS', 900))
+app.config['OTA_RETRY_SECONDS'] = int(os.environ.get('OTA_RETRY_SECONDS', 300))
+
+# Rollout defaults (overridable per rollout) and how often the leader settles slots / advances waves
+app.config['ROLLOUT_WAVES'] = os.environ.get('ROLLOUT_WAVES', '1,10,50,100')
+app.config['ROLLOUT_WAVE_MINUTES'] = float(os.environ.get('ROLLOUT_WAVE_MINUTES', 60))
+app.config['ROLLOUT_MAX_FAILURE_RATE'] = float(os.environ.get('ROLLOUT_MAX_FAILURE_RATE', 0.1))
+app.config['ROLLOUT_MIN_ATTEMPTS'] = int(os.environ.get('ROLLOUT_MIN_ATTEMPTS', 5))
+app.config['OTA_ROLLOUT_INTERVAL'] = float(os.environ.get('OTA_ROLLOUT_INTERVAL', 30))
+
+# Chunked (resumable) firmware uploads
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+app.config['FIRMWARE_MAX_SIZE'] = int(os.environ.get('FIRMWARE_MAX_SIZE', 16 * 1024 * 1024))
+app.config['UPLOAD_SESSION_TTL_HOURS'] = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', 24))
+
+# Delta OTA: patches are built from the DELTA_BASE_COUNT latest stable releases and
+# only kept when smaller than DELTA_MAX_RATIO of the full image
+app.config['DELTA_BASE_COUNT'] = int(os.environ.get('DELTA_BASE_COUNT', 3))
+app.config['DELTA_MAX_RATIO'] = float(os.environ.get('DELTA_MAX_RATIO', 0.6))
+
+# Max alarms accepted by /api/esp32/alarms/batch in one request
+app.config['ALARM_BATCH_MAX'] = int(os.environ.get('ALARM_BATCH_MAX', 200))
+
+# Alarm storm control, per device and alarm_type: ALARM_BURST alarms, then ALARM_RATE per
+# second (0 = no limit); repeats within ALARM_DEDUP_SECONDS of a stored alarm only bump
+# its occurrences (0 = store every alarm)
+app.config['ALARM_RATE'] = float(os.environ.get('ALARM_RATE', 1.0))
+app.config['ALARM_BURST'] = int(os.environ.get('ALARM_BURST', 10))
+app.config['ALARM_DEDUP_SECONDS'] = float(os.environ.get('ALARM_DEDUP_SECONDS', 60))
+app.config['ALARM_FOLD_FLUSH_INTERVAL'] = float(os.environ.get('ALARM_FOLD_FLUSH_INTERVAL', 2.0))
+
+# Offline sweeper: devices online without a heartbeat for OFFLINE_GRACE_SECONDS are flipped
+# to offline every SWEEP_INTERVAL seconds by whichever worker holds the lease
+app.config['SWEEP_INTERVAL'] = float(os.environ.get('SWEEP_INTERVAL', 15))
+app.config['OFFLINE_GRACE_SECONDS'] = int(os.environ.get('OFFLINE_GRACE_SECONDS', 90))
+
+# Heartbeat telemetry history (uptime / free heap): raw chunks are written every
+# TELEMETRY_BLOCK_SECONDS per device, rolled up to 1 min / 1 h by the leader
+app.config['TELEMETRY_BLOCK_SECONDS'] = int(os.environ.get('TELEMETRY_BLOCK_SECONDS', 600))
+app.config['TELEMETRY_ROLLUP_INTERVAL'] = float(os.environ.get('TELEMETRY_ROLLUP_INTERVAL', 60))
+app.config['TELEMETRY_RAW_DAYS'] = int(os.environ.get('TELEMETRY_RAW_DAYS', 7))
+app.config['TELEMETRY_MINUTE_DAYS'] = int(os.environ.get('TELEMETRY_MINUTE_DAYS', 30))
+app.config['TELEMETRY_HOUR_DAYS'] = int(os.environ.get('TELEMETRY_HOUR_DAYS', 365))
+app.config['TELEMETRY_MAX_POINTS'] = int(os.environ.get('TELEMETRY_MAX_POINTS', 5000))
+
+# Largest page served by /api/devices/list and /api/alarms/list
+app.config['LIST_PAGE_MAX'] = int(os.environ.get('LIST_PAGE_MAX', 500))
+
+# Most rows accepted by one /api/devices/bulk upload
+app.config['BULK_MAX_DEVICES'] = int(os.environ.get('BULK_MAX_DEVICES', 20000))
+
+# Longest ?wait= accepted by /api/esp32/command/<mac> (keep it under the proxy timeout)
+app.config['COMMAND_WAIT_MAX'] = float(os.environ.get('COMMAND_WAIT_MAX', 25))
+# Threaded long-polls parked at once per worker (gateway.py parks them without a thread)
+app.config['COMMAND_WAITERS_MAX'] = int(os.environ.get('COMMAND_WAITERS_MAX', 8))
+
+# Request metrics on /metrics: latency histograms, statuses, in-flight and SQL time per route.
+# Each worker writes a snapshot to METRICS_DIR (default: <database folder>/metrics) every
+# METRICS_FLUSH_INTERVAL seconds; scrapes sum them. METRICS_TOKEN allows Bearer-token scrapes.
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# SQL tracing (/api/admin/queries): per-statement totals by endpoint, VM instructions counted in
+# steps of SQL_TRACE_STEP_OPS; statements slower than SLOW_QUERY_MS (0 = off) are logged as
+# JSON lines to SLOW_QUERY_LOG (default: the app log)
+app.config['SQL_TRACE'] = os.environ.get('SQL_TRACE', '0') == '1'
+app.config['SQL_TRACE_STEP_OPS'] = int(os.environ.get('SQL_TRACE_STEP_OPS', 1000))
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG')
+
+# Dashboard live feed (/api/events)
+app.config['EVENTS_POLL_INTERVAL'] = float(os.environ.get('EVENTS_POLL_INTERVAL', 1.0))
+app.config['EVENTS_QUEUE_SIZE'] = int(os.environ.get('EVENTS_QUEUE_SIZE', 256))
+app.config['EVENTS_RETENTION_MINUTES'] = int(os.environ.get('EVENTS_RETENTION_MINUTES', 15))
+app.config['EVENTS_KEEPALIVE'] = float(os.environ.get('EVENTS_KEEPALIVE', 15))
+app.config['EVENTS_STREAM_MAX_SECONDS'] = int(os.environ.get('EVENTS_STREAM_MAX_SECONDS', 300))
+# Open streams per worker: each one holds a gunicorn thread, so keep it well under --threads
+app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', 8))
+
 ALLOWED_EXTENSIONS = {'bin'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_db():
-    db = sqlite3.connect(app.config['DATABASE'])
+class SqlThreadState(threading.local):
+    """SQL counters of the current thread; `endpoint` names the request it is serving."""
+    statements = 0
+    seconds = 0.0
+    ticks = 0  # progress-handler calls, one per SQL_TRACE_STEP_OPS VM instructions
+    endpoint = None
+
+_sql_local = SqlThreadState()
+
+def sql_usage():
+    """(statements, seconds) spent in SQLite by the current thread since it started."""
+    return _sql_local.statements, _sql_local.seconds
+
+_SQL_SPACES = re.compile(r'\s+')
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_IN_LISTS = re.compile(r'\bIN \(\?(?: ?, ?\?)+ ?\)', re.IGNORECASE)
+
+@lru_cache(maxsize=2048)
+def normalize_sql(sql):
+    """Statement text without layout, literals or the length of `IN (?, ?, ...)` lists."""
+    sql = _SQL_LITERALS.sub('?', _SQL_SPACES.sub(' ', sql).strip())
+    return _SQL_IN_LISTS.sub('IN (?, ...)', sql)
+
+class SqlTracer:
+    """Per-statement totals of this worker (SQL_TRACE=1) and the slow-query log.
+
+    Keyed by normalized text and the Flask endpoint (or thread name) that ran it. An
+    execute and the fetches on its cursor add to the same entry: calls counts executes,
+    max is the slowest single execute or fetch.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}  # (sql, endpoint) -> [calls, seconds, max seconds, rows, ticks]
+        self.dirty = False
+
+    def add(self, key, calls, seconds, rows, ticks, phase):
+        with self._lock:
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = [0, 0.0, 0.0, 0, 0]
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            entry[3] += rows
+            entry[4] += ticks
+            self.dirty = True
+        threshold = app.config['SLOW_QUERY_MS']
+        if threshold and seconds * 1000 >= threshold:
+            log_slow_query(key, phase, seconds, rows, ticks)
+
+    def executed(self, cursor, sql, seconds, ticks):
+        key = cursor._trace_key = (normalize_sql(sql), _sql_local.endpoint or threading.current_thread().name)
+        self.add(key, 1, seconds, max(cursor.rowcount, 0), ticks, 'execute')
+
+    def snapshot(self):
+        with self._lock:
+            return [[*key, *entry] for key, entry in self.stats.items()]
+
+sql_tracer = SqlTracer()
+
+def log_slow_query(key, phase, seconds, rows, ticks):
+    entry = {
+        'at': utc_now_sql(), 'ms': round(seconds * 1000, 2), 'phase': phase, 'rows': rows,
+        'vm_steps': ticks * app.config['SQL_TRACE_STEP_OPS'], 'endpoint': key[1], 'sql': key[0],
+        'pid': os.getpid(),
+    }
+    path = app.config['SLOW_QUERY_LOG']
+    if not path:
+        app.logger.warning('Slow query: %s', json.dumps(entry))
+        return
+    try:
+        # one short O_APPEND write per entry, so lines from several workers do not interleave
+        with open(path, 'a') as fh:
+            fh.write(json.dumps(entry) + '\n')
+    except OSError:
+        app.logger.exception('Could not write the slow query log')
+
+def _sql_tick():
+    _sql_local.ticks += 1
+    return 0
+
+class MeteredCursor(sqlite3.Cursor):
+    """Cursor whose execute and fetch calls add to the thread's SQL counters (`sql_usage`)
+    and, with SQL_TRACE=1, to `sql_tracer`.
+
+    Rows pulled by iterating the cursor are not timed; the first one is, by execute().
+    """
+    _trace_key = None
+
+    def _execute(self, method, sql, args, statements=1):
+        local = _sql_local
+        ticks = local.ticks
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            local.statements += statements
+            local.seconds += elapsed
+            if app.config['SQL_TRACE']:
+                sql_tracer.executed(self, sql, elapsed, local.ticks - ticks)
+
+    def _fetch(self, method, args=()):
+        local = _sql_local
+        ticks = local.ticks
+        started = time.perf_counter()
+        try:
+            result = method(self, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            local.seconds += elapsed
+        if self._trace_key is not None:
+            rows = len(result) if isinstance(result, list) else int(result is not None)
+            sql_tracer.add(self._trace_key, 0, elapsed, rows, local.ticks - ticks, 'fetch')
+        return result
+
+    def execute(self, sql, parameters=()):
+        return self._execute(sqlite3.Cursor.execute, sql, (sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._execute(sqlite3.Cursor.executemany, sql, (sql, seq_of_parameters))
+
+    def executescript(self, sql_script):
+        return self._execute(sqlite3.Cursor.executescript, sql_script, (sql_script,))
+
+    def fetchone(self):
+        return self._fetch(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(sqlite3.Cursor.fetchmany, (self.arraysize if size is None else size,))
+
+    def fetchall(self):
+        return self._fetch(sqlite3.Cursor.fetchall)
+
+class MeteredConnection(sqlite3.Connection):
+    """Connection whose shortcut execute methods go through MeteredCursor."""
+
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        local = _sql_local
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            elapsed = time.perf_counter() - started
+            local.seconds += elapsed
+            if app.config['SQL_TRACE']:
+                sql_tracer.add(('COMMIT', local.endpoint or threading.current_thread().name),
+                               1, elapsed, 0, 0, 'commit')
+
+def db_factory():
+    if app.config['METRICS_ENABLED'] or app.config['SQL_TRACE']:
+        return MeteredConnection
+    return sqlite3.Connection
+
+def install_sql_trace(db):
+    """With SQL_TRACE=1, count VM instructions (in SQL_TRACE_STEP_OPS steps) per statement."""
+    if app.config['SQL_TRACE']:
+        db.set_progress_handler(_sql_tick, app.config['SQL_TRACE_STEP_OPS'])
+    return db
+
+def connect_db():
+    """Open a tuned SQLite connection: WAL journal, NORMAL fsync, larger page cache and mmap.
+
+    WAL lets the gunicorn workers read while another one writes; `cached_statements`
+    keeps the prepared statements of the hot queries around between requests.
+    """
+    db = sqlite3.connect(app.config['DATABASE'], cached_statements=app.config['DB_STATEMENT_CACHE'],
+                         factory=db_factory())
     db.row_factory = sqlite3.Row
+    db.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+    # only takes effect on a new, empty file (before WAL writes the header); see retention.py
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute(f"PRAGMA cache_size = -{int(app.config['DB_CACHE_SIZE_KB'])}")
+    db.execute(f"PRAGMA mmap_size = {int(app.config['DB_MMAP_SIZE'])}")
+    db.execute('PRAGMA temp_store = MEMORY')
+    return install_sql_trace(db)
+
+_db_local = threading.local()
+
+def _thread_db():
+    """Long-lived connection owned by the current worker thread (re-opened after a fork)."""
+    conns = getattr(_db_local, 'conns', None)
+    if conns is None:
+        conns = _db_local.conns = {}
+    key = (os.getpid(), app.config['DATABASE'])
+    db = conns.get(key)
+    if db is None:
+        db = conns[key] = connect_db()
     return db
 
+def get_db():
+    """Connection for the current app context; released in `release_db` on teardown."""
+    if 'db' not in g:
+        if app.config['DB_POOL']:
+            g.db = _thread_db()
+        else:
+            g.db = install_sql_trace(sqlite3.connect(app.config['DATABASE'], factory=db_factory()))
+            g.db.row_factory = sqlite3.Row
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    db = g.pop('db', None)
+    if db is None:
+        return
+    if app.config['DB_POOL']:
+        # Pooled connections stay open; just never hand one over mid-transaction.
+        if db.in_transaction:
+            db.rollback()
+    else:
+        db.close()
+
+
+# ---- Request metrics ----
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class RequestMetrics:
+    """Per-route request counters of this worker, summed across workers at scrape time.
+
+    Histograms keep per-bucket (not cumulative) counts followed by sum and count. Every
+    METRICS_FLUSH_INTERVAL seconds the worker replaces its `<pid>.json` snapshot in the
+    metrics folder; `/metrics` adds up all snapshots. Snapshots of workers that are gone
+    are folded into `dead.json`, so counters never go backwards when gunicorn replaces one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._dirty = False
+        self.requests = {}     # (route, method, status) -> count
+        self.latency = {}      # (route, method) -> histogram
+        self.in_flight = {}    # route -> requests in progress
+        self.sql = {}          # route -> [statements, seconds]
+        self.sql_count = {}    # route -> histogram of statements per request
+
+    @staticmethod
+    def _observe(table, key, buckets, value):
+        hist = table.get(key)
+        if hist is None:
+            hist = table[key] = [0] * (len(buckets) + 3)
+        hist[bisect.bisect_left(buckets, value)] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+    def started(self, route):
+        with self._lock:
+            self.in_flight[route] = self.in_flight.get(route, 0) + 1
+        self._ensure_thread()
+
+    def finished(self, route, method, status, seconds, statements, sql_seconds):
+        with self._lock:
+            self.in_flight[route] -= 1
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self._observe(self.latency, (route, method), LATENCY_BUCKETS, seconds)
+            self._observe(self.sql_count, route, SQL_COUNT_BUCKETS, statements)
+            sql = self.sql.setdefault(route, [0, 0.0])
+            sql[0] += statements
+            sql[1] += sql_seconds
+            self._dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'requests': [[*key, n] for key, n in self.requests.items()],
+                'latency': [[*key, hist] for key, hist in self.latency.items()],
+                'in_flight': dict(self.in_flight),
+                'sql': {route: list(v) for route, v in self.sql.items()},
+                'sql_count': {route: list(h) for route, h in self.sql_count.items()},
+                'queries': sql_tracer.snapshot(),
+            }
+
+    def folder(self):
+        return app.config['METRICS_DIR'] or os.path.join(os.path.dirname(app.config['DATABASE']) or '.', 'metrics')
+
+    def write(self):
+        """Replace this worker's snapshot file (atomically, readers never see half of it)."""
+        self._dirty = sql_tracer.dirty = False
+        folder = self.folder()
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(self.snapshot(), fh, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='metrics-writer', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['METRICS_FLUSH_INTERVAL'])
+            if self._dirty or sql_tracer.dirty:
+                try:
+                    self.write()
+                except OSError:
+                    app.logger.exception('Could not write the metrics snapshot')
+
+    def collect(self):
+        """Sum of every worker's snapshot (this one fresh); in-flight only counts live workers."""
+        self.write()
+        folder = self.folder()
+        self._fold_dead(folder)
+        total = {'requests': {}, 'latency': {}, 'in_flight': {}, 'sql': {}, 'sql_count': {}, 'queries': {},
+                 'workers': 0}
+        for name in os.listdir(folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(folder, name)) as fh:
+                    snap = json.load(fh)
+            except (OSError, ValueError):
+                continue  # folded away or replaced in between
+            merge_metrics(total, snap)
+            if name != 'dead.json' and pid_alive(snap['pid']):
+                total['workers'] += 1
+                for route, n in snap['in_flight'].items():
+                    total['in_flight'][route] = total['in_flight'].get(route, 0) + n
+        return total
+
+    def _fold_dead(self, folder):
+        if fcntl is None:
+            return  # without a lock two scrapes could fold the same file twice
+        dead = [name for name in os.listdir(folder)
+                if name.endswith('.json') and name[:-5].isdigit() and not pid_alive(int(name[:-5]))]
+        if not dead:
+            return
+        with open(os.path.join(folder, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            dead_path = os.path.join(folder, 'dead.json')
+            try:
+                with open(dead_path) as fh:
+                    folded = json.load(fh)
+            except (OSError, ValueError):
+                folded = {'requests': [], 'latency': [], 'in_flight': {}, 'sql': {}, 'sql_count': {}}
+            merged = {'requests': {}, 'latency': {}, 'sql': {}, 'sql_count': {}, 'queries': {}}
+            merge_metrics(merged, folded)
+            for name in dead:
+                try:
+                    with open(os.path.join(folder, name)) as fh:
+                        merge_metrics(merged, json.load(fh))
+                except (OSError, ValueError):
+                    continue
+            with open(dead_path + '.tmp', 'w') as fh:
+                json.dump({
+                    'requests': [[*key, n] for key, n in merged['requests'].items()],
+                    'latency': [[*key, hist] for key, hist in merged['latency'].items()],
+                    'in_flight': {},
+                    'sql': merged['sql'],
+                    'sql_count': merged['sql_count'],
+                    'queries': [[*key, *entry] for key, entry in merged['queries'].items()],
+                }, fh, separators=(',', ':'))
+            os.replace(dead_path + '.tmp', dead_path)
+            for name in dead:
+                try:
+                    os.remove(os.path.join(folder, name))
+                except FileNotFoundError:
+                    pass
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _add_lists(into, key, values):
+    current = into.get(key)
+    into[key] = list(values) if current is None else [a + b for a, b in zip(current, values)]
+
+def merge_metrics(total, snap):
+    """Add a snapshot (as written by RequestMetrics.snapshot) into `total`."""
+    for route, method, status, n in snap['requests']:
+        key = (route, method, status)
+        total['requests'][key] = total['requests'].get(key, 0) + n
+    for route, method, hist in snap['latency']:
+        _add_lists(total['latency'], (route, method), hist)
+    for route, values in snap['sql'].items():
+        _add_lists(total['sql'], route, values)
+    for route, hist in snap['sql_count'].items():
+        _add_lists(total['sql_count'], route, hist)
+    for sql, endpoint, calls, seconds, max_seconds, rows, ticks in snap.get('queries', ()):
+        entry = total['queries'].get((sql, endpoint))
+        if entry is None:
+            total['queries'][(sql, endpoint)] = [calls, seconds, max_seconds, rows, ticks]
+        else:
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] = max(entry[2], max_seconds)
+            entry[3] += rows
+            entry[4] += ticks
+
+request_metrics = RequestMetrics()
+
+@atexit.register
+def write_final_metrics():
+    if request_metrics._dirty:
+        try:
+            request_metrics.write()
+        except OSError:
+            pass
+
+def metrics_route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        route = metrics_route()
+        # one g entry: every g / request access goes through a context-local proxy
+        g.metrics = (route, request.method, time.perf_counter(), *sql_usage())
+        request_metrics.started(route)
+
+@app.before_request
+def tag_sql_endpoint():
+    if app.config['SQL_TRACE']:
+        _sql_local.endpoint = request.endpoint or 'unmatched'
+        request_metrics._ensure_thread()
+
+@app.teardown_request
+def untag_sql_endpoint(exc):
+    _sql_local.endpoint = None
+
+@app.after_request
+def note_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    started = g.pop('metrics', None)
+    if started is None:
+        return
+    route, method, at, statements, seconds = started
+    elapsed = time.perf_counter() - at
+    statements_now, seconds_now = sql_usage()
+    request_metrics.finished(route, method, g.get('metrics_status', 500), elapsed,
+                             statements_now - statements, seconds_now - seconds)
+
+def _prom_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+
+def _prom_histogram(lines, name, buckets, hist, **labels):
+    cumulative = 0
+    for bound, n in zip(list(buckets) + ['+Inf'], hist):
+        cumulative += n
+        lines.append(f'{name}_bucket{_prom_labels(**labels, le=bound)} {cumulative}')
+    lines.append(f'{name}_sum{_prom_labels(**labels)} {hist[-2]:.6f}')
+    lines.append(f'{name}_count{_prom_labels(**labels)} {hist[-1]}')
+
+def render_metrics(total):
+    """Prometheus text exposition (version 0.0.4) of `RequestMetrics.collect()`."""
+    lines = [
+        '# HELP pilly_http_requests_total Requests by route, method and status code.',
+        '# TYPE pilly_http_requests_total counter',
+    ]
+    for (route, method, status), n in sorted(total['requests'].items()):
+        lines.append(f'pilly_http_requests_total{_prom_labels(route=route, method=method, status=status)} {n}')
+    lines += [
+        '# HELP pilly_http_request_duration_seconds Time to build the response, by route and method.',
+        '# TYPE pilly_http_request_duration_seconds histogram',
+    ]
+    for (route, method), hist in sorted(total['latency'].items()):
+        _prom_histogram(lines, 'pilly_http_request_duration_seconds', LATENCY_BUCKETS, hist,
+                        route=route, method=method)
+    lines += [
+        '# HELP pilly_http_requests_in_flight Requests in progress in live workers.',
+        '# TYPE pilly_http_requests_in_flight gauge',
+    ]
+    for route, n in sorted(total['in_flight'].items()):
+        lines.append(f'pilly_http_requests_in_flight{_prom_labels(route=route)} {n}')
+    lines += [
+        '# HELP pilly_sql_statements_total SQL statements run by requests, by route.',
+        '# TYPE pilly_sql_statements_total counter',
+    ]
+    for route, (statements, _) in sorted(total['sql'].items()):
+        lines.append(f'pilly_sql_statements_total{_prom_labels(route=route)} {statements}')
+    lines += [
+        '# HELP pilly_sql_seconds_total Time requests spent in SQLite (execute, fetch, commit), by route.',
+        '# TYPE pilly_sql_seconds_total counter',
+    ]
+    for route, (_, seconds) in sorted(total['sql'].items()):
+        lines.append(f'pilly_sql_seconds_total{_prom_labels(route=route)} {seconds:.6f}')
+    lines += [
+        '# HELP pilly_http_request_sql_statements SQL statements per request, by route.',
+        '# TYPE pilly_http_request_sql_statements histogram',
+    ]
+    for route, hist in sorted(total['sql_count'].items()):
+        _prom_histogram(lines, 'pilly_http_request_sql_statements', SQL_COUNT_BUCKETS, hist, route=route)
+    lines += [
+        '# HELP pilly_workers Workers that have written a metrics snapshot and are alive.',
+        '# TYPE pilly_workers gauge',
+        f"pilly_workers {total['workers']}",
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 def ensure_column(db, table, column, coltype_sql):
     """Add column if it does not exist (SQLite)."""
@@ -35,33 +723,1371 @@ def ensure_column(db, table, column, coltype_sql):
 def generate_api_key():
     return secrets.token_urlsafe(32)
 
+MAC_RE = re.compile(r'([0-9a-f]{2}:){5}[0-9a-f]{2}')
+
+def normalize_mac(value):
+    """Lowercase, ':'-separated MAC ("AA-BB-..." and bare "AABBCC..." accepted); check it with MAC_RE."""
+    mac = str(value or '').strip().lower().replace('-', ':')
+    if len(mac) == 12 and ':' not in mac:
+        mac = ':'.join(mac[i:i + 2] for i in range(0, 12, 2))
+    return mac
+
 def get_device_by_mac(db, mac_address):
     return db.execute('SELECT * FROM devices WHERE mac_address = ?', (mac_address,)).fetchone()
 
+def get_state_version(db, key):
+    row = db.execute('SELECT value FROM app_state WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row else 0
+
+def bump_state_version(db, key):
+    """Bump a shared version counter; commits with the caller's transaction."""
+    db.execute('''
+        INSERT INTO app_state (key, value) VALUES (?, 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    ''', (key,))
+
+class DeviceCache:
+    """Bounded LRU/TTL cache of device credentials keyed by MAC.
+
+    Entries hold the id, a SHA-256 digest of the api_key, admin_state and the OTA
+    fields. Local invalidation is immediate; other gunicorn workers notice through
+    the `device_auth` counter in app_state, checked at most every
+    DEVICE_CACHE_CHECK_INTERVAL seconds, and drop their whole cache.
+    """
+
+    VERSION_KEY = 'device_auth'
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def sync(self, db):
+        now = time.monotonic()
+        if now - self._checked_at < app.config['DEVICE_CACHE_CHECK_INTERVAL']:
+            return
+        version = get_state_version(db, self.VERSION_KEY)
+        with self._lock:
+            self._checked_at = now
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+
+    def get(self, mac):
+        mac = mac.lower()  # keyed without case, like the lookup
+        with self._lock:
+            item = self._entries.get(mac)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._entries[mac]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(mac)
+            self.hits += 1
+            return item[1]
+
+    def put(self, mac, entry):
+        mac = mac.lower()
+        with self._lock:
+            self._entries[mac] = (time.monotonic() + app.config['DEVICE_CACHE_TTL'], entry)
+            self._entries.move_to_end(mac)
+            while len(self._entries) > app.config['DEVICE_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, db, mac=None):
+        """Drop `mac` (or everything) here and tell the other workers to do the same."""
+        with self._lock:
+            if mac is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(mac.lower(), None)
+            self.invalidations += 1
+        bump_state_version(db, self.VERSION_KEY)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': app.config['DEVICE_CACHE_SIZE'],
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'version': self._version,
+            }
+
+device_cache = DeviceCache()
+
+def api_key_digest(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).digest()
+
+# MACs are stored in lower case (normalize_mac) and matched without regard to case: the
+# firmware sends WiFi.macAddress() in upper case. Rows from before that may still be in
+# upper case; an exact match wins if an old database holds both spellings.
+DEVICE_BY_MAC_SQL = '''
+    SELECT * FROM devices WHERE mac_address = ? COLLATE NOCASE
+    ORDER BY mac_address = ? DESC LIMIT 1
+'''
+
 def verify_device_request(db, mac, api_key):
     if not mac or not api_key:
         return None, ("missing_fields", 400)
+    if not isinstance(mac, str) or not isinstance(api_key, str):
+        return None, ("invalid_fields", 400)
 
-    cur = db.cursor()
-    cur.execute("SELECT * FROM devices WHERE mac_address = ? LIMIT 1", (mac,))
-    row = cur.fetchone()
+    device_cache.sync(db)
+    entry = device_cache.get(mac)
+    if entry is None:
+        row = db.execute(DEVICE_BY_MAC_SQL, (mac, mac)).fetchone()
 
-    if row is None:
-        return None, ("device_not_found", 404)
+        if row is None:
+            return None, ("device_not_found", 404)
 
-    device = dict(row)  # ✅ convierte sqlite3.Row a dict
+        entry = {
+            'id': row['id'],
+            'mac_address': row['mac_address'],
+            'api_key_digest': api_key_digest(row['api_key']) if row['api_key'] else None,
+            'admin_state': row['admin_state'],
+            'ota_enabled': row['ota_enabled'],
+            'ota_target_version': row['ota_target_version'],
+        }
+        device_cache.put(mac, entry)
 
-    if not device.get("api_key"):
+    if not entry['api_key_digest']:
         return None, ("device_no_api_key", 401)
 
-    if device["api_key"] != api_key:
+    if not hmac.compare_digest(entry['api_key_digest'], api_key_digest(api_key)):
         return None, ("invalid_api_key", 401)
 
     # opcional: bloqueado / no aprobado
-    if device.get("status") == "blocked":
+    if (entry['admin_state'] or '').lower() == 'blocked':
         return None, ("device_blocked", 403)
 
-    return device, None
+    # mac_address is the stored spelling: write with it, not with the request's
+    return dict(entry), None
+
+def utc_now_sql():
+    """Current UTC time in SQLite's CURRENT_TIMESTAMP format."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+HEARTBEAT_UPDATE_SQL = '''
+    UPDATE devices
+    SET last_seen = ?,
+        status = CASE WHEN COALESCE(admin_state, 'active') = 'active' THEN 'online' ELSE 'suspended' END,
+        uptime = ?,
+        free_heap = ?,
+        ip_address = COALESCE(?, ip_address),
+        ssid = COALESCE(?, ssid),
+        firmware_version = COALESCE(?, firmware_version)
+    WHERE mac_address = ?
+'''
+
+class HeartbeatBuffer:
+    """Write-behind buffer for heartbeat device updates.
+
+    Keeps only the latest values per MAC and writes them with a single executemany
+    transaction every HEARTBEAT_FLUSH_INTERVAL seconds, or as soon as
+    HEARTBEAT_FLUSH_SIZE devices are pending. Status is derived from admin_state at
+    flush time, so an admin block in between is never overwritten.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def add(self, mac, uptime, free_heap, ip_address=None, ssid=None, firmware_version=None):
+        row = [utc_now_sql(), uptime, free_heap, ip_address, ssid, firmware_version, mac]
+        with self._lock:
+            prev = self._pending.get(mac)
+            if prev is not None:
+                # keep COALESCE semantics across coalesced beats
+                for i in (3, 4, 5):
+                    if row[i] is None:
+                        row[i] = prev[i]
+            self._pending[mac] = row
+            size = len(self._pending)
+        self._ensure_thread()
+        if size >= app.config['HEARTBEAT_FLUSH_SIZE']:
+            self._wake.set()
+
+    def discard(self, mac):
+        with self._lock:
+            self._pending.pop(mac, None)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+        try:
+            with app.app_context():
+                db = get_db()
+                publish_status_changes(db, batch.values())
+                db.executemany(HEARTBEAT_UPDATE_SQL, list(batch.values()))
+                db.commit()
+        except sqlite3.Error:
+            app.logger.exception('Heartbeat flush failed, re-queueing %d devices', len(batch))
+            with self._lock:
+                for mac, row in batch.items():
+                    self._pending.setdefault(mac, row)
+            return 0
+        return len(batch)
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='heartbeat-flusher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(app.config['HEARTBEAT_FLUSH_INTERVAL'])
+            self._wake.clear()
+            self.flush()
+
+heartbeat_buffer = HeartbeatBuffer()
+atexit.register(heartbeat_buffer.flush)
+
+class AlarmGate:
+    """Per-worker storm control for device alarms.
+
+    Repeats of a stored alarm (same type and severity) within ALARM_DEDUP_SECONDS are
+    folded into it: `occurrences` / `last_seen` are bumped in one batched UPDATE every
+    ALARM_FOLD_FLUSH_INTERVAL instead of a row each. A token bucket per (device,
+    alarm_type) turns a sensor that keeps opening new rows into 429s; folds cost no
+    token. State is per worker, so a storm spread over N workers stores at most N rows
+    per window.
+    """
+
+    def __init__(self):
+        self._buckets = {}  # (device_id, alarm_type) -> [tokens, updated_at]
+        self._windows = {}  # (device_id, alarm_type, severity) -> [row_id, expires_at, folded, last_seen]
+        self._carry = []    # folds of windows replaced before they were flushed
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def admit(self, key, seen_at):
+        """Gate one alarm, `key` = (device_id, alarm_type, severity).
+
+        Returns ('folded', 0) when it was counted into the open window of a stored alarm,
+        ('limited', seconds until the next token) when the budget is spent, or ('new', 0):
+        a token was spent and a window opened, and the caller stores the row and reports
+        it with `opened()`. Only alarms that open a new row cost a token.
+        """
+        dedup = app.config['ALARM_DEDUP_SECONDS']
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key) if dedup > 0 else None
+            if window and window[1] > now:
+                window[2] += 1
+                window[3] = max(window[3], seen_at)
+                return 'folded', 0
+            wait = self._take(key[:2], now)
+            if wait:
+                return 'limited', wait
+            if dedup > 0:
+                if window and window[0] is not None and window[2]:
+                    self._carry.append((window[2], window[3], window[0]))
+                self._windows[key] = [None, now + dedup, 0, seen_at]
+        self._ensure_thread()
+        return 'new', 0
+
+    def _take(self, bucket_key, now):
+        """Spend a token (lock held); returns 0, or the seconds until the next one."""
+        rate = app.config['ALARM_RATE']
+        if rate <= 0:
+            return 0
+        burst = app.config['ALARM_BURST']
+        bucket = self._buckets.setdefault(bucket_key, [burst, now])
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / rate
+        bucket[0] -= 1
+        return 0
+
+    def opened(self, key, row_id):
+        with self._lock:
+            window = self._windows.get(key)
+            if window and window[0] is None:
+                window[0] = row_id
+
+    def abandon(self, key):
+        with self._lock:
+            window = self._windows.get(key)
+            if window and window[0] is None:
+                del self._windows[key]
+
+    def flush(self):
+        now = time.monotonic()
+        with self._lock:
+            rows, self._carry = self._carry, []
+            for key, window in list(self._windows.items()):
+                if window[0] is not None and window[2]:
+                    rows.append((window[2], window[3], window[0]))
+                    window[2] = 0
+                if window[1] <= now and (window[0] is not None or window[1] <= now - 60):
+                    del self._windows[key]
+            rate = app.config['ALARM_RATE']
+            if rate > 0:
+                # buckets idle long enough to be full again are the same as no bucket
+                full_since = now - app.config['ALARM_BURST'] / rate
+                for key in [k for k, b in self._buckets.items() if b[1] <= full_since]:
+                    del self._buckets[key]
+        if not rows:
+            return 0
+        try:
+            with app.app_context():
+                db = get_db()
+                db.executemany('''
+                    UPDATE alarms
+                    SET occurrences = occurrences + ?, last_seen = MAX(COALESCE(last_seen, created_at), ?)
+                    WHERE id = ?
+                ''', rows)
+                db.commit()
+        except sqlite3.Error:
+            app.logger.exception('Alarm fold flush failed, re-queueing %d rows', len(rows))
+            with self._lock:
+                self._carry.extend(rows)
+            return 0
+        return len(rows)
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='alarm-folder', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['ALARM_FOLD_FLUSH_INTERVAL'])
+            self.flush()
+
+alarm_gate = AlarmGate()
+atexit.register(alarm_gate.flush)
+
+def server_busy(error, retry_after=5):
+    """503 for a request that would hold one more thread than the worker allows."""
+    resp = jsonify({'error': error, 'retry_after': retry_after})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(retry_after)
+    return resp
+
+def too_many_alarms(retry_after):
+    retry_after = max(1, math.ceil(retry_after))
+    resp = device_reply({'error': 'Too many alarms', 'retry_after': retry_after}, 429)
+    resp.headers['Retry-After'] = str(retry_after)
+    return resp
+
+# ---- Live events (SSE) ----
+# Writers append to the `events` table in the same transaction as the change itself
+# (outbox), so every gunicorn worker sees the same ordered feed; each worker tails it
+# with one poller thread and fans the rows out to its open /api/events streams.
+EVENT_POLL_SQL = 'SELECT id, kind, data FROM events WHERE id > ? ORDER BY id LIMIT ?'
+
+ALARM_EVENTS_SQL = '''
+    INSERT INTO events (kind, data)
+    SELECT 'alarm', json_object('id', a.id, 'device_id', a.device_id, 'alarm_type', a.alarm_type,
+                                'message', a.message, 'severity', a.severity, 'created_at', a.created_at,
+                                'occurrences', a.occurrences, 'last_seen', a.last_seen,
+                                'device_name', d.device_name, 'mac_address', d.mac_address)
+    FROM alarms a
+    LEFT JOIN devices d ON a.device_id = d.id
+    WHERE a.id BETWEEN ? AND ?
+    ORDER BY a.id
+'''
+
+def publish_event(db, kind, data):
+    """Queue an event in the caller's transaction; it goes out once that commits."""
+    db.execute('INSERT INTO events (kind, data) VALUES (?, ?)', (kind, json.dumps(data, default=str)))
+    g.events_published = True
+
+def publish_alarm_events(db, first_id, last_id=None):
+    """One `alarm` event per alarms row in [first_id, last_id], shaped like /api/alarms/list."""
+    db.execute(ALARM_EVENTS_SQL, (first_id, last_id or first_id))
+    g.events_published = True
+
+def publish_status_changes(db, beats):
+    """device_status events for the devices a heartbeat batch is about to flip."""
+    beats = {row[6]: row for row in beats}
+    macs = list(beats)
+    for start in range(0, len(macs), 500):
+        chunk = macs[start:start + 500]
+        rows = db.execute(f'''
+            SELECT id, mac_address, status, admin_state FROM devices
+            WHERE mac_address IN ({','.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+        for row in rows:
+            status = 'online' if (row['admin_state'] or 'active') == 'active' else 'suspended'
+            if row['status'] != status:
+                publish_event(db, 'device_status', {
+                    'id': row['id'], 'mac_address': row['mac_address'], 'status': status,
+                    'previous': row['status'], 'last_seen': beats[row['mac_address']][0],
+                })
+
+@app.teardown_appcontext
+def wake_event_hub(exc):
+    if g.pop('events_published', False):
+        event_hub.notify()
+
+def format_sse(event_id, kind, data):
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+
+class EventSubscriber:
+    def __init__(self, since, maxsize):
+        self.since = since
+        self.queue = queue.Queue(maxsize)
+        self.dropped = False
+
+    def offer(self, event_id, frame):
+        if event_id <= self.since or self.dropped:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped = True
+            return False
+        self.since = event_id
+        return True
+
+class EventHub:
+    """Per-worker fan-out of the `events` outbox.
+
+    The poller reads new rows every EVENTS_POLL_INTERVAL seconds (at once after a local
+    commit published something), formats each one a single time and hands the same
+    frame to every subscriber queue. A stream that falls EVENTS_QUEUE_SIZE frames behind
+    is dropped; the browser reconnects with Last-Event-ID and catches up from the table.
+    In-process watchers (long-polling devices) keep the poller reading without a stream
+    and get the rows of the kinds they `listen` to.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._watchers = 0
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self._last_id = None
+        self._rewind = None
+        self._pruned_at = 0.0
+        self.delivered = self.dropped = 0
+
+    def subscribe(self, since, limit=None):
+        """None when `limit` streams are already open."""
+        sub = EventSubscriber(since, app.config['EVENTS_QUEUE_SIZE'])
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return None
+            self._subscribers.add(sub)
+            self._rewind = since if self._rewind is None else min(self._rewind, since)
+        self.notify()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def listen(self, kind, callback):
+        self._listeners[kind] = callback
+
+    def watch(self, since):
+        """Keep reading the feed from `since` on (until unwatch) for the listeners."""
+        with self._lock:
+            self._watchers += 1
+            self._rewind = since if self._rewind is None else min(self._rewind, since)
+        self._ensure_thread()
+
+    def unwatch(self):
+        with self._lock:
+            self._watchers -= 1
+
+    def notify(self):
+        self._ensure_thread()
+        self._wake.set()
+
+    def poll(self):
+        with self._lock:
+            subs = list(self._subscribers)
+            watching = self._watchers > 0
+            since = self._last_id
+            if self._rewind is not None:
+                since = self._rewind if since is None else min(since, self._rewind)
+                self._rewind = None
+        with app.app_context():
+            db = get_db()
+            if time.monotonic() - self._pruned_at > 60:
+                self._pruned_at = time.monotonic()
+                db.execute("DELETE FROM events WHERE created_at < datetime('now', ?)",
+                           (f"-{app.config['EVENTS_RETENTION_MINUTES']} minutes",))
+                db.commit()
+            if not subs and not watching:
+                since = None
+            while since is not None:
+                rows = db.execute(EVENT_POLL_SQL, (since, 500)).fetchall()
+                for row in rows:
+                    listener = self._listeners.get(row['kind'])
+                    if watching and listener:
+                        listener(row['data'])
+                    if subs:
+                        frame = format_sse(row['id'], row['kind'], row['data'])
+                        for sub in subs:
+                            if sub.offer(row['id'], frame):
+                                self.delivered += 1
+                    since = row['id']
+                live = [sub for sub in subs if not sub.dropped]
+                self.dropped += len(subs) - len(live)
+                subs = live
+                if len(rows) < 500:
+                    break
+        with self._lock:
+            self._subscribers.difference_update([sub for sub in self._subscribers if sub.dropped])
+            self._last_id = since if self._subscribers or self._watchers else None
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers), 'watchers': self._watchers,
+                    'last_id': self._last_id,
+                    'delivered': self.delivered, 'dropped': self.dropped}
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='event-hub', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(app.config['EVENTS_POLL_INTERVAL'])
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception:
+                app.logger.exception('Event poll failed')
+
+event_hub = EventHub()
+
+def event_head(db):
+    return db.execute('SELECT MAX(id) AS id FROM events').fetchone()['id'] or 0
+
+class CommandWaiters:
+    """Requests long-polling /api/esp32/command/<mac>, by device id.
+
+    queue_device_command wakes them directly; commands queued on another worker arrive
+    through the `command` events read by the EventHub poller (EVENTS_POLL_INTERVAL).
+    """
+
+    def __init__(self):
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def register(self, device_id, since, waiter=None, limit=None):
+        """`waiter` is anything with a thread-safe set(); a threading.Event by default.
+
+        None when `limit` requests are already waiting.
+        """
+        waiter = waiter or threading.Event()
+        with self._lock:
+            if limit is not None and sum(len(waiters) for waiters in self._waiting.values()) >= limit:
+                return None
+            self._waiting.setdefault(device_id, set()).add(waiter)
+        event_hub.watch(since)
+        return waiter
+
+    def unregister(self, device_id, waiter):
+        with self._lock:
+            waiters = self._waiting.get(device_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiting[device_id]
+        event_hub.unwatch()
+
+    def wake(self, device_id):
+        with self._lock:
+            for waiter in self._waiting.get(device_id, ()):
+                waiter.set()
+
+    def on_event(self, data):
+        event = json.loads(data)
+        if event.get('status') == 'pending':
+            # one event per queued command, or one per fan-out campaign
+            for device_id in event.get('device_ids') or (event['device_id'],):
+                self.wake(device_id)
+
+    def count(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiting.values())
+
+command_waiters = CommandWaiters()
+event_hub.listen('command', command_waiters.on_event)
+
+SUPPORTED_COMMANDS = ('restart',)
+
+def claim_pending_command(db, device_id):
+    """Oldest pending command of the device, marked as sent (commits with the caller)."""
+    cmd_row = db.execute('''
+        SELECT id, command, payload, campaign_id FROM device_commands
+        WHERE device_id = ? AND status = 'pending'
+        ORDER BY requested_at ASC
+        LIMIT 1
+    ''', (device_id,)).fetchone()
+    if not cmd_row:
+        return None
+    claimed = db.execute("UPDATE device_commands SET status='sent', sent_at=CURRENT_TIMESTAMP "
+                         "WHERE id=? AND status='pending'", (cmd_row['id'],)).rowcount
+    if not claimed:
+        return None  # another poll of the same device got it first
+    publish_event(db, 'command', {'id': cmd_row['id'], 'device_id': device_id, 'command': cmd_row['command'],
+                                  'status': 'sent', 'campaign_id': cmd_row['campaign_id']})
+    payload = None
+    if cmd_row['payload']:
+        try:
+            payload = json.loads(cmd_row['payload'])
+        except Exception:
+            payload = {'raw': cmd_row['payload']}
+    return {'id': cmd_row['id'], 'command': cmd_row['command'], 'payload': payload}
+
+# ---- Leader-elected background jobs ----
+class LeaderTask:
+    """Periodic job that runs in a single gunicorn worker at a time.
+
+    Every worker runs the loop, but only the holder of the `leases` row for `name`
+    calls `func(db)`. The holder renews the lease on each tick; if it dies the row
+    expires after three intervals and another worker takes over. Each run stores its
+    duration and result in the lease row (see /api/admin/background).
+    """
+
+    def __init__(self, name, interval_key, func):
+        self.name = name
+        self.interval_key = interval_key
+        self.func = func
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def holder(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def acquire(self, db):
+        now = time.time()
+        won = db.execute('''
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+        ''', (self.name, self.holder, now + 3 * app.config[self.interval_key], now)).rowcount
+        db.commit()
+        return won == 1
+
+    def run_once(self):
+        """One tick: returns the job result, or None when another worker is the leader."""
+        with app.app_context():
+            db = get_db()
+            if not self.acquire(db):
+                return None
+            started = time.perf_counter()
+            result = self.func(db)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            db.execute('''
+                UPDATE leases SET last_run_at = ?, last_run_ms = ?, last_result = ?
+                WHERE name = ? AND holder = ?
+            ''', (utc_now_sql(), round(elapsed_ms, 2), json.dumps(result), self.name, self.holder))
+            db.commit()
+            return result
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name=f'leader-{self.name}', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config[self.interval_key])
+            try:
+                self.run_once()
+            except Exception:
+                app.logger.exception('Background job %s failed', self.name)
+
+def sweep_offline_devices(db):
+    """Flip every device whose last heartbeat is older than the grace period to offline.
+
+    Set-based: one INSERT...SELECT for the device_offline alarms, one for the
+    dashboard events and one UPDATE, all on the (status, last_seen) index and in a
+    single write transaction.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=app.config['OFFLINE_GRACE_SECONDS'])) \
+        .strftime('%Y-%m-%d %H:%M:%S')
+    flipped = db.execute('''
+        INSERT INTO alarms (device_id, alarm_type, message, severity)
+        SELECT id, 'device_offline', 'Sin heartbeat desde ' || last_seen || ' UTC', 'warning'
+        FROM devices
+        WHERE status = 'online' AND last_seen < ?
+    ''', (cutoff,)).rowcount
+    if flipped:
+        last_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+        publish_alarm_events(db, last_id - flipped + 1, last_id)
+        db.execute('''
+            INSERT INTO events (kind, data)
+            SELECT 'device_status', json_object('id', id, 'mac_address', mac_address, 'status', 'offline',
+                                                'previous', 'online', 'last_seen', last_seen)
+            FROM devices
+            WHERE status = 'online' AND last_seen < ?
+        ''', (cutoff,))
+        db.execute("UPDATE devices SET status = 'offline' WHERE status = 'online' AND last_seen < ?", (cutoff,))
+    db.commit()
+    return {'offline': flipped, 'cutoff': cutoff}
+
+offline_sweeper = LeaderTask('offline_sweeper', 'SWEEP_INTERVAL', sweep_offline_devices)
+
+# ---- Telemetry store ----
+# telemetry_blocks rows hold one device's samples for a time span as columns of
+# zigzag varints, each column delta-encoded:
+#   resolution 0     raw chunk:  ts, uptime, free_heap            (one per device per worker flush)
+#   resolution 60    1-minute:   ts, count, heap min, heap max, heap sum, uptime max, reboots
+#   resolution 3600  1-hour:     same columns                     (60 s blocks span an hour, 1 h blocks a day)
+ROLLUPS = ((60, 3600), (3600, 86400))  # (resolution, block span)
+
+def encode_series(columns):
+    out = bytearray()
+
+    def varint(n):
+        while n > 0x7F:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    varint(len(columns))
+    varint(len(columns[0]) if columns else 0)
+    for column in columns:
+        prev = 0
+        for value in column:
+            delta = value - prev
+            varint(delta << 1 if delta >= 0 else ((-delta) << 1) - 1)
+            prev = value
+    return bytes(out)
+
+def decode_series(data):
+    pos = 0
+
+    def varint():
+        nonlocal pos
+        n = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    ncols, nrows = varint(), varint()
+    columns = []
+    for _ in range(ncols):
+        column, prev = [], 0
+        for _ in range(nrows):
+            z = varint()
+            prev += (z >> 1) if not z & 1 else -((z + 1) >> 1)
+            column.append(prev)
+        columns.append(column)
+    return columns
+
+class TelemetryBuffer:
+    """Per-worker heartbeat samples, written as one raw chunk per device once the oldest
+    sample is TELEMETRY_BLOCK_SECONDS old (and on shutdown). A crashed worker loses at
+    most that window of history; the current values in `devices` are unaffected.
+    """
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def add(self, device_id, uptime, free_heap):
+        try:
+            sample = (int(time.time()), int(uptime or 0), int(free_heap or 0))
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._samples.setdefault(device_id, []).append(sample)
+        self._ensure_thread()
+
+    def flush(self, force=False):
+        cutoff = time.time() - app.config['TELEMETRY_BLOCK_SECONDS']
+        with self._lock:
+            due = {device_id: samples for device_id, samples in self._samples.items()
+                   if force or samples[0][0] <= cutoff}
+            for device_id in due:
+                del self._samples[device_id]
+        if not due:
+            return 0
+        rows = [(device_id, samples[0][0], samples[-1][0], len(samples),
+                 encode_series([list(column) for column in zip(*samples)]))
+                for device_id, samples in due.items()]
+        try:
+            with app.app_context():
+                db = get_db()
+                db.executemany('''
+                    INSERT INTO telemetry_blocks (device_id, resolution, block_start, block_end, count, data)
+                    VALUES (?, 0, ?, ?, ?, ?)
+                ''', rows)
+                db.commit()
+        except sqlite3.Error:
+            app.logger.exception('Telemetry flush failed, re-queueing %d devices', len(due))
+            with self._lock:
+                for device_id, samples in due.items():
+                    self._samples[device_id] = samples + self._samples.get(device_id, [])
+            return 0
+        return len(rows)
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='telemetry-flusher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(5)
+            self.flush()
+
+telemetry_buffer = TelemetryBuffer()
+atexit.register(telemetry_buffer.flush, True)
+
+def merge_bucket(buckets, ts, count, heap_min, heap_max, heap_sum, uptime_max, reboots):
+    agg = buckets.get(ts)
+    if agg is None:
+        buckets[ts] = [count, heap_min, heap_max, heap_sum, uptime_max, reboots]
+    else:
+        agg[0] += count
+        agg[1] = min(agg[1], heap_min)
+        agg[2] = max(agg[2], heap_max)
+        agg[3] += heap_sum
+        agg[4] = max(agg[4], uptime_max)
+        agg[5] += reboots
+
+def rollup_buckets(data):
+    ts, count, heap_min, heap_max, heap_sum, uptime_max, reboots = decode_series(data)
+    buckets = {}
+    for row in zip(ts, count, heap_min, heap_max, heap_sum, uptime_max, reboots):
+        merge_bucket(buckets, *row)
+    return buckets
+
+def rollup_telemetry(db, batch=5000):
+    """Fold raw chunks not rolled up yet into the 1-minute and 1-hour blocks, then expire old blocks."""
+    chunks = db.execute('''
+        SELECT id, device_id, data FROM telemetry_blocks
+        WHERE resolution = 0 AND rolled = 0
+        ORDER BY id LIMIT ?
+    ''', (batch,)).fetchall()
+
+    pending = {}
+    for chunk in chunks:
+        prev_uptime = None
+        for ts, uptime, heap in zip(*decode_series(chunk['data'])):
+            reboot = 1 if prev_uptime is not None and uptime < prev_uptime else 0
+            prev_uptime = uptime
+            for resolution, span in ROLLUPS:
+                buckets = pending.setdefault((chunk['device_id'], resolution, ts - ts % span), {})
+                merge_bucket(buckets, ts - ts % resolution, 1, heap, heap, heap, uptime, reboot)
+
+    for (device_id, resolution, block_start), buckets in pending.items():
+        row = db.execute('''
+            SELECT id, data FROM telemetry_blocks
+            WHERE device_id = ? AND resolution = ? AND block_start = ?
+        ''', (device_id, resolution, block_start)).fetchone()
+        if row:
+            merged = rollup_buckets(row['data'])
+            for ts, agg in buckets.items():
+                merge_bucket(merged, ts, *agg)
+            buckets = merged
+        order = sorted(buckets)
+        data = encode_series([order] + [[buckets[ts][i] for ts in order] for i in range(6)])
+        if row:
+            db.execute('''
+                UPDATE telemetry_blocks SET block_end = ?, count = ?, data = ? WHERE id = ?
+            ''', (order[-1] + resolution - 1, len(order), data, row['id']))
+        else:
+            db.execute('''
+                INSERT INTO telemetry_blocks (device_id, resolution, block_start, block_end, count, data, rolled)
+                VALUES (?, ?, ?, ?, ?, ?, 1)
+            ''', (device_id, resolution, block_start, order[-1] + resolution - 1, len(order), data))
+    db.executemany('UPDATE telemetry_blocks SET rolled = 1 WHERE id = ?', [(chunk['id'],) for chunk in chunks])
+
+    now = int(time.time())
+    expired = 0
+    for resolution, days_key in ((0, 'TELEMETRY_RAW_DAYS'), (60, 'TELEMETRY_MINUTE_DAYS'), (3600, 'TELEMETRY_HOUR_DAYS')):
+        expired += db.execute('''
+            DELETE FROM telemetry_blocks WHERE resolution = ? AND block_start < ?
+        ''', (resolution, now - app.config[days_key] * 86400)).rowcount
+    db.commit()
+    return {'chunks': len(chunks), 'blocks': len(pending), 'expired': expired}
+
+telemetry_rollup = LeaderTask('telemetry_rollup', 'TELEMETRY_ROLLUP_INTERVAL', rollup_telemetry)
+
+# ---- OTA rollouts and download slots ----
+# A rollout releases one firmware version in waves (percent of the fleet, picked by a
+# hash of version + MAC so each release gets a different canary group). Every update
+# offered by check_update needs a download slot; at most OTA_MAX_DOWNLOADS are handed
+# out at a time, so the uplink load is bounded whatever is released. The leader frees
+# slots once the device reports the new version (success) or when they expire (failure),
+# and moves each active rollout to its next wave after wave_minutes, pausing it if the
+# failure rate of the current wave goes over max_failure_rate.
+OPEN_ROLLOUT_STATES = ('active', 'paused')
+
+STABLE_FIRMWARE_SQL = '''
+    SELECT * FROM firmwares
+    WHERE is_stable = 1
+      AND version NOT IN (SELECT version FROM rollouts WHERE status IN ('active', 'paused'))
+    ORDER BY uploaded_at DESC
+    LIMIT 1
+'''
+
+def rollout_bucket(version, mac):
+    """0-9999, stable per (version, device)."""
+    digest = hashlib.sha256(f'{version}:{mac.lower()}'.encode()).digest()
+    return int.from_bytes(digest[:4], 'big') % 10000
+
+def rollout_percent(rollout):
+    return json.loads(rollout['waves'])[rollout['wave']]
+
+def parse_waves(value):
+    """Rising wave percents ending in 100, from "1,10,100" or a list."""
+    items = value.split(',') if isinstance(value, str) else list(value)
+    waves = [float(item) for item in items]
+    if not waves or waves[-1] != 100 or any(not 0 < w <= 100 for w in waves) or waves != sorted(set(waves)):
+        raise ValueError('waves must be rising percents ending in 100')
+    return [int(w) if w.is_integer() else w for w in waves]
+
+class FirmwareIndex:
+    """Per-worker memo of everything check_update resolves against.
+
+    Releases by version, the latest stable one outside open rollouts, the active
+    rollout and the delta patches, loaded in one go. Writers bump the `firmware`
+    counter in app_state (uploads, deletes, stable flag, deltas, rollout changes);
+    each worker checks it at most every DEVICE_CACHE_CHECK_INTERVAL seconds and
+    reloads when it moved.
+    """
+
+    VERSION_KEY = 'firmware'
+
+    def __init__(self):
+        self._data = None
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = self.loads = 0
+
+    def get(self, db):
+        now = time.monotonic()
+        with self._lock:
+            if self._data is not None and now - self._checked_at < app.config['DEVICE_CACHE_CHECK_INTERVAL']:
+                self.hits += 1
+                return self._data
+        version = get_state_version(db, self.VERSION_KEY)
+        with self._lock:
+            self._checked_at = now
+            if self._data is not None and version == self._version:
+                self.hits += 1
+                return self._data
+        data = self.load(db)
+        with self._lock:
+            self._data, self._version = data, version
+            self.loads += 1
+        return data
+
+    @staticmethod
+    def load(db):
+        stable = db.execute(STABLE_FIRMWARE_SQL).fetchone()
+        rollout = db.execute("SELECT id, version, waves, wave FROM rollouts WHERE status = 'active' LIMIT 1").fetchone()
+        return {
+            'firmwares': {row['version']: dict(row) for row in db.execute(
+                'SELECT version, filename, file_size, sha256 FROM firmwares')},
+            'stable': stable['version'] if stable else None,
+            'rollout': {'id': rollout['id'], 'version': rollout['version'],
+                        'percent': rollout_percent(rollout)} if rollout else None,
+            'deltas': {(row['from_version'], row['to_version']): dict(row) for row in db.execute(
+                'SELECT from_version, to_version, filename, file_size, sha256 FROM firmware_deltas')},
+        }
+
+    def invalidate(self, db):
+        """Drop the memo here and tell the other workers; commits with the caller."""
+        with self._lock:
+            self._data = None
+        bump_state_version(db, self.VERSION_KEY)
+
+    def stats(self):
+        with self._lock:
+            return {'version': self._version, 'hits': self.hits, 'loads': self.loads,
+                    'releases': len(self._data['firmwares']) if self._data else None}
+
+firmware_index = FirmwareIndex()
+
+def acquire_download_slot(db, device_id, version, rollout_id=None):
+    """Slot token for downloading `version` ('' when downloads are not capped).
+
+    None when OTA_MAX_DOWNLOADS slots are already out. A device asking again keeps its
+    slot; an expired one means the previous attempt never landed and counts as failed.
+    """
+    if app.config['OTA_MAX_DOWNLOADS'] <= 0:
+        return ''
+    now = utc_now_sql()
+    held = db.execute('SELECT token, version, rollout_id, expires_at FROM download_slots WHERE device_id = ?',
+                      (device_id,)).fetchone()
+    if held and held['version'] == version and held['expires_at'] > now:
+        return held['token']
+
+    token = secrets.token_urlsafe(12)
+    expires_at = (datetime.now(timezone.utc) + timedelta(seconds=app.config['OTA_SLOT_SECONDS'])) \
+        .strftime('%Y-%m-%d %H:%M:%S')
+    won = db.execute('''
+        INSERT INTO download_slots (device_id, token, version, rollout_id, expires_at)
+        SELECT ?, ?, ?, ?, ? WHERE (SELECT COUNT(*) FROM download_slots WHERE expires_at > ?) < ?
+        ON CONFLICT (device_id) DO UPDATE SET token = excluded.token, version = excluded.version,
+            rollout_id = excluded.rollout_id, issued_at = CURRENT_TIMESTAMP, expires_at = excluded.expires_at
+    ''', (device_id, token, version, rollout_id, expires_at, now, app.config['OTA_MAX_DOWNLOADS'])).rowcount
+    if won and held and held['expires_at'] <= now and held['rollout_id']:
+        db.execute('UPDATE rollouts SET failed = failed + 1, wave_failed = wave_failed + 1 WHERE id = ?',
+                   (held['rollout_id'],))
+    db.commit()
+    return token if won else None
+
+def ota_busy():
+    # spread the retries so a queue of devices does not come back all at once
+    retry_after = random.randint(app.config['OTA_RETRY_SECONDS'] // 2, app.config['OTA_RETRY_SECONDS'])
+    return device_reply({'update_available': False, 'reason': 'busy', 'retry_after': retry_after})
+
+def advance_rollouts(db):
+    """Settle finished / expired download slots, then advance, pause or complete rollouts."""
+    now = utc_now_sql()
+    # back on the version they downloaded: success
+    landed = db.execute('''
+        SELECT s.device_id, s.rollout_id FROM download_slots s
+        JOIN devices d ON d.id = s.device_id
+        WHERE d.firmware_version = s.version
+    ''').fetchall()
+    expired = db.execute('SELECT device_id, rollout_id FROM download_slots WHERE expires_at <= ?',
+                         (now,)).fetchall()
+    landed_ids = {row['device_id'] for row in landed}
+    expired = [row for row in expired if row['device_id'] not in landed_ids]
+    for rows, column in ((landed, 'updated'), (expired, 'failed')):
+        db.executemany(f'UPDATE rollouts SET {column} = {column} + 1, wave_{column} = wave_{column} + 1 WHERE id = ?',
+                       [(row['rollout_id'],) for row in rows if row['rollout_id']])
+        db.executemany('DELETE FROM download_slots WHERE device_id = ?', [(row['device_id'],) for row in rows])
+
+    changes = []
+    for rollout in db.execute("SELECT * FROM rollouts WHERE status = 'active'").fetchall():
+        attempts = rollout['wave_updated'] + rollout['wave_failed']
+        if attempts >= app.config['ROLLOUT_MIN_ATTEMPTS'] \
+                and rollout['wave_failed'] / attempts > rollout['max_failure_rate']:
+            state, reason = 'paused', f"{rollout['wave_failed']} of {attempts} updates failed in wave {rollout['wave'] + 1}"
+        else:
+            started = datetime.strptime(rollout['wave_started_at'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+            if datetime.now(timezone.utc) - started < timedelta(minutes=rollout['wave_minutes']):
+                continue
+            if rollout['wave'] + 1 < len(json.loads(rollout['waves'])):
+                db.execute('UPDATE rollouts SET wave = wave + 1, wave_started_at = ?, wave_updated = 0, '
+                           'wave_failed = 0 WHERE id = ?',
+                           (now, rollout['id']))
+                changes.append({'id': rollout['id'], 'wave': rollout['wave'] + 1})
+                continue
+            in_flight = db.execute('SELECT COUNT(*) FROM download_slots WHERE rollout_id = ?',
+                                   (rollout['id'],)).fetchone()[0]
+            if in_flight:
+                continue
+            state, reason = 'completed', None
+            # the whole fleet has it: from now on it is the regular stable release
+            db.execute('UPDATE firmwares SET is_stable = 1 WHERE version = ?', (rollout['version'],))
+        db.execute('UPDATE rollouts SET status = ?, reason = ?, finished_at = ? WHERE id = ?',
+                   (state, reason, now if state == 'completed' else None, rollout['id']))
+        changes.append({'id': rollout['id'], 'status': state, 'reason': reason})
+
+    for change in changes:
+        publish_event(db, 'rollout', change)
+    if changes:
+        firmware_index.invalidate(db)
+    db.commit()
+    return {'updated': len(landed), 'failed': len(expired), 'changes': changes}
+
+ota_rollouts = LeaderTask('ota_rollouts', 'OTA_ROLLOUT_INTERVAL', advance_rollouts)
+
+BACKGROUND_TASKS = (offline_sweeper, telemetry_rollup, ota_rollouts)
+
+@app.before_request
+def start_background_tasks():
+    # started lazily so every gunicorn worker (post-fork) gets its own threads
+    for task in BACKGROUND_TASKS:
+        task.ensure_started()
+
+# ---- Delta OTA ----
+# Patch format (little-endian):
+#   b'PDLT' | u8 format=1 | u32 target size | 32 B source sha256 | 32 B target sha256
+#   then ops: 0x01 COPY u32 source offset, u32 length | 0x02 DATA u32 length, bytes
+DELTA_MAGIC = b'PDLT'
+DELTA_BLOCK = 32
+DELTA_COPY, DELTA_DATA = 1, 2
+
+def make_delta(source, target):
+    """Binary patch turning `source` into `target` (block-hash matching, greedy extension)."""
+    index = {}
+    for off in range(0, len(source) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(source[off:off + DELTA_BLOCK], off)
+
+    out = bytearray(DELTA_MAGIC)
+    out += struct.pack('<BI', 1, len(target))
+    out += hashlib.sha256(source).digest() + hashlib.sha256(target).digest()
+
+    def emit_data(start, end):
+        if end > start:
+            out.extend(struct.pack('<BI', DELTA_DATA, end - start))
+            out.extend(target[start:end])
+
+    pos = literal = 0
+    limit = len(target) - DELTA_BLOCK
+    while pos <= limit:
+        src = index.get(target[pos:pos + DELTA_BLOCK])
+        if src is None:
+            pos += 1
+            continue
+        length = DELTA_BLOCK
+        while pos + length < len(target) and src + length < len(source) \
+                and target[pos + length] == source[src + length]:
+            length += 1
+        emit_data(literal, pos)
+        out.extend(struct.pack('<BII', DELTA_COPY, src, length))
+        pos += length
+        literal = pos
+    emit_data(literal, len(target))
+    return bytes(out)
+
+def apply_delta(source, patch):
+    if patch[:4] != DELTA_MAGIC:
+        raise ValueError('not a delta patch')
+    _, size = struct.unpack_from('<BI', patch, 4)
+    if hashlib.sha256(source).digest() != patch[9:41]:
+        raise ValueError('source mismatch')
+    out = bytearray()
+    pos = 73
+    while pos < len(patch):
+        op = patch[pos]
+        if op == DELTA_COPY:
+            src, length = struct.unpack_from('<II', patch, pos + 1)
+            out += source[src:src + length]
+            pos += 9
+        elif op == DELTA_DATA:
+            (length,) = struct.unpack_from('<I', patch, pos + 1)
+            out += patch[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        else:
+            raise ValueError('bad opcode')
+    if len(out) != size or hashlib.sha256(out).digest() != patch[41:73]:
+        raise ValueError('target mismatch')
+    return bytes(out)
+
+def incoming_folder():
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')
+
+def publish_firmware(db, version, description, tmp_path, file_size, sha256):
+    """Insert the release and atomically move `tmp_path` to `{version}.bin`.
+
+    The rename happens only after the INSERT succeeded (a duplicate version raises
+    sqlite3.IntegrityError before touching the published file) and before the commit,
+    so a failed rename leaves no row behind. Readers of an older file keep their inode.
+    """
+    filename = secure_filename(f"{version}.bin")
+    cur = db.execute('''
+        INSERT INTO firmwares (version, filename, description, file_size, sha256)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (version, filename, description, file_size, sha256))
+    try:
+        os.replace(tmp_path, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    except OSError:
+        db.rollback()
+        raise
+    publish_event(db, 'release', {'id': cur.lastrowid, 'version': version, 'action': 'uploaded'})
+    firmware_index.invalidate(db)
+    db.commit()
+    schedule_delta_build(version)
+    return cur.lastrowid, filename
+
+def delta_folder():
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'deltas')
+
+def build_deltas(version):
+    """Build patches from the latest stable releases to `version` (runs in a background thread)."""
+    with app.app_context():
+        db = get_db()
+        target = db.execute('SELECT version, filename FROM firmwares WHERE version = ?', (version,)).fetchone()
+        if not target:
+            return
+        bases = db.execute('''
+            SELECT version, filename FROM firmwares
+            WHERE is_stable = 1 AND version != ?
+            ORDER BY uploaded_at DESC
+            LIMIT ?
+        ''', (version, app.config['DELTA_BASE_COUNT'])).fetchall()
+        os.makedirs(delta_folder(), exist_ok=True)
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], target['filename']), 'rb') as fh:
+            new = fh.read()
+        for base in bases:
+            exists = db.execute('''
+                SELECT id FROM firmware_deltas WHERE from_version = ? AND to_version = ?
+            ''', (base['version'], version)).fetchone()
+            base_path = os.path.join(app.config['UPLOAD_FOLDER'], base['filename'])
+            if exists or not os.path.exists(base_path):
+                continue
+            with open(base_path, 'rb') as fh:
+                old = fh.read()
+            patch = make_delta(old, new)
+            if len(patch) > len(new) * app.config['DELTA_MAX_RATIO'] or apply_delta(old, patch) != new:
+                continue
+            filename = secure_filename(f"{base['version']}_to_{version}.delta")
+            with open(os.path.join(delta_folder(), filename), 'wb') as fh:
+                fh.write(patch)
+            db.execute('''
+                INSERT OR IGNORE INTO firmware_deltas (from_version, to_version, filename, file_size, sha256)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (base['version'], version, filename, len(patch), hashlib.sha256(patch).hexdigest()))
+            firmware_index.invalidate(db)
+            db.commit()
+            app.logger.info('Delta %s -> %s: %d bytes (%.0f%% of full image)',
+                            base['version'], version, len(patch), 100.0 * len(patch) / max(len(new), 1))
+
+def schedule_delta_build(version):
+    def run():
+        try:
+            build_deltas(version)
+        except Exception:
+            app.logger.exception('Delta build for %s failed', version)
+    threading.Thread(target=run, name=f'delta-{version}', daemon=True).start()
+
+INDEXES = (
+    # pending-command lookup on heartbeat / command poll
+    "CREATE INDEX IF NOT EXISTS idx_device_commands_pending ON device_commands (device_id, requested_at) WHERE status = 'pending'",
+    "CREATE INDEX IF NOT EXISTS idx_device_commands_device ON device_commands (device_id)",
+    # fan-out campaign counts
+    "CREATE INDEX IF NOT EXISTS idx_device_commands_campaign ON device_commands (campaign_id, status) "
+    "WHERE campaign_id IS NOT NULL",
+    # alarms list (ORDER BY created_at DESC LIMIT ?), 24 h count, per-device delete
+    "CREATE INDEX IF NOT EXISTS idx_alarms_created_at ON alarms (created_at)",
+    # alarms list filtered by device / severity, newest first
+    "CREATE INDEX IF NOT EXISTS idx_alarms_device_created_at ON alarms (device_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_alarms_severity_created_at ON alarms (severity, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_logs_device_id ON logs (device_id)",
+    # retention.py purges, oldest first
+    "CREATE INDEX IF NOT EXISTS idx_logs_created_at ON logs (created_at)",
+    # devices list (ORDER BY last_seen DESC) and online count
+    "CREATE INDEX IF NOT EXISTS idx_devices_last_seen ON devices (last_seen)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_status_last_seen ON devices (status, last_seen)",
+    # one device per MAC whatever its case; device auth looks MACs up with it (DEVICE_BY_MAC_SQL)
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_devices_mac_nocase ON devices (mac_address COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS idx_firmware_deltas_to ON firmware_deltas (to_version)",
+    "CREATE INDEX IF NOT EXISTS idx_firmware_uploads_created_at ON firmware_uploads (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_events_created_at ON events (created_at)",
+    # telemetry range reads, rollup backlog, retention
+    "CREATE INDEX IF NOT EXISTS idx_telemetry_device ON telemetry_blocks (device_id, resolution, block_start)",
+    "CREATE INDEX IF NOT EXISTS idx_telemetry_unrolled ON telemetry_blocks (id) WHERE resolution = 0 AND rolled = 0",
+    "CREATE INDEX IF NOT EXISTS idx_telemetry_expiry ON telemetry_blocks (resolution, block_start)",
+    # releases list and latest stable firmware
+    "CREATE INDEX IF NOT EXISTS idx_firmwares_uploaded_at ON firmwares (uploaded_at)",
+    "CREATE INDEX IF NOT EXISTS idx_firmwares_stable ON firmwares (uploaded_at) WHERE is_stable = 1",
+    # open rollout lookup on check_update, slots in flight (total and per rollout)
+    "CREATE INDEX IF NOT EXISTS idx_rollouts_status ON rollouts (status)",
+    "CREATE INDEX IF NOT EXISTS idx_download_slots_expires ON download_slots (expires_at)",
+    "CREATE INDEX IF NOT EXISTS idx_download_slots_rollout ON download_slots (rollout_id, expires_at)",
+)
+
+def create_indexes(db):
+    for sql in INDEXES:
+        try:
+            db.execute(sql)
+        except sqlite3.IntegrityError:
+            # a UNIQUE index the existing rows break (one MAC stored in two spellings)
+            app.logger.warning('Index not created, existing rows violate it: %s', sql)
+
+# Dashboard counters kept by triggers in the same transaction as the change: fleet_counters
+# holds totals, alarm_buckets the alarm count per minute (epoch // 60) for the last
+# ALARM_BUCKET_DAYS days. Deleting an alarm only touches a bucket that still exists.
+ALARM_BUCKET_DAYS = 8
+
+COUNTER_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS trg_devices_count_insert AFTER INSERT ON devices BEGIN
+        UPDATE fleet_counters SET value = value + 1 WHERE name = 'devices';
+        UPDATE fleet_counters SET value = value + 1 WHERE name = 'devices_online' AND NEW.status IS 'online';
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_devices_count_delete AFTER DELETE ON devices BEGIN
+        UPDATE fleet_counters SET value = value - 1 WHERE name = 'devices';
+        UPDATE fleet_counters SET value = value - 1 WHERE name = 'devices_online' AND OLD.status IS 'online';
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_devices_count_status AFTER UPDATE OF status ON devices
+    WHEN (OLD.status IS 'online') != (NEW.status IS 'online') BEGIN
+        UPDATE fleet_counters SET value = value + (CASE WHEN NEW.status IS 'online' THEN 1 ELSE -1 END)
+        WHERE name = 'devices_online';
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_firmwares_count_insert AFTER INSERT ON firmwares BEGIN
+        UPDATE fleet_counters SET value = value + 1 WHERE name = 'firmwares';
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_firmwares_count_delete AFTER DELETE ON firmwares BEGIN
+        UPDATE fleet_counters SET value = value - 1 WHERE name = 'firmwares';
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_alarms_count_insert AFTER INSERT ON alarms BEGIN
+        UPDATE fleet_counters SET value = value + 1 WHERE name = 'alarms';
+        INSERT INTO alarm_buckets (bucket, count)
+        SELECT bucket, 1 FROM (SELECT CAST(strftime('%s', NEW.created_at) AS INTEGER) / 60 AS bucket)
+        WHERE bucket >= CAST(strftime('%s', 'now') AS INTEGER) / 60 - {ALARM_BUCKET_DAYS * 1440}
+        ON CONFLICT (bucket) DO UPDATE SET count = count + 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_alarms_count_delete AFTER DELETE ON alarms BEGIN
+        UPDATE fleet_counters SET value = value - 1 WHERE name = 'alarms';
+        UPDATE alarm_buckets SET count = count - 1
+        WHERE bucket = CAST(strftime('%s', OLD.created_at) AS INTEGER) / 60;
+    END''',
+    # a new minute starts: drop the buckets that left the window
+    f'''CREATE TRIGGER IF NOT EXISTS trg_alarm_buckets_prune AFTER INSERT ON alarm_buckets BEGIN
+        DELETE FROM alarm_buckets
+        WHERE bucket < CAST(strftime('%s', 'now') AS INTEGER) / 60 - {ALARM_BUCKET_DAYS * 1440};
+    END''',
+)
+
+def rebuild_fleet_counters(db):
+    """Recount fleet_counters / alarm_buckets from the tables (startup, or after manual edits)."""
+    db.execute('DELETE FROM fleet_counters')
+    db.execute('''
+        INSERT INTO fleet_counters (name, value)
+        SELECT 'devices', COUNT(*) FROM devices
+        UNION ALL SELECT 'devices_online', COUNT(*) FROM devices WHERE status = 'online'
+        UNION ALL SELECT 'firmwares', COUNT(*) FROM firmwares
+        UNION ALL SELECT 'alarms', COUNT(*) FROM alarms
+    ''')
+    db.execute('DELETE FROM alarm_buckets')
+    db.execute('''
+        INSERT INTO alarm_buckets (bucket, count)
+        SELECT CAST(strftime('%s', created_at) AS INTEGER) / 60, COUNT(*)
+        FROM alarms
+        WHERE created_at >= datetime('now', ?)
+        GROUP BY 1
+    ''', (f'-{ALARM_BUCKET_DAYS} days',))
+
 def init_db():
     with app.app_context():
         db = get_db()
@@ -131,12 +2157,23 @@ def init_db():
         ''')
         
 
+        # Shared version counters (cross-worker cache invalidation)
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS app_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
         # ---- Schema migrations (safe to run multiple times) ----
         ensure_column(db, 'devices', 'api_key', "TEXT")
         ensure_column(db, 'devices', 'admin_state', "TEXT DEFAULT 'active'")
         ensure_column(db, 'devices', 'ota_enabled', "INTEGER DEFAULT 0")
         ensure_column(db, 'devices', 'ota_target_version', "TEXT")
         ensure_column(db, 'firmwares', 'is_stable', "INTEGER DEFAULT 0")
+        ensure_column(db, 'firmwares', 'sha256', "TEXT")
+        ensure_column(db, 'alarms', 'occurrences', "INTEGER DEFAULT 1")
+        ensure_column(db, 'alarms', 'last_seen', "TIMESTAMP")
 
         db.execute('''
             CREATE TABLE IF NOT EXISTS device_commands (
@@ -151,6 +2188,139 @@ def init_db():
                 FOREIGN KEY (device_id) REFERENCES devices (id)
             )
         ''')
+        ensure_column(db, 'device_commands', 'campaign_id', "INTEGER")
+
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS command_campaigns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                command TEXT NOT NULL,
+                payload TEXT,
+                selector TEXT,
+                targets INTEGER NOT NULL DEFAULT 0,
+                created_by TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS rollouts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                version TEXT NOT NULL,
+                waves TEXT NOT NULL,
+                wave INTEGER NOT NULL DEFAULT 0,
+                wave_minutes REAL NOT NULL,
+                max_failure_rate REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'active',
+                reason TEXT,
+                updated INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                wave_updated INTEGER NOT NULL DEFAULT 0,
+                wave_failed INTEGER NOT NULL DEFAULT 0,
+                created_by TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                wave_started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS download_slots (
+                device_id INTEGER PRIMARY KEY,
+                token TEXT NOT NULL UNIQUE,
+                version TEXT NOT NULL,
+                rollout_id INTEGER,
+                issued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP NOT NULL
+            )
+        ''')
+
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS firmware_deltas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_version TEXT NOT NULL,
+                to_version TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                file_size INTEGER,
+                sha256 TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (from_version, to_version)
+            )
+        ''')
+
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS firmware_uploads (
+                id TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                description TEXT,
+                total_size INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Outbox for the dashboard live feed (pruned after EVENTS_RETENTION_MINUTES)
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Heartbeat history, encoded per device and time span (see encode_series)
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS telemetry_blocks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                resolution INTEGER NOT NULL,
+                block_start INTEGER NOT NULL,
+                block_end INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                rolled INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Leader election for background jobs (one row per job)
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_run_at TIMESTAMP,
+                last_run_ms REAL,
+                last_result TEXT
+            )
+        ''')
+
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS fleet_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS alarm_buckets (
+                bucket INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Indexes for the hot queries (heartbeat command lookup, lists, dashboard counts)
+        create_indexes(db)
+        db.execute('DROP INDEX IF EXISTS idx_alarms_device_id')  # covered by idx_alarms_device_created_at
+
+        for sql in COUNTER_TRIGGERS:
+            db.execute(sql)
+        rebuild_fleet_counters(db)
+
+        # Hash firmwares uploaded before sha256 was stored
+        for row in db.execute("SELECT id, filename FROM firmwares WHERE sha256 IS NULL").fetchall():
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], row['filename'])
+            if os.path.exists(filepath):
+                db.execute("UPDATE firmwares SET sha256 = ?, file_size = ? WHERE id = ?",
+                           (file_sha256(filepath), os.path.getsize(filepath), row['id']))
 
         # Ensure existing devices have API keys
         devices_without_key = db.execute("SELECT id FROM devices WHERE api_key IS NULL OR api_key = ''").fetchall()
@@ -165,7 +2335,6 @@ def init_db():
                       ('admin', hashed_password))
         
         db.commit()
-        db.close()
 
 def login_required(f):
     @wraps(f)
@@ -189,7 +2358,6 @@ def login():
         
         db = get_db()
         user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        db.close()
         
         if user and check_password_hash(user['password'], password):
             session['user_id'] = user['id']
@@ -226,35 +2394,173 @@ def alarms():
 def dashboard_stats():
     db = get_db()
     
-    total_devices = db.execute('SELECT COUNT(*) as count FROM devices').fetchone()['count']
-    online_devices = db.execute('SELECT COUNT(*) as count FROM devices WHERE status = "online"').fetchone()['count']
-    total_releases = db.execute('SELECT COUNT(*) as count FROM firmwares').fetchone()['count']
-    recent_alarms = db.execute('SELECT COUNT(*) as count FROM alarms WHERE created_at > datetime("now", "-24 hours")').fetchone()['count']
-    
-    db.close()
+    # maintained by COUNTER_TRIGGERS: a handful of primary-key reads whatever the fleet size
+    counters = dict(db.execute('''
+        SELECT name, value FROM fleet_counters
+        WHERE name IN ('devices', 'devices_online', 'firmwares', 'alarms')
+    ''').fetchall())
+    minute = int(time.time()) // 60
+    windows = db.execute('''
+        SELECT COALESCE(SUM(CASE WHEN bucket > ? THEN count END), 0) AS last_24h,
+               COALESCE(SUM(count), 0) AS last_7d
+        FROM alarm_buckets WHERE bucket > ?
+    ''', (minute - 1440, minute - 7 * 1440)).fetchone()
     
+    total_devices = counters.get('devices', 0)
+    online_devices = counters.get('devices_online', 0)
     return jsonify({
         'total_devices': total_devices,
         'online_devices': online_devices,
         'offline_devices': total_devices - online_devices,
-        'total_releases': total_releases,
-        'recent_alarms': recent_alarms
+        'total_releases': counters.get('firmwares', 0),
+        'recent_alarms': windows['last_24h'],
+        'alarms_7d': windows['last_7d'],
+        'total_alarms': counters.get('alarms', 0)
     })
 
+# ---- Paginated lists ----
+# Keyset pagination: `next_cursor` encodes the sort key of the last row, the next page
+# seeks past it on the index instead of counting an OFFSET.
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    # [sort key, id]: both end up as bound parameters
+    if (not isinstance(values, list) or len(values) != 2
+            or not isinstance(values[0], (str, int, type(None))) or isinstance(values[0], bool)
+            or not isinstance(values[1], int) or isinstance(values[1], bool)):
+        raise ValueError('Invalid cursor')
+    return values
+
+def list_args(columns, default_fields):
+    """(fields, limit, cursor) from ?fields=a,b&limit=N&cursor=... (ValueError on bad input)."""
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or list(default_fields)
+    unknown = [f for f in fields if f not in columns]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    limit = min(max(request.args.get('limit', 100, type=int), 1), app.config['LIST_PAGE_MAX'])
+    cursor = request.args.get('cursor')
+    return fields, limit, decode_cursor(cursor) if cursor else None
+
+def datetime_arg(name):
+    """?name= as epoch seconds or ISO 8601 (UTC) -> aware datetime, None when absent."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return parse_timestamp(float(value)) if re.fullmatch(r'\d+(\.\d+)?', value) else parse_timestamp(value)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f'Invalid {name}')
+
+def time_arg(name):
+    when = datetime_arg(name)
+    return when.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') if when else None
+
+DEVICE_LIST_COLUMNS = {
+    'id': 'id',
+    'mac_address': 'mac_address',
+    'device_name': 'device_name',
+    'ip_address': 'ip_address',
+    'ssid': 'ssid',
+    'firmware_version': 'firmware_version',
+    'last_seen': 'last_seen',
+    'status': 'status',
+    'uptime': 'uptime',
+    'free_heap': 'free_heap',
+    # the key itself is only in /api/devices/<id>
+    'api_key_hint': "CASE WHEN COALESCE(api_key, '') = '' THEN NULL "
+                    "ELSE substr(api_key, 1, 6) || '…' || substr(api_key, -4) END",
+    'admin_state': 'admin_state',
+    'ota_enabled': 'ota_enabled',
+    'ota_target_version': 'ota_target_version',
+    'created_at': 'created_at',
+}
+DEVICE_LIST_DEFAULT = [name for name in DEVICE_LIST_COLUMNS if name != 'created_at']
+
+def device_selector_sql(filters):
+    """WHERE terms and params for the devices matching `filters`.
+
+    status / admin_state / firmware_version are equality filters, ids a list of device ids
+    (or a comma-separated string, as in ?ids=1,2,3). Raises ValueError/TypeError on bad ids.
+    """
+    where, params = [], []
+    for name in ('status', 'admin_state', 'firmware_version'):
+        value = filters.get(name)
+        if value:
+            where.append(f'{name} = ?')
+            params.append(value)
+    ids = filters.get('ids')
+    if isinstance(ids, str):
+        ids = ids.split(',')
+    if ids:
+        where.append('id IN (SELECT value FROM json_each(?))')
+        params.append(json.dumps([int(i) for i in ids]))
+    return where, params
+
 @app.route('/api/devices/list')
 @login_required
 def devices_list():
+    """Devices by last_seen (newest first, never-seen last).
+
+    ?status= &admin_state= &firmware_version= filters, ?fields= projection,
+    ?limit= (max LIST_PAGE_MAX) and ?cursor= from the previous page's next_cursor.
+    """
+    try:
+        fields, limit, cursor = list_args(DEVICE_LIST_COLUMNS, DEVICE_LIST_DEFAULT)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+
+    select = ', '.join(f"{DEVICE_LIST_COLUMNS[f]} AS {f}" for f in fields)
+    select += ', last_seen AS _last_seen, id AS _id'
+    try:
+        where, params = device_selector_sql(request.args)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ids must be a list of device ids'}), 400
+
     db = get_db()
-    devices = db.execute('''
-        SELECT id, mac_address, device_name, ip_address, ssid,
-               firmware_version, last_seen, status, uptime, free_heap,
-               api_key, admin_state, ota_enabled, ota_target_version
-        FROM devices 
-        ORDER BY last_seen DESC
-    ''').fetchall()
-    db.close()
-    
-    return jsonify([dict(device) for device in devices])
+    rows = []
+    # devices that were seen, on the last_seen index...
+    if cursor is None or cursor[0] is not None:
+        cond, args = where + ['last_seen IS NOT NULL'], list(params)
+        if cursor:
+            cond.append('(last_seen, id) < (?, ?)')
+            args += cursor
+        rows = db.execute(f'''
+            SELECT {select} FROM devices WHERE {' AND '.join(cond)}
+            ORDER BY last_seen DESC, id DESC LIMIT ?
+        ''', args + [limit + 1]).fetchall()
+    # ...then the provisioned-but-never-seen ones
+    if len(rows) <= limit:
+        cond, args = where + ['last_seen IS NULL'], list(params)
+        if cursor and cursor[0] is None:
+            cond.append('id < ?')
+            args.append(cursor[1])
+        rows += db.execute(f'''
+            SELECT {select} FROM devices WHERE {' AND '.join(cond)}
+            ORDER BY id DESC LIMIT ?
+        ''', args + [limit + 1 - len(rows)]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['_last_seen'], rows[-1]['_id'])
+    return jsonify({'items': [{f: row[f] for f in fields} for row in rows], 'next_cursor': next_cursor})
+
+def device_fields(data):
+    """(device_name, firmware_version, admin_state, ota_enabled, ota_target_version) of a provisioning request."""
+    name = str(data.get('device_name') or '').strip()
+    firmware_version = str(data.get('firmware_version') or '').strip()
+    admin_state = str(data.get('admin_state') or 'active').strip().lower()
+    if admin_state not in ('active', 'suspended', 'blocked'):
+        admin_state = 'active'
+
+    ota_enabled = 1 if str(data.get('ota_enabled', 0)).lower() in ('1', 'true', 'yes', 'on') else 0
+    ota_target_version = str(data.get('ota_target_version') or '').strip() or None
+    return name, firmware_version, admin_state, ota_enabled, ota_target_version
 
 @app.route('/api/devices', methods=['POST'])
 @login_required
@@ -263,30 +2569,20 @@ def create_device():
     The ESP32 will NOT need to call /api/esp32/register; it can start sending heartbeat using (mac_address + api_key).
     """
     data = request.json or {}
-    mac = (data.get('mac_address') or '').strip().lower()
-    if not mac:
+    mac_clean = normalize_mac(data.get('mac_address'))
+    if not mac_clean:
         return jsonify({'error': 'mac_address required'}), 400
 
     # basic MAC sanity (allow ":" or "-")
-    mac_clean = mac.replace('-', ':')
-    if not re.match(r'^([0-9a-f]{2}:){5}[0-9a-f]{2}$', mac_clean):
+    if not MAC_RE.fullmatch(mac_clean):
         return jsonify({'error': 'Invalid MAC format. Use AA:BB:CC:DD:EE:FF'}), 400
 
-    name = (data.get('device_name') or '').strip()
-    firmware_version = (data.get('firmware_version') or '').strip()
-    admin_state = (data.get('admin_state') or 'active').strip().lower()
-    if admin_state not in ('active', 'suspended', 'blocked'):
-        admin_state = 'active'
-
-    ota_enabled = 1 if str(data.get('ota_enabled', 0)).lower() in ('1', 'true', 'yes', 'on') else 0
-    ota_target_version = (data.get('ota_target_version') or '').strip() or None
-
+    name, firmware_version, admin_state, ota_enabled, ota_target_version = device_fields(data)
     api_key = generate_api_key()
 
     db = get_db()
-    exists = db.execute('SELECT id FROM devices WHERE mac_address = ?', (mac_clean,)).fetchone()
+    exists = db.execute('SELECT id FROM devices WHERE mac_address = ? COLLATE NOCASE', (mac_clean,)).fetchone()
     if exists:
-        db.close()
         return jsonify({'error': 'Device already exists'}), 409
 
     db.execute('''
@@ -299,29 +2595,220 @@ def create_device():
 
     device_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
 
-    db.execute('''
+    cur = db.execute('''
         INSERT INTO alarms (device_id, alarm_type, message, severity)
         VALUES (?, 'device_provisioned', 'Pastillero provisionado desde el panel', 'info')
     ''', (device_id,))
+    publish_event(db, 'device_added', {'id': device_id, 'mac_address': mac_clean, 'status': 'offline'})
+    publish_alarm_events(db, cur.lastrowid)
 
     db.commit()
-    db.close()
 
     return jsonify({'success': True, 'device_id': device_id, 'api_key': api_key})
 
+def csv_response(header, rows, filename):
+    """Stream `rows` as a CSV download; nothing is cached since they may carry API keys."""
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if count % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    response = app.response_class(generate(), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def read_bulk_rows():
+    """[(line, fields, error)] of a CSV (header row) or JSONL upload, as `file` or the raw body.
+
+    The format comes from ?format=csv|jsonl, else the file extension / Content-Type.
+    """
+    upload = request.files.get('file')
+    raw = upload.read() if upload else request.get_data()
+    name = (upload.filename or '').lower() if upload else ''
+    mimetype = (upload.mimetype if upload else request.mimetype) or ''
+    fmt = request.args.get('format') or (
+        'jsonl' if name.endswith(('.jsonl', '.ndjson')) or 'json' in mimetype else 'csv')
+    text = raw.decode('utf-8-sig')
+
+    rows = []
+    if fmt == 'jsonl':
+        for line, chunk in enumerate(text.splitlines(), 1):
+            if not chunk.strip():
+                continue
+            try:
+                item = json.loads(chunk)
+            except ValueError:
+                rows.append((line, {}, 'invalid JSON'))
+                continue
+            rows.append((line, item, None) if isinstance(item, dict) else (line, {}, 'not a JSON object'))
+    elif fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(text))
+        if 'mac_address' not in (reader.fieldnames or ()):
+            raise ValueError('CSV header must include mac_address')
+        for item in reader:
+            rows.append((reader.line_num, item, None))
+    else:
+        raise ValueError('format must be csv or jsonl')
+    return rows
+
+@app.route('/api/devices/bulk', methods=['POST'])
+@login_required
+def bulk_create_devices():
+    """Provision a batch of pastilleros from a CSV or JSONL upload (same fields as POST /api/devices).
+
+    Every row gets a status: created, exists (MAC already registered), duplicate (repeats an
+    earlier row of the upload) or invalid. The created ones are inserted in one transaction and
+    the report comes back as a CSV with their API keys. ?dry_run=1 only validates (JSON report),
+    ?strict=1 inserts nothing unless every row can be created.
+    """
+    try:
+        rows = read_bulk_rows()
+    except (UnicodeDecodeError, csv.Error, ValueError) as exc:
+        return jsonify({'error': f'Unreadable upload: {exc}'}), 400
+    if not rows:
+        return jsonify({'error': 'No devices in upload'}), 400
+    if len(rows) > app.config['BULK_MAX_DEVICES']:
+        return jsonify({'error': f"At most {app.config['BULK_MAX_DEVICES']} devices per upload"}), 413
+
+    db = get_db()
+    macs = [normalize_mac(item.get('mac_address')) for _, item, _ in rows]
+    valid = {mac for mac in macs if MAC_RE.fullmatch(mac)}
+    # the MACs are normalized (lower case); stored ones may be in either case
+    existing = {row[0] for row in db.execute(
+        'SELECT lower(mac_address) FROM devices WHERE mac_address COLLATE NOCASE IN (SELECT value FROM json_each(?))',
+        (json.dumps(list(valid)),))}
+
+    report, new, first_line = [], [], {}
+    for (line, item, error), mac in zip(rows, macs):
+        if error is None and not mac:
+            error = 'mac_address required'
+        elif error is None and mac not in valid:
+            error = 'Invalid MAC format. Use AA:BB:CC:DD:EE:FF'
+        if error:
+            report.append((line, mac, 'invalid', None, None, error))
+        elif mac in existing:
+            report.append((line, mac, 'exists', None, None, 'Device already exists'))
+        elif mac in first_line:
+            report.append((line, mac, 'duplicate', None, None, f'Same MAC as line {first_line[mac]}'))
+        else:
+            first_line[mac] = line
+            new.append((line, mac, (mac,) + device_fields(item) + (generate_api_key(),)))
+
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes', 'on')
+    strict = request.args.get('strict', '').lower() in ('1', 'true', 'yes', 'on')
+    if dry_run or (strict and report):
+        rejected = [{'line': line, 'mac_address': mac, 'status': status, 'error': error}
+                    for line, mac, status, _, _, error in report]
+        return jsonify({'success': dry_run, 'valid': len(new), 'rejected': rejected}), 200 if dry_run else 409
+
+    if new:
+        try:
+            db.executemany('''
+                INSERT INTO devices (
+                    mac_address, device_name, firmware_version, admin_state, ota_enabled, ota_target_version,
+                    api_key, status, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, 'offline', CURRENT_TIMESTAMP)
+            ''', [params for _, _, params in new])
+        except sqlite3.IntegrityError:
+            db.rollback()
+            return jsonify({'error': 'A device of the upload was registered meanwhile, retry'}), 409
+        created = json.dumps([mac for _, mac, _ in new])
+        ids = dict(db.execute(
+            'SELECT mac_address, id FROM devices WHERE mac_address IN (SELECT value FROM json_each(?))',
+            (created,)).fetchall())
+        db.execute('''
+            INSERT INTO alarms (device_id, alarm_type, message, severity)
+            SELECT id, 'device_provisioned', 'Pastillero provisionado (importación masiva)', 'info'
+            FROM devices WHERE mac_address IN (SELECT value FROM json_each(?))
+        ''', (created,))
+        # one reload for open dashboards instead of an event per device
+        publish_event(db, 'resync', {'reason': 'devices_bulk', 'created': len(new)})
+        db.commit()
+        report += [(line, mac, 'created', ids[mac], params[-1], None) for line, mac, params in new]
+
+    report.sort(key=lambda row: row[0])
+    return csv_response(('line', 'mac_address', 'status', 'device_id', 'api_key', 'error'),
+                        report, 'pilly-devices.csv')
+
 
 @app.route('/api/devices/<int:device_id>')
 @login_required
 def device_detail(device_id):
     db = get_db()
     device = db.execute('SELECT * FROM devices WHERE id = ?', (device_id,)).fetchone()
-    db.close()
     
     if device:
         return jsonify(dict(device))
     return jsonify({'error': 'Device not found'}), 404
 
 
+@app.route('/api/devices/<int:device_id>/telemetry')
+@login_required
+def device_telemetry(device_id):
+    """Uptime / free heap history: ?from= &to= (epoch or ISO 8601, default last 24 h), ?step= seconds.
+
+    step < 60 returns the raw heartbeat samples; otherwise points aggregated per step
+    from the 1-minute (or, for whole hours, 1-hour) rollups.
+    """
+    try:
+        until = datetime_arg('to') or datetime.now(timezone.utc)
+        since = datetime_arg('from') or until - timedelta(hours=24)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    start, end = int(since.timestamp()), int(until.timestamp())
+    span = end - start
+    if span <= 0:
+        return jsonify({'error': 'from must be before to'}), 400
+    max_points = app.config['TELEMETRY_MAX_POINTS']
+    step = max(60, -(-span // 500))  # about 500 points
+    if request.args.get('step'):
+        try:
+            step = int(request.args['step'])
+        except ValueError:
+            step = 0
+    if step <= 0:
+        return jsonify({'error': 'step must be a positive number of seconds'}), 400
+    if step >= 60:
+        step -= step % 60
+    if step >= 60 and span // step > max_points:
+        return jsonify({'error': f'Too many points, use a step of at least {-(-span // max_points)} s'}), 400
+
+    resolution = 0 if step < 60 else (3600 if step % 3600 == 0 else 60)
+    # blocks starting before `start` may still overlap it
+    lookback = {0: 2 * app.config['TELEMETRY_BLOCK_SECONDS'], 60: 3600, 3600: 86400}[resolution]
+    db = get_db()
+    blocks = db.execute('''
+        SELECT data FROM telemetry_blocks
+        WHERE device_id = ? AND resolution = ? AND block_start >= ? AND block_start < ? AND block_end >= ?
+        ORDER BY block_start
+    ''', (device_id, resolution, start - lookback, end, start)).fetchall()
+
+    if resolution == 0:
+        samples = sorted((ts, uptime, heap) for block in blocks
+                         for ts, uptime, heap in zip(*decode_series(block['data'])) if start <= ts < end)
+        if len(samples) > max_points:
+            return jsonify({'error': 'Too many samples, use step >= 60'}), 400
+        points = [{'t': ts, 'uptime': uptime, 'free_heap': heap} for ts, uptime, heap in samples]
+    else:
+        buckets = {}
+        for block in blocks:
+            for ts, agg in rollup_buckets(block['data']).items():
+                if start <= ts < end:
+                    merge_bucket(buckets, ts - ts % step, *agg)
+        points = [{'t': ts, 'count': agg[0], 'free_heap_min': agg[1], 'free_heap_max': agg[2],
+                   'free_heap_avg': round(agg[3] / agg[0]), 'uptime_max': agg[4], 'reboots': agg[5]}
+                  for ts, agg in sorted(buckets.items())]
+    return jsonify({'device_id': device_id, 'from': start, 'to': end, 'step': step,
+                    'resolution': resolution, 'points': points})
+
 @app.route('/api/devices/<int:device_id>/set_state', methods=['POST'])
 @login_required
 def set_device_state(device_id):
@@ -331,31 +2818,61 @@ def set_device_state(device_id):
         return jsonify({'error': 'Invalid state'}), 400
 
     db = get_db()
-    device = db.execute('SELECT id FROM devices WHERE id = ?', (device_id,)).fetchone()
+    device = db.execute('SELECT id, mac_address, status FROM devices WHERE id = ?', (device_id,)).fetchone()
     if not device:
-        db.close()
         return jsonify({'error': 'Device not found'}), 404
 
     status = 'offline' if state == 'active' else state
     db.execute('UPDATE devices SET admin_state = ?, status = ? WHERE id = ?', (state, status, device_id))
+    device_cache.invalidate(db, device['mac_address'])
+    if device['status'] != status:
+        publish_event(db, 'device_status', {'id': device_id, 'mac_address': device['mac_address'],
+                                            'status': status, 'previous': device['status']})
     db.commit()
-    db.close()
     return jsonify({'success': True, 'state': state})
 
 @app.route('/api/devices/<int:device_id>/rotate_key', methods=['POST'])
 @login_required
 def rotate_device_key(device_id):
     db = get_db()
-    device = db.execute('SELECT id FROM devices WHERE id = ?', (device_id,)).fetchone()
-    if not device:
-        db.close()
-        return jsonify({'error': 'Device not found'}), 404
+    device = db.execute('SELECT id, mac_address FROM devices WHERE id = ?', (device_id,)).fetchone()
+    if not device:
+        return jsonify({'error': 'Device not found'}), 404
+
+    new_key = generate_api_key()
+    db.execute('UPDATE devices SET api_key = ? WHERE id = ?', (new_key, device_id))
+    device_cache.invalidate(db, device['mac_address'])
+    db.commit()
+    return jsonify({'success': True, 'api_key': new_key})
+
+@app.route('/api/devices/rotate_keys', methods=['POST'])
+@login_required
+def rotate_device_keys():
+    """New API key for every device matching the filter.
+
+    JSON body: status / admin_state / firmware_version / ids, or {"all": true} for the whole
+    fleet. Returns a CSV of id, mac_address, api_key.
+    """
+    data = request.json or {}
+    try:
+        where, params = device_selector_sql(data)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ids must be a list of device ids'}), 400
+    if not where and data.get('all') is not True:
+        return jsonify({'error': 'Give a filter (status, admin_state, firmware_version, ids) or "all": true'}), 400
+
+    db = get_db()
+    devices = db.execute(f'''
+        SELECT id, mac_address FROM devices {'WHERE ' + ' AND '.join(where) if where else ''}
+    ''', params).fetchall()
+    if not devices:
+        return jsonify({'error': 'No devices match'}), 404
 
-    new_key = generate_api_key()
-    db.execute('UPDATE devices SET api_key = ? WHERE id = ?', (new_key, device_id))
+    keys = sorted((row['id'], row['mac_address'], generate_api_key()) for row in devices)
+    db.executemany('UPDATE devices SET api_key = ? WHERE id = ?', [(key, device_id) for device_id, _, key in keys])
+    device_cache.invalidate(db)
     db.commit()
-    db.close()
-    return jsonify({'success': True, 'api_key': new_key})
+    return csv_response(('id', 'mac_address', 'api_key'), keys, 'pilly-keys.csv')
 
 @app.route('/api/devices/<int:device_id>/ota', methods=['POST'])
 @login_required
@@ -365,9 +2882,8 @@ def set_device_ota(device_id):
     ota_target_version = data.get('ota_target_version', None)
 
     db = get_db()
-    device = db.execute('SELECT id FROM devices WHERE id = ?', (device_id,)).fetchone()
+    device = db.execute('SELECT id, mac_address FROM devices WHERE id = ?', (device_id,)).fetchone()
     if not device:
-        db.close()
         return jsonify({'error': 'Device not found'}), 404
 
     if ota_enabled is not None:
@@ -379,8 +2895,8 @@ def set_device_ota(device_id):
         else:
             db.execute('UPDATE devices SET ota_target_version = ? WHERE id = ?', (ver, device_id))
 
+    device_cache.invalidate(db, device['mac_address'])
     db.commit()
-    db.close()
     return jsonify({'success': True})
 
 @app.route('/api/devices/<int:device_id>/command', methods=['POST'])
@@ -388,7 +2904,7 @@ def set_device_ota(device_id):
 def queue_device_command(device_id):
     data = request.json or {}
     command = (data.get('command') or '').strip().lower()
-    if command not in ['restart']:
+    if command not in SUPPORTED_COMMANDS:
         return jsonify({'error': 'Unsupported command'}), 400
 
     payload = data.get('payload')
@@ -397,13 +2913,14 @@ def queue_device_command(device_id):
     db = get_db()
     device = db.execute('SELECT id FROM devices WHERE id = ?', (device_id,)).fetchone()
     if not device:
-        db.close()
         return jsonify({'error': 'Device not found'}), 404
 
-    db.execute('''
+    cur = db.execute('''
         INSERT INTO device_commands (device_id, command, payload, status)
         VALUES (?, ?, ?, 'pending')
     ''', (device_id, command, payload_json))
+    publish_event(db, 'command', {'id': cur.lastrowid, 'device_id': device_id,
+                                  'command': command, 'status': 'pending'})
 
     db.execute('''
         INSERT INTO logs (device_id, log_type, message)
@@ -411,19 +2928,110 @@ def queue_device_command(device_id):
     ''', (device_id, f'Queued command: {command}'))
 
     db.commit()
-    db.close()
+    command_waiters.wake(device_id)
     return jsonify({'success': True})
 
+CAMPAIGN_LOGS_SQL = '''
+    INSERT INTO logs (device_id, log_type, message)
+    SELECT device_id, 'command', ? FROM device_commands WHERE campaign_id = ?
+'''
+
+# A single `command` event for the whole campaign; CommandWaiters wakes every listed device
+CAMPAIGN_EVENT_SQL = '''
+    INSERT INTO events (kind, data)
+    SELECT 'command', json_object('campaign_id', c.id, 'command', c.command, 'status', 'pending',
+                                  'targets', c.targets,
+                                  'device_ids', json((SELECT json_group_array(device_id) FROM device_commands
+                                                      WHERE campaign_id = c.id)))
+    FROM command_campaigns c WHERE c.id = ?
+'''
+
+CAMPAIGN_COUNTS_SQL = '''
+    SELECT status, COUNT(*) FROM device_commands WHERE campaign_id = ? GROUP BY status
+'''
+
+def campaign_summary(db, campaign_id):
+    """Campaign row with its delivery counts (pending / sent / acked), or None."""
+    row = db.execute('SELECT * FROM command_campaigns WHERE id = ?', (campaign_id,)).fetchone()
+    if not row:
+        return None
+    campaign = dict(row)
+    campaign['payload'] = json.loads(row['payload']) if row['payload'] else None
+    campaign['selector'] = json.loads(row['selector'] or '{}')
+    campaign['counts'] = {'pending': 0, 'sent': 0, 'acked': 0}
+    campaign['counts'].update(db.execute(CAMPAIGN_COUNTS_SQL, (campaign_id,)).fetchall())
+    return campaign
+
+@app.route('/api/commands/fanout', methods=['POST'])
+@login_required
+def fanout_command():
+    """Queue a command for every device matching a selector, as one campaign.
+
+    JSON body: command, payload, and status / admin_state / firmware_version / ids
+    (or "all": true). Returns the campaign with its pending / sent / acked counts;
+    follow it on GET /api/commands/campaigns/<id>.
+    """
+    data = request.json or {}
+    command = (data.get('command') or '').strip().lower()
+    if command not in SUPPORTED_COMMANDS:
+        return jsonify({'error': 'Unsupported command'}), 400
+
+    selector = {name: data[name] for name in ('status', 'admin_state', 'firmware_version', 'ids') if data.get(name)}
+    try:
+        where, params = device_selector_sql(selector)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ids must be a list of device ids'}), 400
+    if not where and data.get('all') is not True:
+        return jsonify({'error': 'Give a selector (status, admin_state, firmware_version, ids) or "all": true'}), 400
+
+    payload = data.get('payload')
+    payload_json = json.dumps(payload) if payload is not None else None
+
+    db = get_db()
+    campaign_id = db.execute('''
+        INSERT INTO command_campaigns (command, payload, selector, created_by) VALUES (?, ?, ?, ?)
+    ''', (command, payload_json, json.dumps(selector or {'all': True}), session.get('username'))).lastrowid
+    targets = db.execute(f'''
+        INSERT INTO device_commands (device_id, command, payload, status, campaign_id)
+        SELECT id, ?, ?, 'pending', ? FROM devices {'WHERE ' + ' AND '.join(where) if where else ''}
+    ''', [command, payload_json, campaign_id] + params).rowcount
+    if not targets:
+        db.rollback()
+        return jsonify({'error': 'No devices match'}), 404
+
+    db.execute('UPDATE command_campaigns SET targets = ? WHERE id = ?', (targets, campaign_id))
+    db.execute(CAMPAIGN_LOGS_SQL, (f'Queued command: {command} (campaign #{campaign_id})', campaign_id))
+    db.execute(CAMPAIGN_EVENT_SQL, (campaign_id,))
+    g.events_published = True
+    db.commit()
+    return jsonify({'success': True, 'campaign': campaign_summary(db, campaign_id)})
+
+@app.route('/api/commands/campaigns')
+@login_required
+def campaigns_list():
+    """Latest fan-out campaigns (?limit=, default 20) with their delivery counts."""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), app.config['LIST_PAGE_MAX'])
+    db = get_db()
+    ids = [row['id'] for row in db.execute('SELECT id FROM command_campaigns ORDER BY id DESC LIMIT ?', (limit,))]
+    return jsonify({'items': [campaign_summary(db, campaign_id) for campaign_id in ids]})
+
+@app.route('/api/commands/campaigns/<int:campaign_id>')
+@login_required
+def campaign_detail(campaign_id):
+    campaign = campaign_summary(get_db(), campaign_id)
+    if not campaign:
+        return jsonify({'error': 'Campaign not found'}), 404
+    return jsonify(campaign)
+
 @app.route('/api/releases/list')
 @login_required
 def releases_list():
     db = get_db()
     firmwares = db.execute('''
-        SELECT id, version, filename, description, file_size, uploaded_at
+        SELECT id, version, filename, description, file_size, sha256, is_stable, uploaded_at
         FROM firmwares 
         ORDER BY uploaded_at DESC
     ''').fetchall()
-    db.close()
     
     return jsonify([dict(firmware) for firmware in firmwares])
 
@@ -444,35 +3052,184 @@ def upload_release():
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(f"{version}.bin")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        file_size = os.path.getsize(filepath)
+        # the body was spooled and hashed while the form was parsed (PillyRequest)
+        spool = file.stream
+        os.fsync(spool.fileno())
         
         db = get_db()
         try:
-            db.execute('''
-                INSERT INTO firmwares (version, filename, description, file_size)
-                VALUES (?, ?, ?, ?)
-            ''', (version, filename, description, file_size))
-            db.commit()
-            firmware_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
-            db.close()
-            
-            return jsonify({
-                'success': True,
-                'id': firmware_id,
-                'version': version,
-                'filename': filename
-            })
+            firmware_id, filename = publish_firmware(db, version, description, spool.path,
+                                                     spool.size, spool.sha256.hexdigest())
         except sqlite3.IntegrityError:
-            db.close()
-            os.remove(filepath)
             return jsonify({'error': 'Version already exists'}), 400
+        
+        return jsonify({
+            'success': True,
+            'id': firmware_id,
+            'version': version,
+            'filename': filename,
+            'size': spool.size,
+            'sha256': spool.sha256.hexdigest()
+        })
     
     return jsonify({'error': 'Invalid file type'}), 400
 
+# ---- Chunked / resumable uploads ----
+# POST /api/releases/uploads {version, description, size} -> upload_id
+# PUT  /api/releases/uploads/<id> with Content-Range: bytes start-end/size, raw body
+# GET  /api/releases/uploads/<id> -> current offset (resume point)
+# POST /api/releases/uploads/<id>/complete -> publish
+_upload_hashers = {}
+_upload_hashers_lock = threading.Lock()
+
+def upload_part_path(upload_id):
+    return os.path.join(incoming_folder(), f"{upload_id}.upload")
+
+def get_upload_session(db, upload_id):
+    return db.execute('SELECT * FROM firmware_uploads WHERE id = ?', (upload_id,)).fetchone()
+
+def drop_upload_session(db, upload_id):
+    db.execute('DELETE FROM firmware_uploads WHERE id = ?', (upload_id,))
+    with _upload_hashers_lock:
+        _upload_hashers.pop(upload_id, None)
+    part = upload_part_path(upload_id)
+    if os.path.exists(part):
+        os.remove(part)
+
+@app.route('/api/releases/uploads', methods=['POST'])
+@login_required
+def start_release_upload():
+    data = request.json or {}
+    version = (data.get('version') or '').strip()
+    description = data.get('description', '')
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        size = 0
+    if not version:
+        return jsonify({'error': 'Version is required'}), 400
+    if not allowed_file(data.get('filename') or f"{version}.bin"):
+        return jsonify({'error': 'Invalid file type'}), 400
+    if size <= 0 or size > app.config['FIRMWARE_MAX_SIZE']:
+        return jsonify({'error': 'Invalid size'}), 400
+
+    db = get_db()
+    if db.execute('SELECT id FROM firmwares WHERE version = ?', (version,)).fetchone():
+        return jsonify({'error': 'Version already exists'}), 400
+
+    stale = db.execute('''
+        SELECT id FROM firmware_uploads WHERE created_at < datetime('now', ?)
+    ''', (f"-{app.config['UPLOAD_SESSION_TTL_HOURS']} hours",)).fetchall()
+    for row in stale:
+        drop_upload_session(db, row['id'])
+
+    upload_id = secrets.token_hex(16)
+    os.makedirs(incoming_folder(), exist_ok=True)
+    open(upload_part_path(upload_id), 'wb').close()
+    db.execute('''
+        INSERT INTO firmware_uploads (id, version, description, total_size) VALUES (?, ?, ?, ?)
+    ''', (upload_id, version, description, size))
+    db.commit()
+    with _upload_hashers_lock:
+        _upload_hashers[upload_id] = (0, hashlib.sha256())
+    return jsonify({'upload_id': upload_id, 'offset': 0, 'chunk_size': app.config['UPLOAD_CHUNK_SIZE']})
+
+@app.route('/api/releases/uploads/<upload_id>', methods=['GET'])
+@login_required
+def release_upload_status(upload_id):
+    upload = get_upload_session(get_db(), upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'upload_id': upload_id, 'offset': os.path.getsize(upload_part_path(upload_id)),
+                    'size': upload['total_size']})
+
+@app.route('/api/releases/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_release_chunk(upload_id):
+    upload = get_upload_session(get_db(), upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    crange = parse_content_range_header(request.headers.get('Content-Range'))
+    if crange is None or crange.length != upload['total_size'] \
+            or crange.stop - crange.start != (request.content_length or 0):
+        return jsonify({'error': 'Invalid Content-Range'}), 400
+
+    with open(upload_part_path(upload_id), 'ab') as part:
+        if fcntl:
+            fcntl.flock(part, fcntl.LOCK_EX)
+        offset = part.seek(0, os.SEEK_END)
+        if crange.start != offset:
+            return jsonify({'error': 'Offset mismatch', 'offset': offset}), 409
+
+        with _upload_hashers_lock:
+            state = _upload_hashers.pop(upload_id, None)
+        hasher = state[1] if state and state[0] == offset else None
+        while True:
+            chunk = request.stream.read(64 * 1024)
+            if not chunk:
+                break
+            part.write(chunk)
+            if hasher:
+                hasher.update(chunk)
+        part.flush()
+        offset = part.tell()
+        if hasher:
+            with _upload_hashers_lock:
+                _upload_hashers[upload_id] = (offset, hasher)
+
+    return jsonify({'upload_id': upload_id, 'offset': offset, 'size': upload['total_size']})
+
+@app.route('/api/releases/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_release_upload(upload_id):
+    db = get_db()
+    upload = get_upload_session(db, upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    part = upload_part_path(upload_id)
+    size = os.path.getsize(part)
+    if size != upload['total_size']:
+        return jsonify({'error': 'Upload incomplete', 'offset': size}), 409
+
+    with _upload_hashers_lock:
+        state = _upload_hashers.pop(upload_id, None)
+    # chunks that landed on another worker: hash the assembled file once
+    sha256 = state[1].hexdigest() if state and state[0] == size else file_sha256(part)
+    expected = (request.json or {}).get('sha256') if request.is_json else None
+    if expected and expected.lower() != sha256:
+        return jsonify({'error': 'Checksum mismatch', 'sha256': sha256}), 422
+
+    try:
+        firmware_id, filename = publish_firmware(db, upload['version'], upload['description'],
+                                                 part, size, sha256)
+    except sqlite3.IntegrityError:
+        drop_upload_session(db, upload_id)
+        db.commit()
+        return jsonify({'error': 'Version already exists'}), 400
+    drop_upload_session(db, upload_id)
+    db.commit()
+
+    return jsonify({
+        'success': True,
+        'id': firmware_id,
+        'version': upload['version'],
+        'filename': filename,
+        'size': size,
+        'sha256': sha256
+    })
+
+@app.route('/api/releases/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_release_upload(upload_id):
+    db = get_db()
+    if not get_upload_session(db, upload_id):
+        return jsonify({'error': 'Upload not found'}), 404
+    drop_upload_session(db, upload_id)
+    db.commit()
+    return jsonify({'success': True})
+
 @app.route('/api/releases/<int:release_id>', methods=['DELETE'])
 @login_required
 def delete_release(release_id):
@@ -484,34 +3241,525 @@ def delete_release(release_id):
         if os.path.exists(filepath):
             os.remove(filepath)
         
+        deltas = db.execute('''
+            SELECT filename FROM firmware_deltas WHERE from_version = ? OR to_version = ?
+        ''', (firmware['version'], firmware['version'])).fetchall()
+        for delta in deltas:
+            delta_path = os.path.join(delta_folder(), delta['filename'])
+            if os.path.exists(delta_path):
+                os.remove(delta_path)
+        db.execute('DELETE FROM firmware_deltas WHERE from_version = ? OR to_version = ?',
+                   (firmware['version'], firmware['version']))
         db.execute('DELETE FROM firmwares WHERE id = ?', (release_id,))
+        publish_event(db, 'release', {'id': release_id, 'version': firmware['version'], 'action': 'deleted'})
+        firmware_index.invalidate(db)
         db.commit()
-        db.close()
         
         return jsonify({'success': True})
     
-    db.close()
     return jsonify({'error': 'Release not found'}), 404
 
+@app.route('/api/releases/<int:release_id>/stable', methods=['POST'])
+@login_required
+def set_release_stable(release_id):
+    data = request.json or {}
+    stable = 1 if str(data.get('stable', 1)).lower() in ('1', 'true', 'yes', 'on') else 0
+
+    db = get_db()
+    firmware = db.execute('SELECT version FROM firmwares WHERE id = ?', (release_id,)).fetchone()
+    if not firmware:
+        return jsonify({'error': 'Release not found'}), 404
+
+    db.execute('UPDATE firmwares SET is_stable = ? WHERE id = ?', (stable, release_id))
+    publish_event(db, 'release', {'id': release_id, 'version': firmware['version'],
+                                  'action': 'stable' if stable else 'unstable'})
+    firmware_index.invalidate(db)
+    db.commit()
+    if stable:
+        schedule_delta_build(firmware['version'])
+    return jsonify({'success': True, 'is_stable': stable})
+
+def rollout_summary(db, rollout_id):
+    row = db.execute('SELECT * FROM rollouts WHERE id = ?', (rollout_id,)).fetchone()
+    if not row:
+        return None
+    rollout = dict(row)
+    rollout['waves'] = json.loads(row['waves'])
+    rollout['percent'] = rollout['waves'][row['wave']]
+    rollout['in_flight'] = db.execute('''
+        SELECT COUNT(*) FROM download_slots WHERE rollout_id = ? AND expires_at > ?
+    ''', (rollout_id, utc_now_sql())).fetchone()[0]
+    return rollout
+
+@app.route('/api/rollouts', methods=['POST'])
+@login_required
+def create_rollout():
+    """Release a firmware version in waves.
+
+    JSON body: version, and optionally waves (percents of the fleet, default ROLLOUT_WAVES),
+    wave_minutes and max_failure_rate. One rollout can be open (active or paused) at a time.
+    """
+    data = request.json or {}
+    version = str(data.get('version') or '').strip()
+    try:
+        waves = parse_waves(data.get('waves') or app.config['ROLLOUT_WAVES'])
+        wave_minutes = float(data.get('wave_minutes', app.config['ROLLOUT_WAVE_MINUTES']))
+        max_failure_rate = float(data.get('max_failure_rate', app.config['ROLLOUT_MAX_FAILURE_RATE']))
+        if wave_minutes < 0 or not 0 <= max_failure_rate <= 1:
+            raise ValueError('wave_minutes must be >= 0 and max_failure_rate between 0 and 1')
+    except (TypeError, ValueError) as exc:
+        return jsonify({'error': str(exc)}), 400
+
+    db = get_db()
+    if not db.execute('SELECT id FROM firmwares WHERE version = ?', (version,)).fetchone():
+        return jsonify({'error': 'Release not found'}), 404
+    if db.execute("SELECT id FROM rollouts WHERE status IN ('active', 'paused') LIMIT 1").fetchone():
+        return jsonify({'error': 'Another rollout is still open, complete or abort it first'}), 409
+
+    now = utc_now_sql()
+    rollout_id = db.execute('''
+        INSERT INTO rollouts (version, waves, wave_minutes, max_failure_rate, created_by, created_at, wave_started_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (version, json.dumps(waves), wave_minutes, max_failure_rate, session.get('username'), now, now)).lastrowid
+    publish_event(db, 'rollout', {'id': rollout_id, 'version': version, 'status': 'active'})
+    firmware_index.invalidate(db)
+    db.commit()
+    schedule_delta_build(version)
+    return jsonify({'success': True, 'rollout': rollout_summary(db, rollout_id)})
+
+@app.route('/api/rollouts')
+@login_required
+def rollouts_list():
+    db = get_db()
+    ids = [row['id'] for row in db.execute('SELECT id FROM rollouts ORDER BY id DESC LIMIT 20')]
+    return jsonify({'items': [rollout_summary(db, rollout_id) for rollout_id in ids]})
+
+@app.route('/api/rollouts/<int:rollout_id>')
+@login_required
+def rollout_detail(rollout_id):
+    rollout = rollout_summary(get_db(), rollout_id)
+    if not rollout:
+        return jsonify({'error': 'Rollout not found'}), 404
+    return jsonify(rollout)
+
+@app.route('/api/rollouts/<int:rollout_id>/state', methods=['POST'])
+@login_required
+def set_rollout_state(rollout_id):
+    """{"state": "paused" | "active" | "aborted"}. Resuming restarts the current wave."""
+    data = request.json or {}
+    state = (data.get('state') or '').strip().lower()
+    if state not in ('active', 'paused', 'aborted'):
+        return jsonify({'error': 'Invalid state'}), 400
+
+    db = get_db()
+    rollout = db.execute('SELECT status FROM rollouts WHERE id = ?', (rollout_id,)).fetchone()
+    if not rollout:
+        return jsonify({'error': 'Rollout not found'}), 404
+    if rollout['status'] not in OPEN_ROLLOUT_STATES:
+        return jsonify({'error': f"Rollout already {rollout['status']}"}), 409
+
+    now = utc_now_sql()
+    if state == 'active':
+        db.execute('''
+            UPDATE rollouts SET status = 'active', reason = NULL, wave_started_at = ?, wave_updated = 0, wave_failed = 0
+            WHERE id = ?
+        ''', (now, rollout_id))
+    elif state == 'paused':
+        db.execute("UPDATE rollouts SET status = 'paused', reason = 'paused from the panel' WHERE id = ?",
+                   (rollout_id,))
+    else:
+        db.execute("UPDATE rollouts SET status = 'aborted', finished_at = ? WHERE id = ?", (now, rollout_id))
+        # downloads still running stop at their next request; the devices get the stable release
+        db.execute('DELETE FROM download_slots WHERE rollout_id = ?', (rollout_id,))
+    publish_event(db, 'rollout', {'id': rollout_id, 'status': state})
+    firmware_index.invalidate(db)
+    db.commit()
+    return jsonify({'success': True, 'rollout': rollout_summary(db, rollout_id)})
+
+ALARM_LIST_COLUMNS = {
+    'id': 'a.id',
+    'device_id': 'a.device_id',
+    'alarm_type': 'a.alarm_type',
+    'message': 'a.message',
+    'severity': 'a.severity',
+    'created_at': 'a.created_at',
+    'occurrences': 'a.occurrences',
+    'last_seen': 'a.last_seen',
+    'device_name': 'd.device_name',
+    'mac_address': 'd.mac_address',
+}
+ALARM_LIST_DEFAULT = ['id', 'alarm_type', 'message', 'severity', 'created_at', 'occurrences', 'last_seen',
+                      'device_name', 'mac_address']
+
 @app.route('/api/alarms/list')
 @login_required
 def alarms_list():
-    limit = request.args.get('limit', 100, type=int)
-    
+    """Alarms by created_at, newest first.
+
+    ?severity= &alarm_type= &device_id= &from= &to= (epoch or ISO 8601, UTC) filters,
+    ?fields= projection, ?limit= (max LIST_PAGE_MAX) and ?cursor= for the next page.
+    """
+    try:
+        fields, limit, cursor = list_args(ALARM_LIST_COLUMNS, ALARM_LIST_DEFAULT)
+        since, until = time_arg('from'), time_arg('to')
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+
+    select = ', '.join(f"{ALARM_LIST_COLUMNS[f]} AS {f}" for f in fields)
+    select += ', a.created_at AS _created_at, a.id AS _id'
+    joins = ''
+    if {'device_name', 'mac_address'} & set(fields):
+        joins = 'LEFT JOIN devices d ON a.device_id = d.id'
+    where, params = [], []
+    for name in ('severity', 'alarm_type'):
+        value = request.args.get(name)
+        if value:
+            where.append(f'a.{name} = ?')
+            params.append(value)
+    device_id = request.args.get('device_id', type=int)
+    if device_id is not None:
+        where.append('a.device_id = ?')
+        params.append(device_id)
+    if since:
+        where.append('a.created_at >= ?')
+        params.append(since)
+    if until:
+        where.append('a.created_at < ?')
+        params.append(until)
+    if cursor:
+        where.append('(a.created_at, a.id) < (?, ?)')
+        params += cursor
+
     db = get_db()
-    alarms = db.execute('''
-        SELECT a.id, a.alarm_type, a.message, a.severity, a.created_at,
-               d.device_name, d.mac_address
-        FROM alarms a
-        LEFT JOIN devices d ON a.device_id = d.id
-        ORDER BY a.created_at DESC
+    rows = db.execute(f'''
+        SELECT {select}
+        FROM alarms a {joins}
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY a.created_at DESC, a.id DESC
         LIMIT ?
-    ''', (limit,)).fetchall()
-    db.close()
-    
-    return jsonify([dict(alarm) for alarm in alarms])
+    ''', params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['_created_at'], rows[-1]['_id'])
+    return jsonify({'items': [{f: row[f] for f in fields} for row in rows], 'next_cursor': next_cursor})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape target: needs a dashboard session or `Authorization: Bearer <METRICS_TOKEN>`."""
+    token = app.config['METRICS_TOKEN']
+    auth = request.headers.get('Authorization', '')
+    if 'user_id' not in session and not (
+            token and auth.startswith('Bearer ') and hmac.compare_digest(auth[7:].encode(), token.encode())):
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({'error': 'Metrics are disabled (METRICS_ENABLED=0)'}), 404
+    body = render_metrics(request_metrics.collect())
+    return app.response_class(body, content_type='text/plain; version=0.0.4; charset=utf-8',
+                              headers={'Cache-Control': 'no-store'})
+
+QUERY_SORT_KEYS = ('total_ms', 'calls', 'mean_ms', 'max_ms', 'rows', 'vm_steps')
+
+@app.route('/api/admin/queries')
+@login_required
+def query_stats():
+    """Top SQL statements by total time (or ?sort=) over all workers, with SQL_TRACE=1.
+
+    One item per normalized statement and endpoint; `?endpoint=` keeps one handler.
+    """
+    sort = request.args.get('sort', 'total_ms')
+    if sort not in QUERY_SORT_KEYS:
+        return jsonify({'error': f"sort must be one of {', '.join(QUERY_SORT_KEYS)}"}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 500)
+    endpoint = request.args.get('endpoint')
+    total = request_metrics.collect()
+    step_ops = app.config['SQL_TRACE_STEP_OPS']
+    items = []
+    for (sql, item_endpoint), (calls, seconds, max_seconds, rows, ticks) in total['queries'].items():
+        if endpoint and item_endpoint != endpoint:
+            continue
+        items.append({
+            'sql': sql, 'endpoint': item_endpoint, 'calls': calls,
+            'total_ms': round(seconds * 1000, 3),
+            'mean_ms': round(seconds * 1000 / calls, 3) if calls else None,
+            'max_ms': round(max_seconds * 1000, 3),
+            'rows': rows, 'rows_per_call': round(rows / calls, 1) if calls else None,
+            'vm_steps': ticks * step_ops,
+        })
+    items.sort(key=lambda item: item[sort] or 0, reverse=True)
+    return jsonify({
+        'enabled': app.config['SQL_TRACE'], 'slow_query_ms': app.config['SLOW_QUERY_MS'],
+        'workers': total['workers'], 'statements': len(items), 'items': items[:limit],
+    })
+
+@app.route('/api/admin/cache')
+@login_required
+def cache_stats():
+    return jsonify({'device_cache': device_cache.stats(), 'firmware_index': firmware_index.stats()})
+
+@app.route('/api/admin/background')
+@login_required
+def background_stats():
+    """Leader-elected jobs: who holds each lease and how long the last run took."""
+    db = get_db()
+    leases = db.execute('''
+        SELECT name, holder, expires_at, last_run_at, last_run_ms, last_result
+        FROM leases ORDER BY name
+    ''').fetchall()
+    jobs = []
+    for row in leases:
+        job = dict(row)
+        job['last_result'] = json.loads(row['last_result']) if row['last_result'] else None
+        job['active'] = row['expires_at'] > time.time()
+        jobs.append(job)
+    return jsonify({'jobs': jobs, 'events': event_hub.stats(), 'command_waiters': command_waiters.count()})
+
+@app.route('/api/events')
+@login_required
+def events_stream():
+    """Server-Sent Events feed for the panel: device_status, device_added, device_removed,
+    alarm, command and release. Reconnects resume from Last-Event-ID; if that event has
+    already been pruned the stream starts with `resync` so the page reloads its tables."""
+    db = get_db()
+    bounds = db.execute('SELECT MIN(id) AS first, MAX(id) AS last FROM events').fetchone()
+    head = bounds['last'] or 0
+    since = request.headers.get('Last-Event-ID', type=int)
+    resync = False
+    if since is None or since > head:
+        since = head
+    elif bounds['first'] is not None and since < bounds['first'] - 1:
+        since, resync = head, True
+
+    sub = event_hub.subscribe(since, app.config['EVENTS_MAX_STREAMS'])
+    if sub is None:
+        # the panel falls back to polling
+        return server_busy('Too many open event streams')
+    keepalive = app.config['EVENTS_KEEPALIVE']
+    deadline = time.monotonic() + app.config['EVENTS_STREAM_MAX_SECONDS']
+
+    def stream():
+        # runs after the request context is gone: no DB access in here
+        yield f"retry: 3000\nid: {since}\n\n"
+        if resync:
+            yield format_sse(since, 'resync', '{}')
+        while not sub.dropped and time.monotonic() < deadline:
+            try:
+                yield sub.queue.get(timeout=keepalive)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+
+    resp = app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # on close rather than in the generator: a stream closed before its first frame frees its slot too
+    resp.call_on_close(lambda: event_hub.unsubscribe(sub))
+    return resp
 
 # API Routes for ESP32 Devices
+# ---- Compact device protocol (CBOR) ----
+# Heartbeat, alarm(s) and check_update also speak CBOR (RFC 8949): Content-Type:
+# application/cbor for the request, Accept: application/cbor (or a CBOR request without
+# Accept) for the response. Map keys are small integers instead of field names, the MAC
+# goes as 6 bytes, an IPv4 address as 4 and SHA-256 digests as 32; everything else is
+# the JSON payload as is, so the handlers and auth are the same for both formats.
+CBOR_MIMETYPE = 'application/cbor'
+
+DEVICE_CBOR_KEYS = {
+    # keys 0-23 take a single byte: hot heartbeat / response fields first
+    'mac_address': 1, 'api_key': 2, 'uptime': 3, 'free_heap': 4, 'ip_address': 5, 'ssid': 6,
+    'firmware_version': 7, 'current_version': 8, 'alarm_type': 9, 'message': 10, 'severity': 11,
+    'timestamp': 12, 'age': 13, 'alarms': 14,
+    'success': 16, 'error': 17, 'command': 18, 'payload': 19, 'update_available': 20,
+    'version': 21, 'url': 22, 'size': 23,
+    'sha256': 24, 'reason': 25, 'delta_url': 26, 'delta_size': 27, 'delta_sha256': 28,
+    'deduplicated': 29, 'retry_after': 30, 'accepted': 31, 'rejected': 32, 'rate_limited': 33,
+    'results': 34, 'index': 35, 'status': 36, 'id': 37, 'etag': 38,
+}
+DEVICE_CBOR_NAMES = {key: name for name, key in DEVICE_CBOR_KEYS.items()}
+CBOR_MAX_DEPTH = 8
+
+def _cbor_head(out, major, n):
+    if n < 24:
+        out.append(major << 5 | n)
+    elif n < 0x100:
+        out += bytes((major << 5 | 24, n))
+    elif n < 0x10000:
+        out.append(major << 5 | 25)
+        out += n.to_bytes(2, 'big')
+    elif n < 0x100000000:
+        out.append(major << 5 | 26)
+        out += n.to_bytes(4, 'big')
+    else:
+        out.append(major << 5 | 27)
+        out += n.to_bytes(8, 'big')
+
+def cbor_dumps(obj):
+    out = bytearray()
+
+    def dump(value):
+        if value is None:
+            out.append(0xF6)
+        elif value is True or value is False:
+            out.append(0xF5 if value else 0xF4)
+        elif isinstance(value, int):
+            if value >= 0:
+                _cbor_head(out, 0, value)
+            else:
+                _cbor_head(out, 1, -1 - value)
+        elif isinstance(value, float):
+            out.append(0xFB)
+            out.extend(struct.pack('>d', value))
+        elif isinstance(value, (bytes, bytearray)):
+            _cbor_head(out, 2, len(value))
+            out.extend(value)
+        elif isinstance(value, str):
+            encoded = value.encode('utf-8')
+            _cbor_head(out, 3, len(encoded))
+            out.extend(encoded)
+        elif isinstance(value, (list, tuple)):
+            _cbor_head(out, 4, len(value))
+            for item in value:
+                dump(item)
+        elif isinstance(value, dict):
+            _cbor_head(out, 5, len(value))
+            for key, item in value.items():
+                dump(key)
+                dump(item)
+        else:
+            raise TypeError(f'Cannot encode {type(value).__name__} as CBOR')
+
+    dump(obj)
+    return bytes(out)
+
+def cbor_loads(data):
+    """Decode one CBOR item (definite or indefinite arrays / maps, no indefinite strings)."""
+    data = bytes(data)
+    end = len(data)
+
+    def load(pos, depth):
+        if pos >= end:
+            raise ValueError('Truncated CBOR')
+        initial = data[pos]
+        pos += 1
+        major, info = initial >> 5, initial & 0x1F
+        if major == 7:
+            if info in (20, 21):
+                return info == 21, pos
+            if info in (22, 23):
+                return None, pos
+            if 25 <= info <= 27:
+                fmt, size = ('>e', 2) if info == 25 else ('>f', 4) if info == 26 else ('>d', 8)
+                if pos + size > end:
+                    raise ValueError('Truncated CBOR')
+                return struct.unpack_from(fmt, data, pos)[0], pos + size
+            raise ValueError('Unsupported CBOR simple value')
+        if info < 24:
+            n = info
+        elif info <= 27:
+            size = 1 << (info - 24)
+            if pos + size > end:
+                raise ValueError('Truncated CBOR')
+            n = int.from_bytes(data[pos:pos + size], 'big')
+            pos += size
+        elif info == 31 and major in (4, 5):
+            n = None
+        else:
+            raise ValueError('Unsupported CBOR length')
+        if major == 0:
+            return n, pos
+        if major == 1:
+            return -1 - n, pos
+        if major in (2, 3):
+            if pos + n > end:
+                raise ValueError('Truncated CBOR')
+            chunk = data[pos:pos + n]
+            return (chunk if major == 2 else chunk.decode('utf-8')), pos + n
+        if depth >= CBOR_MAX_DEPTH:
+            raise ValueError('CBOR nested too deep')
+        if major == 6:
+            return load(pos, depth + 1)  # tags are ignored, but nest like arrays
+        items = [] if major == 4 else {}
+        count = 0
+        while n is None or count < n:
+            if n is None and pos < end and data[pos] == 0xFF:
+                pos += 1
+                break
+            value, pos = load(pos, depth + 1)
+            if major == 4:
+                items.append(value)
+            else:
+                if isinstance(value, (list, dict)):
+                    raise ValueError('Unsupported CBOR map key')
+                items[value], pos = load(pos, depth + 1)
+            count += 1
+        return items, pos
+
+    value, pos = load(0, 0)
+    if pos != end:
+        raise ValueError('Trailing bytes after CBOR item')
+    return value
+
+def decode_device_cbor(value):
+    """CBOR request -> the dict the JSON request gives (integer keys to names, packed MAC / IP)."""
+    if isinstance(value, list):
+        return [decode_device_cbor(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    decoded = {}
+    for key, item in value.items():
+        name = DEVICE_CBOR_NAMES.get(key, key)
+        if name == 'mac_address':
+            # 6 packed bytes, or text; any other type would only reach SQLite
+            if isinstance(item, bytes) and len(item) == 6:
+                item = normalize_mac(item.hex())
+            elif not isinstance(item, str):
+                raise ValueError('Invalid mac_address')
+        elif name == 'ip_address' and isinstance(item, bytes) and len(item) == 4:
+            item = '.'.join(str(b) for b in item)
+        else:
+            item = decode_device_cbor(item)
+        decoded[name] = item
+    return decoded
+
+def encode_device_cbor(value):
+    if isinstance(value, list):
+        return [encode_device_cbor(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    encoded = {}
+    for name, item in value.items():
+        if name in ('sha256', 'delta_sha256') and isinstance(item, str) and len(item) == 64:
+            item = bytes.fromhex(item)
+        else:
+            item = encode_device_cbor(item)
+        encoded[DEVICE_CBOR_KEYS.get(name, name)] = item
+    return encoded
+
+def device_body():
+    """Body of a device request as a dict, from JSON or CBOR."""
+    if request.mimetype == CBOR_MIMETYPE:
+        try:
+            data = decode_device_cbor(cbor_loads(request.get_data(cache=False)))
+        except ValueError:
+            raise BadRequest('Invalid CBOR body')
+        return data if isinstance(data, dict) else {}
+    return request.json or {}
+
+def wants_cbor():
+    # a CBOR request gets CBOR back unless Accept asks for JSON
+    order = [CBOR_MIMETYPE, 'application/json'] if request.mimetype == CBOR_MIMETYPE \
+        else ['application/json', CBOR_MIMETYPE]
+    return request.accept_mimetypes.best_match(order, default=order[0]) == CBOR_MIMETYPE
+
+def device_reply(payload, status=200):
+    if wants_cbor():
+        resp = app.response_class(cbor_dumps(encode_device_cbor(payload)), mimetype=CBOR_MIMETYPE)
+    else:
+        resp = jsonify(payload)
+    resp.status_code = status
+    resp.vary.add('Accept')
+    return resp
+
 @app.route('/api/esp32/register', methods=['POST'])
 def esp32_register():
     data = request.json
@@ -521,13 +3769,14 @@ def esp32_register():
         return jsonify({'error': 'Missing required fields'}), 400
     
     db = get_db()
-    
     # Check if device exists
-    device = db.execute('SELECT * FROM devices WHERE mac_address = ?', 
-                       (data['mac_address'],)).fetchone()
+    device = db.execute(DEVICE_BY_MAC_SQL, (data['mac_address'], data['mac_address'])).fetchone()
+    # an existing row keeps its spelling of the MAC, a new one is stored in lower case
+    mac = device['mac_address'] if device else normalize_mac(data['mac_address'])
+    # registration carries fresher values than anything still buffered
+    heartbeat_buffer.discard(mac)
     # If blocked, deny registration/updates
-    if device and (device.get('admin_state') == 'blocked'):
-        db.close()
+    if device and (device['admin_state'] == 'blocked'):
         return jsonify({'error': 'Device blocked'}), 403
 
     
@@ -541,190 +3790,395 @@ def esp32_register():
             WHERE mac_address = ?
         ''', (data['ip_address'], data.get('ssid', ''), data['firmware_version'],
               data.get('device_name', ''), data.get('uptime', 0), 
-              data.get('free_heap', 0), data['mac_address']))
+              data.get('free_heap', 0), mac))
         device_id = device['id']
-        if not device.get('api_key'):
+        if not device['api_key']:
             db.execute('UPDATE devices SET api_key = ? WHERE id = ?', (generate_api_key(), device_id))
+            # the only credential change a registration makes; a reboot of a keyed device
+            # leaves every worker's cache alone
+            device_cache.invalidate(db, mac)
+        if device['status'] != 'online':
+            publish_event(db, 'device_status', {'id': device_id, 'mac_address': mac,
+                                                'status': 'online', 'previous': device['status']})
     else:
         # Create new device
         db.execute('''
             INSERT INTO devices (mac_address, ip_address, ssid, firmware_version, 
                                device_name, last_seen, status, uptime, free_heap, api_key, admin_state, ota_enabled)
             VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, 'online', ?, ?, ?, 'active', 0)
-        ''', (data['mac_address'], data['ip_address'], data.get('ssid', ''),
+        ''', (mac, data['ip_address'], data.get('ssid', ''),
               data['firmware_version'], data.get('device_name', ''),
               data.get('uptime', 0), data.get('free_heap', 0), generate_api_key()))
         device_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
         
         # Log new device
-        db.execute('''
+        cur = db.execute('''
             INSERT INTO alarms (device_id, alarm_type, message, severity)
             VALUES (?, 'device_registered', 'New device registered', 'info')
         ''', (device_id,))
+        publish_event(db, 'device_added', {'id': device_id, 'mac_address': mac, 'status': 'online'})
+        publish_alarm_events(db, cur.lastrowid)
     
     db.commit()
-    db.close()
     
     device_row = get_db().execute('SELECT api_key FROM devices WHERE id = ?', (device_id,)).fetchone()
     return jsonify({'success': True, 'device_id': device_id, 'api_key': device_row['api_key'] if device_row else None})
 
 @app.route('/api/esp32/heartbeat', methods=['POST'])
 def esp32_heartbeat():
-    data = request.json or {}
+    data = device_body()
     mac = data.get('mac_address')
     if not mac:
-        return jsonify({'error': 'MAC address required'}), 400
+        return device_reply({'error': 'MAC address required'}, 400)
 
     api_key = request.headers.get('X-API-Key') or data.get('api_key')
     if not api_key:
-        return jsonify({'error': 'API key required'}), 401
+        return device_reply({'error': 'API key required'}, 401)
 
     db = get_db()
     device, err = verify_device_request(db, mac, api_key)
     if err:
-        db.close()
         return err
 
     admin_state = (device.get('admin_state') or 'active').lower()
-    status = 'online' if admin_state == 'active' else 'suspended'
-
-    db.execute('''
-        UPDATE devices
-        SET last_seen = CURRENT_TIMESTAMP,
-            status = ?,
-            uptime = ?,
-            free_heap = ?,
-            ip_address = COALESCE(?, ip_address),
-            ssid = COALESCE(?, ssid),
-            firmware_version = COALESCE(?, firmware_version)
-        WHERE mac_address = ?
-    ''', (status, data.get('uptime', 0), data.get('free_heap', 0),
-          data.get('ip_address'), data.get('ssid'), data.get('firmware_version'), mac))
 
-    cmd_row = db.execute('''
-        SELECT id, command, payload FROM device_commands
-        WHERE device_id = ? AND status = 'pending'
-        ORDER BY requested_at ASC
-        LIMIT 1
-    ''', (device['id'],)).fetchone()
+    beat = (data.get('uptime', 0), data.get('free_heap', 0),
+            data.get('ip_address'), data.get('ssid'), data.get('firmware_version'))
+    telemetry_buffer.add(device['id'], beat[0], beat[1])
+    if app.config['HEARTBEAT_FLUSH_INTERVAL'] > 0:
+        heartbeat_buffer.add(device['mac_address'], *beat)
+    else:
+        row = (utc_now_sql(),) + beat + (device['mac_address'],)
+        publish_status_changes(db, [row])
+        db.execute(HEARTBEAT_UPDATE_SQL, row)
 
     command = None
-    if cmd_row and admin_state == 'active':
-        db.execute("UPDATE device_commands SET status='sent', sent_at=CURRENT_TIMESTAMP WHERE id=?", (cmd_row['id'],))
-        payload = None
-        if cmd_row['payload']:
-            try:
-                payload = json.loads(cmd_row['payload'])
-            except Exception:
-                payload = {'raw': cmd_row['payload']}
-        command = {'command': cmd_row['command'], 'payload': payload}
+    if admin_state == 'active':
+        command = claim_pending_command(db, device['id'])
+        if command:
+            command = {'id': command['id'], 'command': command['command'], 'payload': command['payload']}
 
     db.commit()
-    db.close()
-    return jsonify({'success': True, 'command': command})
+    return device_reply({'success': True, 'command': command})
+
+
+def update_reply(data, payload):
+    """check_update answer tagged with a short token of its content.
 
+    A device that sends the token back (`etag` in the body or If-None-Match) gets
+    an empty 304 while the answer stays the same.
+    """
+    etag = format(zlib.crc32(json.dumps(payload, sort_keys=True).encode()), '08x')
+    known = data.get('etag') or request.headers.get('If-None-Match', '').strip().strip('"')
+    if known == etag:
+        resp = app.response_class(status=304)
+    else:
+        resp = device_reply(dict(payload, etag=etag))
+    resp.headers['ETag'] = f'"{etag}"'
+    return resp
 
 @app.route('/api/esp32/check_update', methods=['POST'])
 def esp32_check_update():
-    data = request.json or {}
+    data = device_body()
     mac = data.get('mac_address')
     current = data.get('current_version')
     if not mac or current is None:
-        return jsonify({'error': 'MAC address and current version required'}), 400
+        return device_reply({'error': 'MAC address and current version required'}, 400)
 
     api_key = request.headers.get('X-API-Key') or data.get('api_key')
     if not api_key:
-        return jsonify({'error': 'API key required'}), 401
+        return device_reply({'error': 'API key required'}, 401)
 
     db = get_db()
     device, err = verify_device_request(db, mac, api_key)
     if err:
-        db.close()
         return err
 
     admin_state = (device.get('admin_state') or 'active').lower()
     if admin_state != 'active':
-        db.close()
-        return jsonify({'update_available': False, 'reason': 'suspended'})
+        return update_reply(data, {'update_available': False, 'reason': 'suspended'})
 
     ota_enabled = int(device.get('ota_enabled') or 0)
     target_version = (device.get('ota_target_version') or '').strip()
 
+    index = firmware_index.get(db)
     firmware = None
+    rollout_id = None
     if target_version:
-        firmware = db.execute('SELECT * FROM firmwares WHERE version = ? LIMIT 1', (target_version,)).fetchone()
+        firmware = index['firmwares'].get(target_version)
         if not firmware:
-            db.close()
-            return jsonify({'update_available': False, 'reason': 'target_not_found'})
+            return update_reply(data, {'update_available': False, 'reason': 'target_not_found'})
     else:
         if not ota_enabled:
-            db.close()
-            return jsonify({'update_available': False, 'reason': 'ota_disabled'})
-        firmware = db.execute('''
-            SELECT * FROM firmwares
-            WHERE is_stable = 1
-            ORDER BY uploaded_at DESC
-            LIMIT 1
-        ''').fetchone()
+            return update_reply(data, {'update_available': False, 'reason': 'ota_disabled'})
+        # devices in the current wave of the active rollout get its version...
+        rollout = index['rollout']
+        if rollout and rollout_bucket(rollout['version'], mac) < rollout['percent'] * 100:
+            firmware = index['firmwares'].get(rollout['version'])
+            rollout_id = rollout['id']
+        # ...the rest the latest stable release that is not still rolling out
+        if not firmware:
+            firmware = index['firmwares'].get(index['stable'])
 
-    db.close()
 
     if not firmware:
-        return jsonify({'update_available': False})
+        return update_reply(data, {'update_available': False})
 
     if firmware['version'] != current:
-        return jsonify({
+        slot = acquire_download_slot(db, device['id'], firmware['version'], rollout_id)
+        if slot is None:
+            return ota_busy()
+        response = {
             'update_available': True,
             'version': firmware['version'],
-            'url': url_for('download_firmware', version=firmware['version'], _external=True),
-            'size': firmware.get('file_size')
-        })
+            'url': url_for('download_firmware', version=firmware['version'], slot=slot or None, _external=True),
+            'size': firmware['file_size'],
+            'sha256': firmware['sha256']
+        }
+        delta = index['deltas'].get((current, firmware['version']))
+        if delta:
+            # the full image stays in `url` as the fallback
+            response['delta_url'] = url_for('download_firmware_delta', version=firmware['version'],
+                                            from_version=current, slot=slot or None, _external=True)
+            response['delta_size'] = delta['file_size']
+            response['delta_sha256'] = delta['sha256']
+        return update_reply(data, response)
+
+    return update_reply(data, {'update_available': False})
+
 
-    return jsonify({'update_available': False})
+def refused_slot(db, version):
+    """429 for a download of `version` without a valid ?slot=; None when it may go ahead.
 
+    Without ?slot= only the version of the active rollout is refused (while downloads are
+    capped): otherwise leaving the token out would skip the OTA_MAX_DOWNLOADS cap.
+    """
+    token = request.args.get('slot')
+    if token:
+        if db.execute('SELECT 1 FROM download_slots WHERE token = ? AND version = ? AND expires_at > ?',
+                      (token, version, utc_now_sql())).fetchone():
+            return None
+        error = 'Download slot expired, check for updates again'
+    else:
+        rollout = firmware_index.get(db)['rollout']
+        if app.config['OTA_MAX_DOWNLOADS'] <= 0 or not rollout or rollout['version'] != version:
+            return None
+        error = 'Download slot required, check for updates first'
+    resp = jsonify({'error': error})
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(app.config['OTA_RETRY_SECONDS'])
+    return resp
 
 @app.route('/api/esp32/firmware/<version>')
 def download_firmware(version):
     db = get_db()
-    firmware = db.execute('SELECT * FROM firmwares WHERE version = ?', (version,)).fetchone()
-    db.close()
+    refused = refused_slot(db, version)
+    if refused:
+        return refused
+    firmware = firmware_index.get(db)['firmwares'].get(version)
     
     if firmware:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], firmware['filename'])
+        # Strong ETag = content hash; conditional=True answers If-None-Match (304) and
+        # Range/If-Range (206) so an interrupted OTA resumes instead of restarting.
+        # The body goes out through wsgi.file_wrapper (sendfile under gunicorn).
+        return send_from_directory(app.config['UPLOAD_FOLDER'], firmware['filename'],
+                                   mimetype='application/octet-stream',
+                                   etag=firmware['sha256'] or True, conditional=True,
+                                   max_age=app.config['FIRMWARE_CACHE_MAX_AGE'])
     
     return jsonify({'error': 'Firmware not found'}), 404
 
+@app.route('/api/esp32/firmware/<version>/delta/<from_version>')
+def download_firmware_delta(version, from_version):
+    db = get_db()
+    refused = refused_slot(db, version)
+    if refused:
+        return refused
+    delta = firmware_index.get(db)['deltas'].get((from_version, version))
+
+    if delta:
+        return send_from_directory(delta_folder(), delta['filename'],
+                                   mimetype='application/octet-stream',
+                                   etag=delta['sha256'] or True, conditional=True,
+                                   max_age=app.config['FIRMWARE_CACHE_MAX_AGE'])
+
+    return jsonify({'error': 'Delta not found'}), 404
+
 @app.route('/api/esp32/alarm', methods=['POST'])
 def esp32_alarm():
-    data = request.json or {}
+    data = device_body()
     mac = data.get('mac_address')
     if not mac or 'alarm_type' not in data:
-        return jsonify({'error': 'MAC address and alarm_type required'}), 400
+        return device_reply({'error': 'MAC address and alarm_type required'}, 400)
 
     api_key = request.headers.get('X-API-Key') or data.get('api_key')
     if not api_key:
-        return jsonify({'error': 'API key required'}), 401
+        return device_reply({'error': 'API key required'}, 401)
 
     db = get_db()
     device, err = verify_device_request(db, mac, api_key)
     if err:
-        db.close()
         return err
 
-    db.execute('''
-        INSERT INTO alarms (device_id, alarm_type, message, severity)
-        VALUES (?, ?, ?, ?)
-    ''', (device['id'], data['alarm_type'], data.get('message', ''),
-          data.get('severity', 'info')))
+    alarm_type, severity = str(data['alarm_type']), data.get('severity', 'info')
+    if not isinstance(severity, str):
+        return device_reply({'error': 'severity must be a string'}, 400)
+    seen_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    window = (device['id'], alarm_type, severity)
+    outcome, retry_after = alarm_gate.admit(window, seen_at)
+    if outcome == 'limited':
+        return too_many_alarms(retry_after)
+    if outcome == 'folded':
+        return device_reply({'success': True, 'deduplicated': True})
 
-    db.commit()
-    db.close()
-    return jsonify({'success': True})
+    try:
+        cur = db.execute('''
+            INSERT INTO alarms (device_id, alarm_type, message, severity, created_at, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (device['id'], alarm_type, data.get('message', ''), severity, seen_at, seen_at))
+        alarm_gate.opened(window, cur.lastrowid)
+        publish_alarm_events(db, cur.lastrowid)
+        db.commit()
+    except Exception:
+        alarm_gate.abandon(window)
+        raise
+    return device_reply({'success': True})
+
+
+def read_device_body():
+    """Request body as JSON or CBOR, transparently gunzipping `Content-Encoding: gzip`."""
+    raw = request.get_data(cache=False)
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        limit = app.config['MAX_CONTENT_LENGTH']
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        raw = inflater.decompress(raw, limit)
+        if inflater.unconsumed_tail:
+            raise ValueError('payload_too_large')
+    if request.mimetype == CBOR_MIMETYPE:
+        return decode_device_cbor(cbor_loads(raw)) if raw else {}
+    return json.loads(raw or b'{}')
+
+def parse_timestamp(ts):
+    """Epoch seconds or ISO 8601 (UTC unless it has an offset) -> aware datetime."""
+    if isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        return datetime.fromtimestamp(ts, timezone.utc)
+    when = datetime.fromisoformat(str(ts).replace('Z', '+00:00'))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when
+
+def parse_device_timestamp(item, received_at):
+    """created_at for a device-side event: `timestamp` (epoch seconds or ISO 8601, UTC)
+    or `age` (seconds before the request). Future times are clamped to `received_at`."""
+    if item.get('timestamp') is not None:
+        when = parse_timestamp(item['timestamp'])
+    elif item.get('age') is not None:
+        when = received_at - timedelta(seconds=float(item['age']))
+    else:
+        when = received_at
+    return min(when, received_at).astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+@app.route('/api/esp32/alarms/batch', methods=['POST'])
+def esp32_alarm_batch():
+    """Several alarms in one request: {mac_address, alarms: [{alarm_type, message, severity, timestamp|age}]}."""
+    try:
+        data = read_device_body()
+    except ValueError as exc:
+        if str(exc) == 'payload_too_large':
+            return device_reply({'error': 'Payload too large'}, 413)
+        return device_reply({'error': 'Invalid body'}, 400)
+    except zlib.error:
+        return device_reply({'error': 'Invalid gzip body'}, 400)
+
+    mac = data.get('mac_address') if isinstance(data, dict) else None
+    items = data.get('alarms') if isinstance(data, dict) else None
+    if not mac or not isinstance(items, list):
+        return device_reply({'error': 'MAC address and alarms list required'}, 400)
+    if len(items) > app.config['ALARM_BATCH_MAX']:
+        return device_reply({'error': f"At most {app.config['ALARM_BATCH_MAX']} alarms per batch"}, 413)
+
+    api_key = request.headers.get('X-API-Key') or data.get('api_key')
+    if not api_key:
+        return device_reply({'error': 'API key required'}, 401)
+
+    db = get_db()
+    device, err = verify_device_request(db, mac, api_key)
+    if err:
+        return err
+
+    received_at = datetime.now(timezone.utc)
+    rows, windows, results = [], [], []
+    deduplicated = limited = 0
+    retry_after = 0
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('alarm_type'):
+            results.append({'index': index, 'status': 'rejected', 'error': 'alarm_type required'})
+            continue
+        try:
+            created_at = parse_device_timestamp(item, received_at)
+        except (TypeError, ValueError, OverflowError, OSError):
+            results.append({'index': index, 'status': 'rejected', 'error': 'invalid timestamp'})
+            continue
+        alarm_type, severity = str(item['alarm_type']), item.get('severity', 'info')
+        if not isinstance(severity, str):
+            results.append({'index': index, 'status': 'rejected', 'error': 'severity must be a string'})
+            continue
+        window = (device['id'], alarm_type, severity)
+        outcome, wait = alarm_gate.admit(window, created_at)
+        if outcome == 'limited':
+            limited += 1
+            retry_after = max(retry_after, wait)
+            results.append({'index': index, 'status': 'rate_limited', 'retry_after': max(1, math.ceil(wait))})
+            continue
+        if outcome == 'folded':
+            deduplicated += 1
+            results.append({'index': index, 'status': 'deduplicated'})
+            continue
+        rows.append((device['id'], alarm_type, item.get('message', ''), severity, created_at, created_at))
+        windows.append(window)
+        results.append({'index': index, 'status': 'accepted'})
+
+    if limited and limited == len(items):
+        return too_many_alarms(retry_after)
+
+    if rows:
+        try:
+            db.executemany('''
+                INSERT INTO alarms (device_id, alarm_type, message, severity, created_at, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            # one write transaction, so the new ids are contiguous
+            last_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+            for offset, window in enumerate(windows):
+                alarm_gate.opened(window, last_id - len(rows) + 1 + offset)
+            publish_alarm_events(db, last_id - len(rows) + 1, last_id)
+            db.commit()
+        except Exception:
+            for window in windows:
+                alarm_gate.abandon(window)
+            raise
+
+    resp = device_reply({
+        'success': True,
+        'accepted': len(rows),
+        'deduplicated': deduplicated,
+        'rate_limited': limited,
+        'rejected': len(items) - len(rows) - deduplicated - limited,
+        'results': results
+    })
+    if limited:
+        resp.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return resp
 
 
 @app.route('/api/esp32/command/<mac_address>', methods=['GET'])
 def esp32_get_command(mac_address):
-    """ESP32 polls this endpoint to check for pending commands (fallback)."""
+    """ESP32 polls this endpoint to check for pending commands (fallback).
+
+    With `?wait=N` the request is held up to N seconds (at most COMMAND_WAIT_MAX) until a
+    command is queued for the device. While parked it holds no transaction and, with
+    DB_POOL=0, no connection.
+    """
     api_key = request.headers.get('X-API-Key') or request.args.get('api_key')
     if not api_key:
         return jsonify({'error': 'API key required'}), 401
@@ -732,48 +4186,89 @@ def esp32_get_command(mac_address):
     db = get_db()
     device, err = verify_device_request(db, mac_address, api_key)
     if err:
-        db.close()
         return err
 
     admin_state = (device.get('admin_state') or 'active').lower()
     if admin_state != 'active':
-        db.close()
         return jsonify({'command': None})
 
-    cmd_row = db.execute('''
-        SELECT id, command, payload FROM device_commands
-        WHERE device_id = ? AND status = 'pending'
-        ORDER BY requested_at ASC
-        LIMIT 1
-    ''', (device['id'],)).fetchone()
+    wait = request.args.get('wait', 0, type=float)
+    # same rule as gateway.py: nan / inf would never reach the deadline
+    wait = min(max(wait, 0), app.config['COMMAND_WAIT_MAX']) if math.isfinite(wait) else 0
+    deadline = time.monotonic() + wait
+    waiter = None
+    try:
+        if wait:
+            # registered before the first look, so a command queued in between still wakes us
+            waiter = command_waiters.register(device['id'], event_head(db),
+                                              limit=app.config['COMMAND_WAITERS_MAX'])
+        while True:
+            command = claim_pending_command(db, device['id'])
+            remaining = deadline - time.monotonic()
+            if command or not remaining > 0:  # also ends the loop on a non-finite deadline
+                break
+            if waiter is None:
+                # every waiting slot of this worker is taken: come back later, don't hold a thread
+                return server_busy('Too many waiting requests')
+            release_db(None)
+            waiter.wait(remaining)
+            waiter.clear()
+            db = get_db()
+    finally:
+        if waiter is not None:
+            command_waiters.unregister(device['id'], waiter)
 
-    command = None
-    if cmd_row:
-        db.execute("UPDATE device_commands SET status='sent', sent_at=CURRENT_TIMESTAMP WHERE id=?", (cmd_row['id'],))
-        payload = None
-        if cmd_row['payload']:
-            try:
-                payload = json.loads(cmd_row['payload'])
-            except Exception:
-                payload = {'raw': cmd_row['payload']}
-        command = {'id': cmd_row['id'], 'command': cmd_row['command'], 'payload': payload}
+    if command:
         db.commit()
-    db.close()
     return jsonify({'command': command})
 
+@app.route('/api/esp32/command/<mac_address>/ack', methods=['POST'])
+def esp32_ack_command(mac_address):
+    """The device confirms it is running a command: {"id": <command id>} (JSON or CBOR)."""
+    data = device_body()
+    api_key = request.headers.get('X-API-Key') or data.get('api_key')
+    if not api_key:
+        return device_reply({'error': 'API key required'}, 401)
+
+    db = get_db()
+    device, err = verify_device_request(db, mac_address, api_key)
+    if err:
+        return err
+
+    command_id = data.get('id')
+    if not isinstance(command_id, int):
+        return device_reply({'error': 'Command id required'}, 400)
+    row = db.execute('SELECT command, status FROM device_commands WHERE id = ? AND device_id = ?',
+                     (command_id, device['id'])).fetchone()
+    if not row or row['status'] not in ('sent', 'acked'):
+        return device_reply({'error': 'Command not found'}, 404)
+    if row['status'] == 'sent':
+        db.execute("UPDATE device_commands SET status = 'acked', ack_at = CURRENT_TIMESTAMP "
+                   "WHERE id = ? AND status = 'sent'", (command_id,))
+        publish_event(db, 'command', {'id': command_id, 'device_id': device['id'],
+                                      'command': row['command'], 'status': 'acked'})
+        db.commit()
+    return device_reply({'success': True})
+
 @app.route('/api/devices/<int:device_id>', methods=['DELETE'])
+@login_required
 def delete_device(device_id):
     conn = get_db()
     cursor = conn.cursor()
+    device = conn.execute("SELECT mac_address FROM devices WHERE id = ?", (device_id,)).fetchone()
 
     # Primero borramos logs asociados
     cursor.execute("DELETE FROM alarms WHERE device_id = ?", (device_id,))
-    cursor.execute("DELETE FROM commands WHERE device_id = ?", (device_id,))
+    cursor.execute("DELETE FROM device_commands WHERE device_id = ?", (device_id,))
+    cursor.execute("DELETE FROM telemetry_blocks WHERE device_id = ?", (device_id,))
+    cursor.execute("DELETE FROM download_slots WHERE device_id = ?", (device_id,))
     
     # Después borramos el dispositivo
     cursor.execute("DELETE FROM devices WHERE id = ?", (device_id,))
+    if device:
+        device_cache.invalidate(conn, device['mac_address'])
+        publish_event(conn, 'device_removed', {'id': device_id, 'mac_address': device['mac_address']})
     conn.commit()
-    conn.close()
 
     return jsonify({"success": True})
 
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Heartbeat throughput benchmark for Pilly Cloud.
+
+Runs /api/esp32/heartbeat in-process against a throw-away database twice:
+once with one plain sqlite3 connection per request (DB_POOL=0, the old
+behaviour) and once with the pooled WAL connections.
+
+    python bench_heartbeat.py --devices 500 --requests 5000 --threads 4
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import app as pilly
+
+
+def setup_database(path, devices):
+    pilly.app.config['DATABASE'] = path
+    pilly.init_db()
+    client = pilly.app.test_client()
+    fleet = []
+    for i in range(devices):
+        mac = '24:0A:C4:%02X:%02X:%02X' % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+        res = client.post('/api/esp32/register', json={
+            'mac_address': mac,
+            'ip_address': '10.0.0.%d' % (i % 250 + 1),
+            'firmware_version': '1.0.0',
+        })
+        fleet.append((mac, res.get_json()['api_key']))
+    return fleet
+
+
+def run(fleet, total, threads):
+    per_thread = total // threads
+    errors = []
+
+    def worker(offset):
+        client = pilly.app.test_client()
+        for n in range(per_thread):
+            mac, key = fleet[(offset + n) % len(fleet)]
+            res = client.post('/api/esp32/heartbeat', json={
+                'mac_address': mac, 'uptime': n, 'free_heap': 200000,
+            }, headers={'X-API-Key': key})
+            if res.status_code != 200:
+                errors.append(res.status_code)
+
+    workers = [threading.Thread(target=worker, args=(i * per_thread,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return per_thread * threads / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    results = {}
+    for label, pooled in (('per-request connect', False), ('pooled WAL', True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            pilly.app.config['DB_POOL'] = pooled
+            fleet = setup_database(os.path.join(tmp, 'bench.db'), args.devices)
+            results[label] = run(fleet, args.requests, args.threads)
+
+    for label, (rate, errors) in results.items():
+        print(f"{label:>20}: {rate:8.1f} heartbeats/s  ({errors} errors)")
+    before, after = results['per-request connect'][0], results['pooled WAL'][0]
+    print(f"{'speedup':>20}: {after / before:8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+JSON vs CBOR device protocol benchmark for Pilly Cloud.
+
+Measures payload size and the cost of parsing each request and serializing each
+response the way the device endpoints do (json module / app.py's CBOR codec with
+the integer key map), then runs real heartbeats in both formats in-process.
+
+    python bench_protocol.py --iterations 20000 --requests 3000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import app as pilly
+
+MAC = '24:0A:C4:12:34:56'
+
+REQUESTS = {
+    'heartbeat': {'mac_address': MAC, 'uptime': 86400, 'free_heap': 183244,
+                  'ip_address': '192.168.1.47', 'ssid': 'Casa-2.4G', 'firmware_version': '1.4.2'},
+    'alarm': {'mac_address': MAC, 'alarm_type': 'dose_missed', 'message': 'Slot 3', 'severity': 'warning'},
+    'check_update': {'mac_address': MAC, 'current_version': '1.4.2'},
+}
+RESPONSES = {
+    'heartbeat': {'success': True, 'command': None},
+    'alarm': {'success': True},
+    'check_update': {'update_available': True, 'version': '1.5.0',
+                     'url': 'https://pilly.example.com/api/esp32/firmware/1.5.0', 'size': 1489920,
+                     'sha256': '9f2c3b6a0d7e4f1a8b5c2d9e6f3a0b7c4d1e8f5a2b9c6d3e0f7a4b1c8d5e2f9a'},
+}
+
+
+def per_op(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def codec_table(iterations):
+    print(f"{'':>22} {'bytes':>7} {'parse µs':>10} {'build µs':>10}")
+    for name, payload in REQUESTS.items():
+        as_json = json.dumps(payload).encode()
+        as_cbor = pilly.cbor_dumps(pilly.encode_device_cbor(payload))
+        rows = (
+            ('json', as_json, lambda: json.loads(as_json), lambda: json.dumps(payload).encode()),
+            ('cbor', as_cbor, lambda: pilly.decode_device_cbor(pilly.cbor_loads(as_cbor)),
+             lambda: pilly.cbor_dumps(pilly.encode_device_cbor(payload))),
+        )
+        for label, raw, parse, build in rows:
+            print(f"{name + ' request ' + label:>22} {len(raw):>7} "
+                  f"{per_op(parse, iterations):>10.2f} {per_op(build, iterations):>10.2f}")
+    for name, payload in RESPONSES.items():
+        as_json = json.dumps(payload).encode()
+        as_cbor = pilly.cbor_dumps(pilly.encode_device_cbor(payload))
+        print(f"{name + ' reply json':>22} {len(as_json):>7} {per_op(lambda: json.loads(as_json), iterations):>10.2f} "
+              f"{per_op(lambda: json.dumps(payload).encode(), iterations):>10.2f}")
+        print(f"{name + ' reply cbor':>22} {len(as_cbor):>7} "
+              f"{per_op(lambda: pilly.cbor_loads(as_cbor), iterations):>10.2f} "
+              f"{per_op(lambda: pilly.cbor_dumps(pilly.encode_device_cbor(payload)), iterations):>10.2f}")
+
+
+def endpoint_rate(requests):
+    with tempfile.TemporaryDirectory() as tmp:
+        pilly.app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        pilly.init_db()
+        client = pilly.app.test_client()
+        api_key = client.post('/api/esp32/register', json={
+            'mac_address': MAC, 'ip_address': '192.168.1.47', 'firmware_version': '1.4.2',
+        }).get_json()['api_key']
+        payload = REQUESTS['heartbeat']
+        bodies = {
+            'json': (json.dumps(payload).encode(), 'application/json'),
+            'cbor': (pilly.cbor_dumps(pilly.encode_device_cbor(payload)), pilly.CBOR_MIMETYPE),
+        }
+        for label, (body, content_type) in bodies.items():
+            started = time.perf_counter()
+            for _ in range(requests):
+                res = client.post('/api/esp32/heartbeat', data=body, content_type=content_type,
+                                  headers={'X-API-Key': api_key})
+                assert res.status_code == 200, res.data
+            rate = requests / (time.perf_counter() - started)
+            print(f"{'heartbeat ' + label:>22}: {rate:8.1f} req/s  ({len(body)} B in, {len(res.data)} B out)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=3000)
+    args = parser.parse_args()
+    codec_table(args.iterations)
+    print()
+    endpoint_rate(args.requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Query-plan regression check for Pilly Cloud.
+
+Collects the SQL statements app.py runs, runs EXPLAIN QUERY PLAN for each
+one against a seeded database and exits non-zero if any of them falls back
+to a full table scan. Statements come from three places:
+
+- string literals (and module-level string constants) passed to
+  execute()/executemany() in app.py;
+- every statement the app actually runs while `exercise()` drives the panel
+  API, the device API and the leader jobs through the Flask test client, so
+  SQL built at runtime (f-strings, IN lists, filters) is checked as well;
+- EXTRA_QUERIES, for SQL that neither of those reaches (retention.py).
+
+A new query built at runtime is covered once `exercise()` calls its endpoint
+or job; add the request there. List it in EXTRA_QUERIES only if it cannot be
+reached through the app. A scan that is fine goes in ALLOWED_SCANS with the
+reason. tests/test_query_plans.py runs the same check on a small fleet.
+
+    python check_query_plans.py                      # 100k devices / 10M alarms
+    python check_query_plans.py --alarms 200000      # quicker local run
+    python check_query_plans.py --database big.db --no-seed
+"""
+
+import argparse
+import ast
+import contextlib
+import io
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+APP_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+# Statements the app never runs during exercise(), in a representative shape.
+EXTRA_QUERIES = (
+    # retention.py
+    "SELECT * FROM alarms WHERE severity = ? AND created_at < ? ORDER BY created_at, id LIMIT ?",
+    "SELECT * FROM alarms WHERE severity IS NULL AND created_at < ? ORDER BY created_at, id LIMIT ?",
+    "SELECT * FROM logs WHERE created_at < ? ORDER BY created_at, id LIMIT ?",
+    "WITH RECURSIVE s(severity) AS (SELECT MIN(severity) FROM alarms UNION ALL "
+    "SELECT (SELECT MIN(severity) FROM alarms WHERE severity > s.severity) FROM s WHERE s.severity IS NOT NULL) "
+    "SELECT severity FROM s WHERE severity IS NOT NULL",
+)
+
+# Full scans that are expected, with the reason.
+ALLOWED_SCANS = {
+    "WHERE api_key IS NULL OR api_key = ''": 'one-off migration in init_db',
+    "FROM firmwares WHERE sha256 IS NULL": 'one-off backfill in init_db',
+    "FROM fleet_counters WHERE": 'four-row table, a scan is what the planner picks',
+    "FROM command_campaigns ORDER BY id DESC LIMIT": 'walks the rowid backwards, stops after the page',
+    "FROM rollouts ORDER BY id DESC LIMIT": 'walks the rowid backwards, stops after the page',
+    "FROM download_slots s JOIN devices d": 'holds at most OTA_MAX_DOWNLOADS rows',
+    "SELECT version, filename, file_size, sha256 FROM firmwares": 'FirmwareIndex load, only after a release change',
+    "SELECT from_version, to_version, filename, file_size, sha256 FROM firmware_deltas": 'FirmwareIndex load, only after a release change',
+    "WITH RECURSIVE s(severity)": 'retention.py: scans its own CTE, one index seek per severity',
+}
+
+SKIP_PREFIXES = ('PRAGMA', 'CREATE', 'ALTER', 'DROP', 'BEGIN', 'COMMIT', 'ROLLBACK', 'ANALYZE', 'VACUUM')
+
+
+def collect_queries(path=APP_SOURCE):
+    """Return (lineno, sql) for every literal SQL statement executed by app.py."""
+    with open(path, encoding='utf-8') as fh:
+        tree = ast.parse(fh.read(), path)
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) \
+                and isinstance(node.value.value, str):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+
+    queries = []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr in ('execute', 'executemany') and node.args):
+            continue
+        arg = node.args[0]
+        if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+            sql = arg.value
+        elif isinstance(arg, ast.Name) and arg.id in constants:
+            sql = constants[arg.id]
+        else:
+            continue  # f-strings / dynamic SQL: list a representative shape in EXTRA_QUERIES
+        queries.append((node.lineno, sql))
+    queries.sort()
+    queries.extend((0, sql) for sql in EXTRA_QUERIES)
+    return queries
+
+
+def normalize(sql):
+    return ' '.join(sql.split())
+
+
+def seed(db, devices, alarms, verbose=True):
+    started = time.perf_counter()
+    db.execute('''
+        WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < ?)
+        INSERT INTO devices (mac_address, device_name, ip_address, firmware_version, last_seen,
+                             status, api_key, admin_state, ota_enabled)
+        SELECT printf('24:0A:C4:%02X:%02X:%02X', (x >> 16) & 255, (x >> 8) & 255, x & 255),
+               'Pilly ' || x, '10.0.0.1', '1.0.' || (x % 20),
+               datetime('now', '-' || (x % 86400) || ' seconds'),
+               CASE WHEN x % 3 THEN 'online' ELSE 'offline' END,
+               hex(randomblob(16)), 'active', x % 2
+        FROM n
+    ''', (devices,))
+    db.execute('''
+        WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < ?)
+        INSERT INTO alarms (device_id, alarm_type, message, severity, created_at)
+        SELECT x % ? + 1, 'dose_taken', 'seeded', CASE x % 3 WHEN 0 THEN 'info' WHEN 1 THEN 'warning' ELSE 'error' END,
+               datetime('now', '-' || (x % 7776000) || ' seconds')
+        FROM n
+    ''', (alarms, devices))
+    db.execute('''
+        WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < ?)
+        INSERT INTO device_commands (device_id, command, status)
+        SELECT x, 'restart', CASE WHEN x % 10 THEN 'sent' ELSE 'pending' END FROM n
+    ''', (devices,))
+    db.execute('''
+        WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 50)
+        INSERT INTO firmwares (version, filename, file_size, is_stable)
+        SELECT '1.0.' || x, '1.0.' || x || '.bin', 1500000, x % 5 = 0 FROM n
+    ''')
+    db.commit()
+    db.execute('ANALYZE')
+    db.commit()
+    if verbose:
+        print(f"Seeded {devices:,} devices / {alarms:,} alarms in {time.perf_counter() - started:.1f}s")
+
+
+def full_scans(db, sql):
+    params = [None] * sql.count('?')
+    names = re.findall(r'(?<!:):([A-Za-z_]\w*)', sql)
+    if names:
+        params = {name: None for name in names}
+    plan = db.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    return [row[3] for row in plan
+            if row[3].startswith('SCAN ') and ' USING ' not in row[3]
+            and not row[3].startswith(('SCAN CONSTANT ROW', 'SCAN json_each'))]  # json_each: the bound list
+
+
+def exercise(pilly):
+    """Drive the panel API, the device API and the leader jobs once through the test client."""
+    with tempfile.TemporaryDirectory() as uploads:
+        folder = pilly.app.config['UPLOAD_FOLDER']
+        pilly.app.config['UPLOAD_FOLDER'] = uploads
+        try:
+            _exercise(pilly, uploads)
+        finally:
+            # delta builds run in threads; let them finish before their folder goes away
+            for thread in threading.enumerate():
+                if thread.name.startswith('delta-'):
+                    thread.join()
+            pilly.app.config['UPLOAD_FOLDER'] = folder
+
+
+def _exercise(pilly, uploads):
+    db = sqlite3.connect(pilly.app.config['DATABASE'])  # not an app connection: not traced
+    for filename, in db.execute('SELECT filename FROM firmwares'):
+        with open(os.path.join(uploads, filename), 'wb') as fh:
+            fh.write(os.urandom(64) * 8)
+    db.close()
+
+    client = pilly.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['username'] = 'admin'
+
+    mac = 'AA:BB:CC:00:00:01'
+    registered = client.post('/api/esp32/register', json={
+        'mac_address': mac, 'ip_address': '10.0.0.2', 'firmware_version': '1.0.1'}).get_json()
+    api_key = registered['api_key']
+    device = {'X-API-Key': api_key}
+    client.post('/api/esp32/heartbeat', json={'mac_address': mac, 'uptime': 60, 'free_heap': 180000},
+                headers=device)
+    client.post('/api/esp32/check_update', json={'mac_address': mac, 'current_version': '1.0.1'}, headers=device)
+    client.post('/api/esp32/alarm', json={'mac_address': mac, 'alarm_type': 'dose_missed', 'severity': 'warning'},
+                headers=device)
+    client.post('/api/esp32/alarm', json={'mac_address': mac, 'alarm_type': 'dose_missed', 'severity': 'warning'},
+                headers=device)
+    client.post('/api/esp32/alarms/batch', json={'mac_address': mac, 'alarms': [
+        {'alarm_type': 'dose_taken', 'age': 30}, {'alarm_type': 'lid_open', 'severity': 'info'}]}, headers=device)
+
+    device_id = client.post('/api/devices', json={'mac_address': 'AA:BB:CC:00:00:02'}).get_json()['device_id']
+    client.post('/api/devices/bulk', data='mac_address,device_name\nAA:BB:CC:00:00:03,bulk\n24:0A:C4:00:00:01,dup\n',
+                content_type='text/csv')
+    client.post(f'/api/devices/{device_id}/set_state', json={'state': 'suspended'})
+    client.post(f'/api/devices/{device_id}/rotate_key')
+    client.post(f'/api/devices/{device_id}/ota', json={'ota_enabled': True})
+    client.post('/api/devices/rotate_keys', json={'ids': [device_id]})
+    client.post('/api/devices/rotate_keys', json={'status': 'offline', 'firmware_version': '1.0.3'})
+    client.post('/api/devices/1/command', json={'command': 'restart'})
+    campaign = client.post('/api/commands/fanout', json={
+        'command': 'restart', 'firmware_version': '1.0.3', 'status': 'online'}).get_json()
+    client.get(f"/api/commands/campaigns/{campaign.get('campaign_id', 1)}")
+    client.post(f"/api/devices/{registered['device_id']}/command", json={'command': 'restart'})
+    command = client.get(f'/api/esp32/command/{mac}', headers=device).get_json()['command'] or {}
+    client.post(f'/api/esp32/command/{mac}/ack', json={'id': command.get('id', 0)}, headers=device)
+    release = client.post('/api/releases/upload', data={
+        'version': '2.0.0', 'file': (io.BytesIO(os.urandom(512)), '2.0.0.bin')}).get_json()
+    client.post(f"/api/releases/{release.get('id', 0)}/stable", json={'stable': True})
+    client.delete(f"/api/releases/{release.get('id', 0)}")
+    client.post('/api/rollouts', json={'version': '1.0.1', 'waves': '10,100'})
+    offer = client.post('/api/esp32/check_update', json={'mac_address': mac, 'current_version': '1.0.0'},
+                        headers=device).get_json()
+    for key in ('url', 'delta_url'):
+        if offer.get(key):
+            client.get(urlsplit(offer[key])._replace(scheme='', netloc='').geturl())
+    client.get('/api/esp32/firmware/1.0.1')
+    client.get('/api/rollouts/1')
+    client.post('/api/rollouts/1/state', json={'state': 'paused'})
+
+    for url in ('/api/dashboard/stats', '/api/devices/1', '/api/devices/1/telemetry',
+                '/api/devices/1/telemetry?step=30', '/api/commands/campaigns', '/api/releases/list',
+                '/api/rollouts', '/api/admin/cache', '/api/admin/background',
+                '/api/devices/list?status=online&firmware_version=1.0.3', '/api/devices/list?ids=1,2,3',
+                # nothing seen matches: goes on to the never-seen tail
+                '/api/devices/list?firmware_version=none',
+                '/api/devices/list?cursor=' + pilly.encode_cursor(None, 10 ** 9),
+                '/api/alarms/list?severity=error', '/api/alarms/list?fields=id,device_name',
+                '/api/alarms/list?device_id=1&from=2000-01-01T00:00:00Z&to=2100-01-01T00:00:00Z'):
+        client.get(url)
+    for url in ('/api/devices/list?limit=5', '/api/alarms/list?limit=5', '/api/alarms/list?limit=5&severity=info'):
+        page = client.get(url).get_json()
+        if page.get('next_cursor'):
+            client.get(f"{url}&cursor={page['next_cursor']}")
+
+    pilly.heartbeat_buffer.flush()
+    pilly.telemetry_buffer.flush(force=True)
+    pilly.alarm_gate.flush()
+    for job in (pilly.offline_sweeper, pilly.telemetry_rollup, pilly.ota_rollouts):
+        job.run_once()
+    client.delete(f'/api/devices/{device_id}')
+
+
+@contextlib.contextmanager
+def traced_statements(pilly):
+    """Collect every distinct statement the app's connections run inside the block."""
+    seen = {}
+
+    def trace(sql):
+        if not sql.startswith('--'):  # trigger bodies
+            seen.setdefault(pilly.normalize_sql(sql), sql)
+
+    install_sql_trace = pilly.install_sql_trace
+
+    def traced(db):
+        db.set_trace_callback(trace)
+        return install_sql_trace(db)
+
+    # every app connection (pooled, per request, background threads) goes through it
+    pilly.install_sql_trace = traced
+    try:
+        yield seen
+    finally:
+        pilly.install_sql_trace = install_sql_trace
+
+
+def run(database, devices, alarms, seed_db=True, verbose=True):
+    """Seed, exercise and check; return the [(where, sql, scans)] that scan unexpectedly."""
+    import app as pilly
+
+    pilly.app.config['DATABASE'] = database
+    db = sqlite3.connect(database)
+    with traced_statements(pilly) as traced:
+        pilly.init_db()
+        if seed_db:
+            seed(db, devices, alarms, verbose)
+        exercise(pilly)
+    queries = collect_queries() + [(0, sql) for sql in traced.values()]
+
+    failures, checked = [], set()
+    for lineno, sql in queries:
+        text = normalize(sql)
+        if text.split(' ', 1)[0].upper() in SKIP_PREFIXES or text in checked:
+            continue
+        checked.add(text)
+        where = f'app.py:{lineno}' if lineno else 'traced'
+        scans = full_scans(db, sql)
+        allowed = next((why for pattern, why in ALLOWED_SCANS.items() if pattern in text), None)
+        if scans and not allowed:
+            failures.append((where, text, scans))
+            if verbose:
+                print(f"FAIL {where}: {text}")
+                for detail in scans:
+                    print(f"       {detail}")
+        elif verbose and scans:
+            print(f"skip {where}: {text[:80]} ({allowed})")
+        elif verbose:
+            print(f"  ok {where}: {text[:100]}")
+    db.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fail if any app.py query does a full table scan.')
+    parser.add_argument('--database', help='database file to use (default: a temporary one); '
+                        'exercise() adds a few devices and releases to it')
+    parser.add_argument('--devices', type=int, default=100_000)
+    parser.add_argument('--alarms', type=int, default=10_000_000)
+    parser.add_argument('--no-seed', action='store_true', help='use --database as it is')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.database or os.path.join(tmp, 'plans.db')
+        failures = len(run(path, args.devices, args.alarms, seed_db=not args.no_seed))
+    print(f"\n{failures} quer{'y' if failures == 1 else 'ies'} with full table scans")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
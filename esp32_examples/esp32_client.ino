@@ -235,6 +235,8 @@ void sendAlarm(String alarmType, String message, String severity) {
 // ============================================
 // OTA UPDATE
 // ============================================
+String updateEtag = "";  // token of the last check_update answer
+
 void checkForUpdates() {
   if (WiFi.status() != WL_CONNECTED) return;
   
@@ -248,13 +250,16 @@ void checkForUpdates() {
   StaticJsonDocument<256> doc;
   doc["mac_address"] = macAddress;
   doc["current_version"] = FIRMWARE_VERSION;
+  if (updateEtag.length()) doc["etag"] = updateEtag;
   
   String payload;
   serializeJson(doc, payload);
   
   int httpCode = http.POST(payload);
   
-  if (httpCode == HTTP_CODE_OK) {
+  if (httpCode == HTTP_CODE_NOT_MODIFIED) {
+    Serial.println("Firmware is up to date (unchanged)");
+  } else if (httpCode == HTTP_CODE_OK) {
     String response = http.getString();
     
     StaticJsonDocument<512> responseDoc;
@@ -262,6 +267,7 @@ void checkForUpdates() {
     
     if (!error) {
       bool updateAvailable = responseDoc["update_available"];
+      updateEtag = responseDoc["etag"] | "";
       
       if (updateAvailable) {
         String newVersion = responseDoc["version"];
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Async (ASGI) gateway for the device API of Pilly Cloud.
+
+    uvicorn gateway:app --host 0.0.0.0 --port 8001 --timeout-keep-alive 75
+
+Serves /api/esp32/* for many slow devices. Request bodies are read and responses
+written on the event loop, so an idle keep-alive connection or a slow cellular
+upload costs a coroutine, not a worker thread. The endpoints themselves are
+app.py's, run on a bounded thread pool (GATEWAY_THREADS) that does all the
+database work, so auth, schema and responses are exactly the ones gunicorn
+serves. Firmware images are streamed from that pool in GATEWAY_CHUNK_SIZE reads,
+and `?wait=` command long-polls park on the event loop instead of a thread.
+The dashboard stays on gunicorn.
+"""
+
+import asyncio
+import io
+import json
+import math
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+from werkzeug.wsgi import FileWrapper
+
+import app as pilly
+
+GATEWAY_THREADS = int(os.environ.get('GATEWAY_THREADS', 32))
+GATEWAY_CHUNK_SIZE = int(os.environ.get('GATEWAY_CHUNK_SIZE', 64 * 1024))
+
+DEVICE_PREFIX = '/api/esp32/'
+COMMAND_PREFIX = '/api/esp32/command/'
+
+executor = ThreadPoolExecutor(GATEWAY_THREADS, thread_name_prefix='gateway')
+
+
+def wsgi_environ(scope, body, query_string=None):
+    """WSGI environ for an ASGI http scope whose body has already been read."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': (scope['query_string'] if query_string is None else query_string).decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'gateway.streamed': False,
+    }
+
+    def file_wrapper(file, buffer_size=8192):
+        environ['gateway.streamed'] = True
+        return FileWrapper(file, GATEWAY_CHUNK_SIZE)
+
+    environ['wsgi.file_wrapper'] = file_wrapper
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def call_app(environ):
+    """Run the Flask app for one request (on the pool).
+
+    Returns (status, headers, body): body is bytes, or for files sent through
+    wsgi.file_wrapper the still unread iterable, streamed by `send_response`.
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    body = pilly.app(environ, start_response)
+    if environ['gateway.streamed']:
+        return started['status'], started['headers'], body
+    try:
+        return started['status'], started['headers'], b''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def run(func, *args):
+    return asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def send_response(send, status, headers, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    if isinstance(body, bytes):
+        await send({'type': 'http.response.body', 'body': body})
+        return
+    chunks = iter(body)
+    try:
+        while True:
+            chunk = await run(next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                # waits for the socket to drain, so a slow client only slows itself
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(body, 'close'):
+            await run(body.close)
+
+
+async def send_json(send, status, payload):
+    await send_response(send, status, [('Content-Type', 'application/json')],
+                        json.dumps(payload).encode())
+
+
+async def read_body(receive, limit):
+    """Whole request body; None if the client went away, False once it passes `limit`."""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return False
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+class AsyncWake:
+    """CommandWaiters waiter for a coroutine: set() may be called from any thread."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+def device_wait_info(mac):
+    with pilly.app.app_context():
+        db = pilly.get_db()
+        row = db.execute(pilly.DEVICE_BY_MAC_SQL, (mac, mac)).fetchone()
+        return (row['id'], pilly.event_head(db)) if row else (None, 0)
+
+
+async def command_long_poll(scope, send, query, wait):
+    """GET /api/esp32/command/<mac>?wait=N without holding a thread while parked.
+
+    Each look is the regular endpoint without `wait`; in between the request waits on
+    the same command events the threaded long-poll uses.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    query_string = urlencode([(k, v) for k, v in query if k != 'wait']).encode()
+    device_id, since = await run(device_wait_info, scope['path'][len(COMMAND_PREFIX):])
+    waiter = None
+    if device_id is not None:
+        # registered before the first look, so a command queued in between still wakes us
+        waiter = AsyncWake(loop)
+        pilly.command_waiters.register(device_id, since, waiter)
+    try:
+        while True:
+            status, headers, body = await run(call_app, wsgi_environ(scope, b'', query_string))
+            remaining = deadline - loop.time()
+            if waiter is None or status != 200 or remaining <= 0 \
+                    or json.loads(body).get('command') is not None:
+                return await send_response(send, status, headers, body)
+            try:
+                await asyncio.wait_for(waiter.event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            waiter.event.clear()
+    finally:
+        if waiter is not None:
+            pilly.command_waiters.unregister(device_id, waiter)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # write what the buffers hold before the process goes
+            await run(pilly.heartbeat_buffer.flush)
+            await run(pilly.telemetry_buffer.flush, True)
+            await run(pilly.alarm_gate.flush)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    if not scope['path'].startswith(DEVICE_PREFIX):
+        return await send_json(send, 404, {'error': 'Not found'})
+
+    limit = pilly.app.config['MAX_CONTENT_LENGTH']
+    length = dict(scope['headers']).get(b'content-length')
+    if length and length.isdigit() and int(length) > limit:
+        return await send_json(send, 413, {'error': 'Payload too large'})
+    body = await read_body(receive, limit)
+    if body is None:
+        return
+    if body is False:
+        return await send_json(send, 413, {'error': 'Payload too large'})
+
+    if scope['method'] == 'GET' and scope['path'].startswith(COMMAND_PREFIX):
+        query = parse_qsl(scope['query_string'].decode('latin-1'))
+        try:
+            wait = float(dict(query).get('wait') or 0)
+        except ValueError:
+            wait = 0
+        wait = min(max(wait, 0), pilly.app.config['COMMAND_WAIT_MAX']) if math.isfinite(wait) else 0
+        if wait:
+            return await command_long_poll(scope, send, query, wait)
+
+    status, headers, response = await run(call_app, wsgi_environ(scope, body))
+    await send_response(send, status, headers, response)
@@ -8,6 +8,9 @@ import os
 import sqlite3
 from werkzeug.security import generate_password_hash
 
+# one definition of the indexes and counter triggers, shared with the app's init_db()
+from app import COUNTER_TRIGGERS, INDEXES
+
 DATABASE = 'database/esp32_management.db'
 
 def init_database():
@@ -18,6 +21,7 @@ def init_database():
 
     print(f"Creating new database: {DATABASE}")
     db = sqlite3.connect(DATABASE)
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')  # lets retention.py shrink the file
     cursor = db.cursor()
 
     print("Creating users table...")
@@ -60,7 +64,8 @@ def init_database():
             description TEXT,
             file_size INTEGER,
             uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_stable INTEGER DEFAULT 0
+            is_stable INTEGER DEFAULT 0,
+            sha256 TEXT
         )
     ''')
 
@@ -73,6 +78,8 @@ def init_database():
             message TEXT,
             severity TEXT DEFAULT 'info',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            occurrences INTEGER DEFAULT 1,
+            last_seen TIMESTAMP,
             FOREIGN KEY (device_id) REFERENCES devices (id)
         )
     ''')
@@ -100,10 +107,147 @@ def init_database():
             requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             sent_at TIMESTAMP,
             ack_at TIMESTAMP,
+            campaign_id INTEGER,
             FOREIGN KEY (device_id) REFERENCES devices (id)
         )
     ''')
 
+    print("Creating command_campaigns table...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS command_campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            command TEXT NOT NULL,
+            payload TEXT,
+            selector TEXT,
+            targets INTEGER NOT NULL DEFAULT 0,
+            created_by TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    print("Creating rollouts tables...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            version TEXT NOT NULL,
+            waves TEXT NOT NULL,
+            wave INTEGER NOT NULL DEFAULT 0,
+            wave_minutes REAL NOT NULL,
+            max_failure_rate REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'active',
+            reason TEXT,
+            updated INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            wave_updated INTEGER NOT NULL DEFAULT 0,
+            wave_failed INTEGER NOT NULL DEFAULT 0,
+            created_by TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            wave_started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS download_slots (
+            device_id INTEGER PRIMARY KEY,
+            token TEXT NOT NULL UNIQUE,
+            version TEXT NOT NULL,
+            rollout_id INTEGER,
+            issued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+
+    print("Creating firmware_deltas table...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS firmware_deltas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_version TEXT NOT NULL,
+            to_version TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            file_size INTEGER,
+            sha256 TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (from_version, to_version)
+        )
+    ''')
+
+    print("Creating firmware_uploads table...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS firmware_uploads (
+            id TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            description TEXT,
+            total_size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    print("Creating events table...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    print("Creating app_state table...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    print("Creating telemetry_blocks table...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS telemetry_blocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            resolution INTEGER NOT NULL,
+            block_start INTEGER NOT NULL,
+            block_end INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            rolled INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    print("Creating leases table...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            last_run_at TIMESTAMP,
+            last_run_ms REAL,
+            last_result TEXT
+        )
+    ''')
+
+    print("Creating dashboard counters...")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fleet_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS alarm_buckets (
+            bucket INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.executemany('INSERT INTO fleet_counters (name, value) VALUES (?, 0)',
+                       [('devices',), ('devices_online',), ('firmwares',), ('alarms',)])
+
+    print("Creating indexes...")
+    for sql in INDEXES:
+        cursor.execute(sql)
+    for sql in COUNTER_TRIGGERS:
+        cursor.execute(sql)
+
     print("Creating default admin user (admin/admin123)...")
     cursor.execute(
         'INSERT INTO users (username, password) VALUES (?, ?)',
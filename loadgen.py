@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+Virtual-fleet load generator for the Pilly Cloud device API.
+
+Simulates N pastilleros speaking the esp32_client.ino protocol: register at boot,
+a heartbeat every 30 s, check_update every 5 min (with its etag), the firmware
+download and a reboot when an update is offered, command polls (acked, a restart
+reboots), and alarms at random. Every device starts at a random point of its
+cycle and each interval has some jitter. `--scale` divides all intervals, so 500
+devices at --scale 10 offer the load of 5,000 real ones.
+
+    python loadgen.py --devices 500 --scale 10 --duration 60            # in-process, throw-away db
+    python loadgen.py --url http://127.0.0.1:5000 --devices 2000 --duration 300
+    python loadgen.py --save loadgen_baseline.json                       # record a baseline...
+    python loadgen.py --compare loadgen_baseline.json                    # ...and fail on regressions
+
+Reports throughput, p50/p95/p99 latency per endpoint, how late requests went out
+against their schedule (the fleet is bigger than the server can take once this
+grows) and SQLite "database is locked" errors (in-process only).
+"""
+
+import argparse
+import heapq
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+import app as pilly
+
+HEARTBEAT_INTERVAL = 30
+UPDATE_CHECK_INTERVAL = 300
+ENDPOINTS = ('register', 'heartbeat', 'check_update', 'firmware', 'command', 'command_ack', 'alarm')
+ALARMS = (('dose_taken', 'info'), ('dose_missed', 'warning'), ('low_battery', 'warning'), ('lid_open', 'info'))
+
+
+class InProcessTransport:
+    """The Flask app through its test client, exceptions surfaced to the caller."""
+
+    def __init__(self):
+        self.client = pilly.app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        res = self.client.open(path, method=method, data=body, headers=headers or {},
+                               content_type='application/json' if body is not None else None)
+        return res.status_code, res.get_data()
+
+
+class HttpTransport:
+    """One keep-alive HTTP/1.1 connection per worker thread."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                res = self.conn.getresponse()
+                return res.status, res.read()
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+
+class LockErrorCounter(logging.Handler):
+    """Counts 'database is locked' errors logged by the app's background threads."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        exc = record.exc_info[1] if record.exc_info else None
+        if isinstance(exc, sqlite3.OperationalError) and 'locked' in str(exc):
+            self.count += 1
+
+
+class Device:
+    def __init__(self, index, version):
+        self.mac = '02:4C:47:%02X:%02X:%02X' % ((index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+        self.name = f'loadgen-{index}'
+        self.version = version
+        self.api_key = None
+        self.etag = None
+        self.booted = time.time()
+
+    def uptime(self):
+        return int(time.time() - self.booted)
+
+
+class Fleet:
+    """Scheduler shared by the worker threads: a heap of (due, seq, device, action)."""
+
+    def __init__(self, args, transport_factory):
+        self.args = args
+        self.transport_factory = transport_factory
+        self.rng = random.Random(args.seed)
+        self.devices = [Device(i, args.version) for i in range(args.devices)]
+        self.queue = []
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.stop_at = None
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.lag = []
+        self.lock_errors = 0
+        self.downloaded = 0
+
+    # -- scheduling --
+    def interval(self, seconds):
+        return seconds / self.args.scale * self.rng.uniform(1 - self.args.jitter, 1 + self.args.jitter)
+
+    def schedule(self, due, device, action):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.queue, (due, self.seq, device, action))
+            self.cond.notify()
+
+    def next_job(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if now >= self.stop_at:
+                    return None
+                if self.queue and self.queue[0][0] <= now:
+                    return heapq.heappop(self.queue)
+                wait = self.queue[0][0] - now if self.queue else self.stop_at - now
+                self.cond.wait(min(wait, self.stop_at - now))
+
+    # -- one request --
+    def call(self, transport, endpoint, method, path, body=None, device=None):
+        headers = {'X-API-Key': device.api_key} if device is not None and device.api_key else {}
+        started = time.perf_counter()
+        try:
+            status, data = transport.request(method, path, None if body is None else json.dumps(body), headers)
+        except sqlite3.OperationalError as exc:
+            status, data = ('locked' if 'locked' in str(exc) else 'sqlite'), b''
+            if status == 'locked':
+                with self.cond:
+                    self.lock_errors += 1
+        except Exception as exc:  # connection reset, app exception in-process...
+            status, data = type(exc).__name__, b''
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.cond:
+            self.latencies[endpoint].append(elapsed)
+            self.statuses[endpoint][status] += 1
+        return status, data
+
+    def json_reply(self, status, data):
+        if status != 200:
+            return {}
+        try:
+            return json.loads(data)
+        except ValueError:
+            return {}
+
+    # -- the device protocol --
+    def register(self, transport, device, now):
+        device.booted = time.time()
+        device.etag = None
+        status, data = self.call(transport, 'register', 'POST', '/api/esp32/register', {
+            'mac_address': device.mac, 'device_name': device.name, 'ip_address': '10.20.0.1',
+            'ssid': 'loadgen', 'firmware_version': device.version, 'uptime': 0, 'free_heap': 180000,
+        })
+        reply = self.json_reply(status, data)
+        if not reply.get('api_key'):
+            self.schedule(now + self.interval(HEARTBEAT_INTERVAL), device, 'register')
+            return
+        device.api_key = reply['api_key']
+        # like the sketch: heartbeat and update check run on their own timers from boot
+        self.schedule(now + self.interval(HEARTBEAT_INTERVAL), device, 'heartbeat')
+        self.schedule(now + self.rng.uniform(0, UPDATE_CHECK_INTERVAL / self.args.scale), device, 'check_update')
+        if self.args.command_interval:
+            self.schedule(now + self.interval(self.args.command_interval), device, 'command')
+        if self.args.alarm_rate:
+            self.schedule(now + self.next_alarm(), device, 'alarm')
+
+    def next_alarm(self):
+        return self.rng.expovariate(self.args.alarm_rate / 3600) / self.args.scale
+
+    def run_command(self, transport, device, command, now):
+        """Ack the command; a restart reboots (register again). True when the device rebooted."""
+        if not command or command.get('id') is None:
+            return False
+        self.call(transport, 'command_ack', 'POST', f'/api/esp32/command/{device.mac}/ack',
+                  {'id': command['id']}, device)
+        if command.get('command') == 'restart':
+            self.schedule(now + 1 / self.args.scale, device, 'register')
+            return True
+        return False
+
+    def heartbeat(self, transport, device, now):
+        status, data = self.call(transport, 'heartbeat', 'POST', '/api/esp32/heartbeat', {
+            'mac_address': device.mac, 'uptime': device.uptime(), 'free_heap': self.rng.randint(150000, 200000),
+        }, device)
+        if not self.run_command(transport, device, self.json_reply(status, data).get('command'), now):
+            self.schedule(now + self.interval(HEARTBEAT_INTERVAL), device, 'heartbeat')
+
+    def check_update(self, transport, device, now):
+        body = {'mac_address': device.mac, 'current_version': device.version}
+        if device.etag:
+            body['etag'] = device.etag
+        status, data = self.call(transport, 'check_update', 'POST', '/api/esp32/check_update', body, device)
+        reply = self.json_reply(status, data)
+        device.etag = reply.get('etag', device.etag)
+        next_check = self.interval(UPDATE_CHECK_INTERVAL)
+        if reply.get('reason') == 'busy':
+            next_check = reply.get('retry_after', UPDATE_CHECK_INTERVAL) / self.args.scale
+        elif reply.get('update_available'):
+            url = urlsplit(reply['url'])
+            status, image = self.call(transport, 'firmware', 'GET',
+                                      url.path + ('?' + url.query if url.query else ''), device=device)
+            if status == 200:
+                with self.cond:
+                    self.downloaded += len(image)
+                # flashed: reboot into the new version
+                device.version = reply['version']
+                self.schedule(now + 1 / self.args.scale, device, 'register')
+                return
+        self.schedule(now + next_check, device, 'check_update')
+
+    def command(self, transport, device, now):
+        status, data = self.call(transport, 'command', 'GET', f'/api/esp32/command/{device.mac}', device=device)
+        if not self.run_command(transport, device, self.json_reply(status, data).get('command'), now):
+            self.schedule(now + self.interval(self.args.command_interval), device, 'command')
+
+    def alarm(self, transport, device, now):
+        alarm_type, severity = self.rng.choice(ALARMS)
+        self.call(transport, 'alarm', 'POST', '/api/esp32/alarm', {
+            'mac_address': device.mac, 'alarm_type': alarm_type, 'message': 'loadgen', 'severity': severity,
+        }, device)
+        self.schedule(now + self.next_alarm(), device, 'alarm')
+
+    # -- running --
+    def worker(self):
+        transport = self.transport_factory()
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            due, _, device, action = job
+            now = time.monotonic()
+            with self.cond:
+                self.lag.append((now - due) * 1000)
+            if action in ('heartbeat', 'check_update', 'command', 'alarm') and device.api_key is None:
+                continue  # rebooting: these timers restart after register
+            getattr(self, action)(transport, device, now)
+
+    def run(self):
+        start = time.monotonic()
+        self.stop_at = start + self.args.duration
+        ramp = min(self.args.ramp, self.args.duration)
+        for device in self.devices:
+            self.schedule(start + self.rng.uniform(0, ramp), device, 'register')
+        threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(self.args.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - start
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(round(q * (len(values) - 1))))], 2)
+
+
+def summarize(fleet, elapsed, args):
+    endpoints = {}
+    for name in ENDPOINTS:
+        samples = fleet.latencies.get(name)
+        if not samples:
+            continue
+        statuses = fleet.statuses[name]
+        errors = sum(count for status, count in statuses.items() if status not in (200, 304))
+        endpoints[name] = {
+            'count': len(samples),
+            'rps': round(len(samples) / elapsed, 2),
+            'errors': errors,
+            'statuses': {str(status): count for status, count in statuses.items()},
+            'p50_ms': percentile(samples, 0.50),
+            'p95_ms': percentile(samples, 0.95),
+            'p99_ms': percentile(samples, 0.99),
+            'max_ms': round(max(samples), 2),
+        }
+    total = sum(item['count'] for item in endpoints.values())
+    return {
+        'scenario': {key: getattr(args, key) for key in
+                     ('devices', 'scale', 'duration', 'workers', 'command_interval', 'alarm_rate', 'seed')},
+        'target': args.url or 'in-process',
+        'environment': {
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+        },
+        'elapsed_s': round(elapsed, 2),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 2),
+        'equivalent_fleet': int(args.devices * args.scale),
+        'lag_ms': {'p50': percentile(fleet.lag, 0.50), 'p95': percentile(fleet.lag, 0.95),
+                   'p99': percentile(fleet.lag, 0.99)},
+        'lock_errors': fleet.lock_errors,
+        'downloaded_bytes': fleet.downloaded,
+        'endpoints': endpoints,
+    }
+
+
+def print_report(result):
+    print(f"\n{result['target']}: {result['scenario']['devices']} devices x{result['scenario']['scale']} "
+          f"(~{result['equivalent_fleet']:,} pastilleros) for {result['elapsed_s']}s")
+    print(f"{'endpoint':>14} {'count':>8} {'req/s':>8} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}")
+    for name, item in result['endpoints'].items():
+        print(f"{name:>14} {item['count']:>8} {item['rps']:>8.1f} {item['errors']:>7} {item['p50_ms']:>8.2f} "
+              f"{item['p95_ms']:>8.2f} {item['p99_ms']:>8.2f} {item['max_ms']:>8.2f}")
+    lag = result['lag_ms']
+    print(f"\nthroughput {result['throughput_rps']:.1f} req/s, schedule lag p50/p95/p99 "
+          f"{lag['p50']}/{lag['p95']}/{lag['p99']} ms, lock errors {result['lock_errors']}, "
+          f"firmware {result['downloaded_bytes'] / 1e6:.1f} MB")
+    if lag['p95'] is not None and lag['p95'] > 1000:
+        print('the workers fell behind the schedule: this fleet is more than the target can take')
+
+
+def compare(result, baseline, args):
+    """Print the changes against `baseline`; returns the regressions found.
+
+    An endpoint's p95 regresses when it grows by more than --tolerance and by more
+    than --min-delta ms; endpoints with fewer than --min-samples are only shown.
+    """
+    if baseline.get('scenario') != result['scenario']:
+        print(f"\nwarning: baseline scenario differs: {baseline.get('scenario')}")
+    regressions = []
+    print(f"\n{'endpoint':>14} {'p95 base':>9} {'p95 now':>9} {'change':>8}")
+    for name, item in result['endpoints'].items():
+        base = baseline.get('endpoints', {}).get(name)
+        if not base or not base.get('p95_ms'):
+            continue
+        change = item['p95_ms'] / base['p95_ms'] - 1
+        flag = ''
+        if change > args.tolerance and item['p95_ms'] - base['p95_ms'] > args.min_delta \
+                and item['count'] >= args.min_samples:
+            regressions.append(f'{name} p95 {base["p95_ms"]} -> {item["p95_ms"]} ms')
+            flag = '  REGRESSION'
+        print(f"{name:>14} {base['p95_ms']:>9.2f} {item['p95_ms']:>9.2f} {change:>+8.0%}{flag}")
+        if item['errors'] > base.get('errors', 0):
+            regressions.append(f"{name} errors {base.get('errors', 0)} -> {item['errors']}")
+    if result['throughput_rps'] < baseline.get('throughput_rps', 0) * (1 - args.tolerance):
+        regressions.append(f"throughput {baseline['throughput_rps']} -> {result['throughput_rps']} req/s")
+    if result['lock_errors'] > baseline.get('lock_errors', 0):
+        regressions.append(f"lock errors {baseline.get('lock_errors', 0)} -> {result['lock_errors']}")
+    for line in regressions:
+        print(f'REGRESSION: {line}')
+    return regressions
+
+
+def setup_in_process(tmp, args):
+    """Throw-away database with a stable release newer than the fleet's and OTA on for --ota of it."""
+    pilly.app.config.update(DATABASE=os.path.join(tmp, 'loadgen.db'), UPLOAD_FOLDER=tmp,
+                            PROPAGATE_EXCEPTIONS=True)
+    pilly.init_db()
+    release = args.version + '-new'
+    with open(os.path.join(tmp, f'{release}.bin'), 'wb') as fh:
+        fh.write(os.urandom(args.firmware_size))
+    with pilly.app.app_context():
+        db = pilly.get_db()
+        db.execute('''
+            INSERT INTO firmwares (version, filename, file_size, sha256, is_stable) VALUES (?, ?, ?, ?, 1)
+        ''', (release, f'{release}.bin', args.firmware_size, pilly.file_sha256(os.path.join(tmp, f'{release}.bin'))))
+        pilly.firmware_index.invalidate(db)
+        db.commit()
+
+
+def enable_ota(fleet, args):
+    """Pre-provision the in-process fleet so that --ota of it takes updates."""
+    rng = random.Random(args.seed)
+    with pilly.app.app_context():
+        db = pilly.get_db()
+        rows = [(d.mac, d.name, d.version, pilly.generate_api_key(), int(rng.random() < args.ota))
+                for d in fleet.devices]
+        db.executemany('''
+            INSERT INTO devices (mac_address, device_name, firmware_version, api_key, ota_enabled, status, admin_state)
+            VALUES (?, ?, ?, ?, ?, 'offline', 'active')
+        ''', rows)
+        pilly.device_cache.invalidate(db)
+        db.commit()
+
+
+def report(fleet, elapsed, args):
+    result = summarize(fleet, elapsed, args)
+    print_report(result)
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(result, fh, indent=2, sort_keys=True)
+            fh.write('\n')
+        print(f'saved {args.save}')
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        return 1 if compare(result, baseline, args) else 0
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='target server, e.g. http://127.0.0.1:5000 (default: in-process)')
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--scale', type=float, default=10, help='divide every interval by this')
+    parser.add_argument('--duration', type=float, default=60, help='seconds')
+    parser.add_argument('--ramp', type=float, default=HEARTBEAT_INTERVAL / 10, help='seconds over which devices boot')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent requests')
+    parser.add_argument('--jitter', type=float, default=0.1, help='+/- fraction on every interval')
+    parser.add_argument('--command-interval', type=float, default=60, help='command poll period, 0 = off')
+    parser.add_argument('--alarm-rate', type=float, default=2, help='alarms per device per hour')
+    parser.add_argument('--version', default='1.0.0', help='firmware the fleet boots with')
+    parser.add_argument('--ota', type=float, default=0.05, help='in-process: fraction of devices with OTA on')
+    parser.add_argument('--firmware-size', type=int, default=1024 * 1024, help='in-process: release size')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON (a baseline)')
+    parser.add_argument('--compare', metavar='FILE', help='compare with a saved baseline, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 / throughput change')
+    parser.add_argument('--min-delta', type=float, default=1.0, help='ms of p95 growth ignored as noise')
+    parser.add_argument('--min-samples', type=int, default=50, help='endpoints with fewer samples are not judged')
+    args = parser.parse_args()
+
+    tmp = None
+    if args.url:
+        transport_factory = lambda: HttpTransport(args.url)
+    else:
+        tmp = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
+        setup_in_process(tmp.name, args)
+        transport_factory = InProcessTransport
+    lock_handler = LockErrorCounter()
+    pilly.app.logger.addHandler(lock_handler)
+
+    fleet = Fleet(args, transport_factory)
+    if not args.url:
+        enable_ota(fleet, args)
+    elapsed = fleet.run()
+    fleet.lock_errors += lock_handler.count
+    try:
+        return report(fleet, elapsed, args)
+    finally:
+        if tmp is not None:
+            # the app's background jobs keep ticking: remove their database last thing
+            pilly.heartbeat_buffer.flush()
+            pilly.telemetry_buffer.flush(True)
+            pilly.alarm_gate.flush()
+            # write the metrics snapshot now; the writer thread may still fire during the
+            # cleanup, hence ignore_cleanup_errors
+            pilly.request_metrics.write()
+            tmp.cleanup()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
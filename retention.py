@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Alarm and log retention for Pilly Cloud.
+
+Rows older than their retention period are appended to gzip'd NDJSON archives,
+one file per table and day (archive/alarms/2024/05/alarms-2024-05-01.ndjson.gz),
+then deleted in small transactions so heartbeats keep writing in between, and
+the freed pages are returned to the filesystem with an incremental vacuum.
+
+    python retention.py                                  # one run with the configured policies
+    python retention.py --dry-run                        # only count what would be purged
+    python retention.py --schedule                       # run every RETENTION_INTERVAL_HOURS
+    python retention.py --alarms "info=7,warning=30,*=365" --logs 14
+    python retention.py --enable-incremental-vacuum      # one-off, for databases created before
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import app as pilly
+
+# severity=days; "*" covers every other severity, 0 keeps rows forever
+ALARM_RETENTION = os.environ.get('ALARM_RETENTION', 'info=30,warning=90,error=365,*=180')
+LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', 30))
+ARCHIVE_FOLDER = os.environ.get('ARCHIVE_FOLDER', 'archive')
+RETENTION_BATCH = int(os.environ.get('RETENTION_BATCH', 2000))
+RETENTION_INTERVAL_HOURS = float(os.environ.get('RETENTION_INTERVAL_HOURS', 24))
+
+# Distinct severities through the (severity, created_at) index, one seek per value
+SEVERITIES_SQL = '''
+    WITH RECURSIVE s(severity) AS (
+        SELECT MIN(severity) FROM alarms
+        UNION ALL
+        SELECT (SELECT MIN(severity) FROM alarms WHERE severity > s.severity) FROM s
+        WHERE s.severity IS NOT NULL
+    )
+    SELECT severity FROM s WHERE severity IS NOT NULL
+'''
+
+
+def parse_policy(text):
+    policy = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        severity, _, days = item.partition('=')
+        if not days.strip().isdigit():
+            raise ValueError(f'Invalid retention policy entry: {item!r}')
+        policy[severity.strip().lower()] = int(days)
+    policy.setdefault('*', 0)
+    return policy
+
+
+def cutoff(days, now):
+    return (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def write_archive(folder, table, rows):
+    """Append rows to their day's archive; fsync'd before the caller deletes them."""
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(str(row['created_at'])[:10], []).append(row)
+    for day, day_rows in by_day.items():
+        path = os.path.join(folder, table, day[:4], day[5:7], f'{table}-{day}.ndjson.gz')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as raw:
+            # each append is a new gzip member; gzip / zcat read them as one stream
+            with gzip.GzipFile(fileobj=raw, mode='ab') as out:
+                for row in day_rows:
+                    out.write(json.dumps(dict(row), separators=(',', ':')).encode() + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def purge(db, table, where, params, args):
+    """Archive and delete `table` rows matching `where`, oldest first, `args.batch` per transaction."""
+    if args.dry_run:
+        return db.execute(f'SELECT COUNT(*) FROM {table} WHERE {where}', params).fetchone()[0]
+    total = 0
+    while True:
+        rows = db.execute(f'SELECT * FROM {table} WHERE {where} ORDER BY created_at, id LIMIT ?',
+                          params + (args.batch,)).fetchall()
+        if not rows:
+            return total
+        if not args.no_archive:
+            write_archive(args.archive, table, rows)
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(f'DELETE FROM {table} WHERE id = ?', [(row['id'],) for row in rows])
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        total += len(rows)
+        time.sleep(args.pause)
+
+
+def incremental_vacuum(db, args):
+    """Release free pages in steps of --vacuum-pages; returns the pages released."""
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        print('  auto_vacuum is not INCREMENTAL, the file will not shrink '
+              '(run once with --enable-incremental-vacuum while the app is stopped)')
+        return 0
+    released = 0
+    while True:
+        free = db.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            break
+        db.execute(f'PRAGMA incremental_vacuum({min(free, args.vacuum_pages)})').fetchall()
+        left = db.execute('PRAGMA freelist_count').fetchone()[0]
+        if left >= free:
+            break
+        released += free - left
+        time.sleep(args.pause)
+    # the deletes went through the WAL; copy them back and truncate it (a brief writer pause)
+    db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    return released
+
+
+def run_once(args):
+    started = time.perf_counter()
+    now = datetime.now(timezone.utc)
+    db = pilly.connect_db()
+    db.isolation_level = None  # explicit short transactions in purge()
+    results = {}
+    try:
+        policy = args.alarms
+        severities = [row[0] for row in db.execute(SEVERITIES_SQL)]
+        for severity in severities:
+            days = policy.get(severity.lower(), policy['*'])
+            if days:
+                results[f'alarms[{severity}]'] = purge(
+                    db, 'alarms', 'severity = ? AND created_at < ?', (severity, cutoff(days, now)), args)
+        if policy['*']:
+            results['alarms[null]'] = purge(
+                db, 'alarms', 'severity IS NULL AND created_at < ?', (cutoff(policy['*'], now),), args)
+        if args.logs:
+            results['logs'] = purge(db, 'logs', 'created_at < ?', (cutoff(args.logs, now),), args)
+
+        verb = 'would purge' if args.dry_run else 'purged'
+        for name, count in results.items():
+            print(f'  {name}: {verb} {count:,} rows')
+        if not args.dry_run and any(results.values()):
+            print(f'  vacuum: released {incremental_vacuum(db, args):,} pages')
+    finally:
+        db.close()
+    print(f'Retention run finished in {time.perf_counter() - started:.1f}s')
+    return results
+
+
+def enable_incremental_vacuum():
+    db = pilly.connect_db()
+    db.isolation_level = None
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    print('Rewriting the database (VACUUM), stop the app first...')
+    db.execute('VACUUM')
+    print(f"auto_vacuum = {db.execute('PRAGMA auto_vacuum').fetchone()[0]} (2 = INCREMENTAL)")
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive and purge old alarms and logs.')
+    parser.add_argument('--alarms', type=parse_policy, default=parse_policy(ALARM_RETENTION),
+                        help='per-severity retention in days, e.g. "info=30,error=365,*=180"')
+    parser.add_argument('--logs', type=int, default=LOG_RETENTION_DAYS, help='log retention in days (0 = keep)')
+    parser.add_argument('--archive', default=ARCHIVE_FOLDER, help='folder for the NDJSON.gz archives')
+    parser.add_argument('--no-archive', action='store_true', help='delete without archiving')
+    parser.add_argument('--batch', type=int, default=RETENTION_BATCH, help='rows per delete transaction')
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds between batches')
+    parser.add_argument('--vacuum-pages', type=int, default=1000, help='pages released per vacuum step')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--schedule', action='store_true', help='keep running every --interval hours')
+    parser.add_argument('--interval', type=float, default=RETENTION_INTERVAL_HOURS)
+    parser.add_argument('--enable-incremental-vacuum', action='store_true')
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum()
+        return 0
+    if not args.schedule:
+        run_once(args)
+        return 0
+    while True:
+        try:
+            run_once(args)
+        except Exception as exc:  # keep the schedule alive, retry on the next tick
+            print(f'Retention run failed: {exc}', file=sys.stderr)
+        time.sleep(args.interval * 3600)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
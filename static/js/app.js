@@ -85,6 +85,15 @@ function formatStatus(status) {
     return map[s] || status;
 }
 
+function statusBadge(status) {
+    return `
+        <span class="status-badge status-${status}">
+            <span class="status-dot"></span>
+            ${formatStatus(status)}
+        </span>
+    `;
+}
+
 function formatSeverity(sev) {
     if (!sev) return 'info';
     const s = String(sev).toLowerCase();
@@ -109,14 +118,14 @@ async function loadDashboardStats() {
 
 async function loadRecentDevices() {
     try {
-        const devices = await fetchAPI('/api/devices/list');
+        const page = await fetchAPI('/api/devices/list?limit=5&fields=id,device_name,mac_address,ip_address,firmware_version,status,last_seen');
         const tbody = document.getElementById('recent-devices-tbody');
 
         if (!tbody) return;
 
         tbody.innerHTML = '';
 
-        const recentDevices = devices.slice(0, 5);
+        const recentDevices = page.items;
 
         if (recentDevices.length === 0) {
             tbody.innerHTML = '<tr><td colspan="5" class="text-center">Todavía no hay pastilleros registrados</td></tr>';
@@ -125,6 +134,7 @@ async function loadRecentDevices() {
 
         recentDevices.forEach(device => {
             const row = document.createElement('tr');
+            row.dataset.deviceId = device.id;
             row.innerHTML = `
                 <td>
                     <strong>${device.device_name || 'Pastillero sin nombre'}</strong><br>
@@ -132,12 +142,7 @@ async function loadRecentDevices() {
                 </td>
                 <td>${device.ip_address || 'N/A'}</td>
                 <td>${device.firmware_version || 'Desconocido'}</td>
-                <td>
-                    <span class="status-badge status-${device.status}">
-                        <span class="status-dot"></span>
-                        ${formatStatus(device.status)}
-                    </span>
-                </td>
+                <td class="device-status">${statusBadge(device.status)}</td>
                 <td>${formatDate(device.last_seen)}</td>
             `;
             tbody.appendChild(row);
@@ -147,69 +152,116 @@ async function loadRecentDevices() {
     }
 }
 
-// Devices Functions
-async function loadDevices() {   // ✅ FIX: antes decía "async async function"
-    try {
-        const devices = await fetchAPI('/api/devices/list');
-        const tbody = document.getElementById('devices-tbody');
-
-        if (!tbody) return;
+// Paginated tables: pages come from `next_cursor` and load as the user scrolls
+// to the bottom of the table (IntersectionObserver on a sentinel below it).
+class TablePager {
+    constructor(url, tbody, renderRow, emptyHtml) {
+        this.url = url;
+        this.tbody = tbody;
+        this.renderRow = renderRow;
+        this.emptyHtml = emptyHtml;
+        this.generation = 0;
+        this.sentinelVisible = false;
+
+        const sentinel = document.createElement('div');
+        sentinel.style.height = '1px';
+        tbody.closest('table').after(sentinel);
+        if (window.IntersectionObserver) {
+            new IntersectionObserver(entries => {
+                this.sentinelVisible = entries[0].isIntersecting;
+                if (this.sentinelVisible) this.next();
+            }, { rootMargin: '300px' }).observe(sentinel);
+        }
+    }
 
-        tbody.innerHTML = '';
+    reset() {
+        this.generation++;
+        this.cursor = null;
+        this.done = false;
+        this.loading = false;
+        this.pages = 0;
+        return this.next();
+    }
 
-        if (devices.length === 0) {
-            tbody.innerHTML = `
-                <tr>
-                    <td colspan="9" class="text-center">
-                        <div class="empty-state">
-                            <div class="empty-state-title">No hay pastilleros todavía</div>
-                            <div class="empty-state-text">Van a aparecer acá cuando se conecten al sistema</div>
-                        </div>
-                    </td>
-                </tr>
-            `;
-            return;
+    async next() {
+        if (this.loading || this.done) return;
+        const generation = this.generation;
+        this.loading = true;
+        try {
+            const sep = this.url.includes('?') ? '&' : '?';
+            const page = await fetchAPI(this.cursor ? `${this.url}${sep}cursor=${encodeURIComponent(this.cursor)}` : this.url);
+            if (generation !== this.generation) return;
+            if (this.pages === 0) {
+                this.tbody.innerHTML = page.items.length ? '' : this.emptyHtml;
+            }
+            page.items.forEach(item => this.tbody.appendChild(this.renderRow(item)));
+            this.pages++;
+            this.cursor = page.next_cursor;
+            this.done = !page.next_cursor;
+        } finally {
+            if (generation === this.generation) this.loading = false;
         }
+        // tall screens: keep going while the bottom is still in view
+        if (this.sentinelVisible && generation === this.generation) this.next();
+    }
+}
 
-        devices.forEach(device => {
-            const row = document.createElement('tr');
-            const maskedKey = device.api_key ? (device.api_key.slice(0, 6) + '…' + device.api_key.slice(-4)) : '—';
-            row.innerHTML = `
-                <td>
-                    <strong>${device.device_name || 'Pastillero sin nombre'}</strong><br>
-                    <small style="color: var(--gray-500)">${device.mac_address}</small>
-                </td>
-                <td>${device.ip_address || 'N/A'}</td>
-                <td>${device.ssid || 'N/A'}</td>
-                <td>${device.firmware_version || 'Desconocido'}</td>
-                <td>
-                    <span class="status-badge status-${device.status}">
-                        <span class="status-dot"></span>
-                        ${formatStatus(device.status)}
-                    </span>
-                </td>
-                <td>${formatUptime(device.uptime || 0)}</td>
-                <td>${formatBytes(device.free_heap || 0)}</td>
-                <td>${formatDate(device.last_seen)}</td>
-                <td>
-                    <div class="flex gap-1" style="flex-wrap: wrap;">
-                        <button class="btn btn-secondary btn-xs" onclick="copyApiKey('${device.api_key || ''}')">API key</button>
-                        <button class="btn btn-secondary btn-xs" onclick="queueRestart(${device.id})">Reiniciar</button>
-                        <button class="btn btn-secondary btn-xs" onclick="toggleOTA(${device.id}, ${device.ota_enabled ? 1 : 0})">${device.ota_enabled ? 'OTA: ON' : 'OTA: OFF'}</button>
-                        <button class="btn btn-danger btn-xs" onclick="setDeviceState(${device.id}, '${device.admin_state || 'active'}')">${device.admin_state === 'blocked' ? 'Desbloquear' : (device.admin_state === 'suspended' ? 'Activar' : 'Bloquear')}</button>
-                        <button class="btn btn-secondary btn-xs" onclick="setTargetFirmware(${device.id})">OTA objetivo</button>
-                        <button onclick="deleteDevice(${device.id})" class="btn btn-danger btn-xs">Eliminar</button>
+// Devices Functions
+let devicesPager = null;
+
+async function loadDevices() {
+    const tbody = document.getElementById('devices-tbody');
+    if (!tbody) return;
+
+    if (!devicesPager) {
+        devicesPager = new TablePager('/api/devices/list?limit=50', tbody, renderDeviceRow, `
+            <tr>
+                <td colspan="9" class="text-center">
+                    <div class="empty-state">
+                        <div class="empty-state-title">No hay pastilleros todavía</div>
+                        <div class="empty-state-text">Van a aparecer acá cuando se conecten al sistema</div>
                     </div>
-                    <small style="color: var(--gray-500); display:block; margin-top:4px;">${maskedKey}</small>
                 </td>
-            `;
-            tbody.appendChild(row);
-        });
+            </tr>
+        `);
+    }
+    try {
+        await devicesPager.reset();
     } catch (error) {
         console.error('Error loading devices:', error);
     }
 }
 
+function renderDeviceRow(device) {
+    const row = document.createElement('tr');
+    row.dataset.deviceId = device.id;
+    row.innerHTML = `
+        <td>
+            <strong>${device.device_name || 'Pastillero sin nombre'}</strong><br>
+            <small style="color: var(--gray-500)">${device.mac_address}</small>
+        </td>
+        <td>${device.ip_address || 'N/A'}</td>
+        <td>${device.ssid || 'N/A'}</td>
+        <td>${device.firmware_version || 'Desconocido'}</td>
+        <td class="device-status">${statusBadge(device.status)}</td>
+        <td>${formatUptime(device.uptime || 0)}</td>
+        <td>${formatBytes(device.free_heap || 0)}</td>
+        <td>${formatDate(device.last_seen)}</td>
+        <td>
+            <div class="flex gap-1" style="flex-wrap: wrap;">
+                <button class="btn btn-secondary btn-xs" onclick="copyApiKey(${device.id})">API key</button>
+                <button class="btn btn-secondary btn-xs" onclick="queueRestart(${device.id})">Reiniciar</button>
+                <button class="btn btn-secondary btn-xs" onclick="toggleOTA(${device.id}, ${device.ota_enabled ? 1 : 0})">${device.ota_enabled ? 'OTA: ON' : 'OTA: OFF'}</button>
+                <button class="btn btn-danger btn-xs" onclick="setDeviceState(${device.id}, '${device.admin_state || 'active'}')">${device.admin_state === 'blocked' ? 'Desbloquear' : (device.admin_state === 'suspended' ? 'Activar' : 'Bloquear')}</button>
+                <button class="btn btn-secondary btn-xs" onclick="setTargetFirmware(${device.id})">OTA objetivo</button>
+                <button onclick="deleteDevice(${device.id})" class="btn btn-danger btn-xs">Eliminar</button>
+            </div>
+            <small style="color: var(--gray-500); display:block; margin-top:4px;">${device.api_key_hint || '—'}</small>
+        </td>
+    `;
+    return row;
+}
+
 // Releases Functions
 async function loadReleases() {
     try {
@@ -243,9 +295,14 @@ async function loadReleases() {
                 <td>${formatBytes(release.file_size)}</td>
                 <td>${formatDate(release.uploaded_at)}</td>
                 <td>
-                    <button class="btn btn-danger btn-sm" onclick="deleteRelease(${release.id}, '${release.version}')">
-                        Delete
-                    </button>
+                    <div class="flex gap-1">
+                        <button class="btn btn-secondary btn-sm" onclick="toggleStable(${release.id}, ${release.is_stable ? 1 : 0})">
+                            ${release.is_stable ? 'Stable ✓' : 'Marcar stable'}
+                        </button>
+                        <button class="btn btn-danger btn-sm" onclick="deleteRelease(${release.id}, '${release.version}')">
+                            Delete
+                        </button>
+                    </div>
                 </td>
             `;
             tbody.appendChild(row);
@@ -268,7 +325,9 @@ async function uploadRelease(event) {
     event.preventDefault();
 
     const form = event.target;
-    const formData = new FormData(form);
+    const file = form.querySelector('input[type="file"]').files[0];
+    const version = form.querySelector('[name="version"]').value.trim();
+    const description = form.querySelector('[name="description"]').value;
 
     const submitBtn = form.querySelector('button[type="submit"]');
     const originalText = submitBtn.textContent;
@@ -276,14 +335,11 @@ async function uploadRelease(event) {
     submitBtn.innerHTML = '<span class="spinner"></span> Uploading...';
 
     try {
-        const response = await fetch('/api/releases/upload', {
-            method: 'POST',
-            body: formData
+        const result = await uploadFirmwareChunked(file, version, description, (done) => {
+            submitBtn.innerHTML = `<span class="spinner"></span> Uploading... ${Math.round(done * 100 / file.size)}%`;
         });
 
-        const result = await response.json();
-
-        if (response.ok) {
+        if (result.ok) {
             showToast('Firmware uploaded successfully', 'success');
             closeUploadModal();
             loadReleases();
@@ -298,6 +354,60 @@ async function uploadRelease(event) {
     }
 }
 
+// Chunked, resumable upload: each chunk is its own short request, and a failed
+// chunk is retried from the offset the server reports.
+async function uploadFirmwareChunked(file, version, description, onProgress) {
+    const start = await fetch('/api/releases/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ version, description, size: file.size, filename: file.name })
+    });
+    const session = await start.json();
+    if (!start.ok) return { ok: false, error: session.error };
+
+    const url = `/api/releases/uploads/${session.upload_id}`;
+    let offset = 0;
+    let retries = 0;
+    while (offset < file.size) {
+        const end = Math.min(offset + session.chunk_size, file.size);
+        try {
+            const res = await fetch(url, {
+                method: 'PUT',
+                headers: { 'Content-Range': `bytes ${offset}-${end - 1}/${file.size}` },
+                body: file.slice(offset, end)
+            });
+            const body = await res.json();
+            if (res.ok || res.status === 409) {
+                offset = body.offset;
+                retries = 0;
+                onProgress(offset);
+                continue;
+            }
+            throw new Error(body.error);
+        } catch (error) {
+            if (++retries > 5) return { ok: false, error: 'Upload interrupted' };
+            await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+            const status = await fetch(url).then(r => r.json()).catch(() => null);
+            if (status && typeof status.offset === 'number') offset = status.offset;
+        }
+    }
+
+    const done = await fetch(`${url}/complete`, { method: 'POST' });
+    const result = await done.json();
+    return { ok: done.ok, error: result.error };
+}
+
+async function toggleStable(id, currentStable) {
+    try {
+        await fetchAPI(`/api/releases/${id}/stable`, {
+            method: 'POST',
+            body: JSON.stringify({ stable: currentStable ? 0 : 1 })
+        });
+        showToast(currentStable ? 'Release ya no es stable' : 'Release marcado como stable', 'success');
+        loadReleases();
+    } catch (e) {}
+}
+
 async function deleteRelease(id, version) {
     if (!confirm(`Are you sure you want to delete version ${version}?`)) {
         return;
@@ -341,57 +451,58 @@ async function deleteDevice(deviceId) {
 }
 
 // Alarms Functions
-async function loadAlarms() {
-    try {
-        const alarms = await fetchAPI('/api/alarms/list');
-        const tbody = document.getElementById('alarms-tbody');
+let alarmsPager = null;
 
-        if (!tbody) return;
-
-        tbody.innerHTML = '';
-
-        if (alarms.length === 0) {
-            tbody.innerHTML = `
-                <tr>
-                    <td colspan="5" class="text-center">
-                        <div class="empty-state">
-                            <div class="empty-state-title">Todavía no hay eventos</div>
-                            <div class="empty-state-text">Los eventos de tomas/alertas van a aparecer acá</div>
-                        </div>
-                    </td>
-                </tr>
-            `;
-            return;
-        }
-
-        alarms.forEach(alarm => {
-            const row = document.createElement('tr');
-            const severityClass = alarm.severity === 'error' ? 'status-offline' :
-                                 alarm.severity === 'warning' ? 'status-warning' :
-                                 'status-online';
-
-            row.innerHTML = `
-                <td>${formatDate(alarm.created_at)}</td>
-                <td>
-                    ${alarm.device_name || 'Desconocido Device'}<br>
-                    <small style="color: var(--gray-500)">${alarm.mac_address || 'N/A'}</small>
-                </td>
-                <td>${alarm.alarm_type}</td>
-                <td>
-                    <span class="status-badge ${severityClass}">
-                        <span class="status-dot"></span>
-                        ${formatSeverity(alarm.severity)}
-                    </span>
+async function loadAlarms() {
+    const tbody = document.getElementById('alarms-tbody');
+    if (!tbody) return;
+
+    if (!alarmsPager) {
+        alarmsPager = new TablePager('/api/alarms/list?limit=100', tbody, renderAlarmRow, `
+            <tr>
+                <td colspan="5" class="text-center">
+                    <div class="empty-state">
+                        <div class="empty-state-title">Todavía no hay eventos</div>
+                        <div class="empty-state-text">Los eventos de tomas/alertas van a aparecer acá</div>
+                    </div>
                 </td>
-                <td>${alarm.message}</td>
-            `;
-            tbody.appendChild(row);
-        });
+            </tr>
+        `);
+    }
+    try {
+        await alarmsPager.reset();
     } catch (error) {
         console.error('Error loading alarms:', error);
     }
 }
 
+function renderAlarmRow(alarm) {
+    const row = document.createElement('tr');
+    const severityClass = alarm.severity === 'error' ? 'status-offline' :
+                         alarm.severity === 'warning' ? 'status-warning' :
+                         'status-online';
+
+    row.innerHTML = `
+        <td>${formatDate(alarm.created_at)}</td>
+        <td>
+            ${alarm.device_name || 'Desconocido Device'}<br>
+            <small style="color: var(--gray-500)">${alarm.mac_address || 'N/A'}</small>
+        </td>
+        <td>
+            ${alarm.alarm_type}
+            ${alarm.occurrences > 1 ? `<br><small style="color: var(--gray-500)">×${alarm.occurrences} · ${formatDate(alarm.last_seen)}</small>` : ''}
+        </td>
+        <td>
+            <span class="status-badge ${severityClass}">
+                <span class="status-dot"></span>
+                ${formatSeverity(alarm.severity)}
+            </span>
+        </td>
+        <td>${alarm.message}</td>
+    `;
+    return row;
+}
+
 // Auto-refresh functionality
 function startAutoRefresh(interval = 30000) {
     const currentPage = window.location.pathname;
@@ -401,13 +512,92 @@ function startAutoRefresh(interval = 30000) {
             loadDashboardStats();
             loadRecentDevices();
         } else if (currentPage.includes('devices')) {
-            loadDevices();
+            // do not throw away the pages the user scrolled through
+            if (!devicesPager || devicesPager.pages <= 1) loadDevices();
         } else if (currentPage.includes('alarms')) {
-            loadAlarms();
+            if (!alarmsPager || alarmsPager.pages <= 1) loadAlarms();
         }
     }, interval);
 }
 
+// Live updates: /api/events (Server-Sent Events) patches the page in place.
+// Falls back to the 30 s polling above when EventSource is missing or the stream is refused.
+function bumpCounter(id, delta) {
+    const el = document.getElementById(id);
+    if (el && el.textContent !== '-') el.textContent = Math.max(0, (parseInt(el.textContent, 10) || 0) + delta);
+}
+
+function patchDeviceStatus(event) {
+    document.querySelectorAll(`tr[data-device-id="${event.id}"] .device-status`).forEach(cell => {
+        cell.innerHTML = statusBadge(event.status);
+    });
+    const wasOnline = event.previous === 'online';
+    const isOnline = event.status === 'online';
+    if (wasOnline !== isOnline) {
+        bumpCounter('online-devices', isOnline ? 1 : -1);
+        bumpCounter('offline-devices', isOnline ? -1 : 1);
+    }
+}
+
+const LIVE_HANDLERS = {
+    dashboard: {
+        device_status: patchDeviceStatus,
+        device_added: () => { loadDashboardStats(); loadRecentDevices(); },
+        device_removed: () => { loadDashboardStats(); loadRecentDevices(); },
+        alarm: () => bumpCounter('recent-alarms', 1),
+        release: event => {
+            if (event.action === 'uploaded') bumpCounter('total-releases', 1);
+            if (event.action === 'deleted') bumpCounter('total-releases', -1);
+        },
+        resync: () => { loadDashboardStats(); loadRecentDevices(); },
+    },
+    devices: {
+        device_status: patchDeviceStatus,
+        device_added: () => loadDevices(),
+        device_removed: event => {
+            document.querySelectorAll(`tr[data-device-id="${event.id}"]`).forEach(row => row.remove());
+        },
+        command: event => {
+            // campaign deliveries are followed on the campaign, not one toast per device
+            if (event.status === 'sent' && !event.campaign_id) showToast(`Comando ${event.command} entregado al pastillero #${event.device_id}`, 'success');
+        },
+        resync: () => loadDevices(),
+    },
+    alarms: {
+        alarm: alarm => {
+            const tbody = document.getElementById('alarms-tbody');
+            if (!tbody) return;
+            if (tbody.querySelector('.empty-state')) tbody.innerHTML = '';
+            tbody.insertBefore(renderAlarmRow(alarm), tbody.firstChild);
+            bumpCounter('alarms-24h', 1);
+            bumpCounter('alarms-7d', 1);
+            bumpCounter('alarms-total', 1);
+        },
+        resync: () => loadAlarms(),
+    },
+    releases: {
+        release: () => loadReleases(),
+        resync: () => loadReleases(),
+    },
+};
+
+function startLiveUpdates(page) {
+    if (!window.EventSource) {
+        startAutoRefresh();
+        return;
+    }
+    const source = new EventSource('/api/events');
+    Object.entries(LIVE_HANDLERS[page]).forEach(([kind, handler]) => {
+        source.addEventListener(kind, e => handler(JSON.parse(e.data)));
+    });
+    source.onerror = () => {
+        // CONNECTING = the browser retries by itself (and resumes from Last-Event-ID)
+        if (source.readyState === EventSource.CLOSED) startAutoRefresh();
+    };
+    // uptime / free heap / last seen do not produce events: refresh them slowly
+    startAutoRefresh(5 * 60 * 1000);
+}
+
 // Initialize on page load
 document.addEventListener('DOMContentLoaded', () => {
     const currentPage = window.location.pathname;
@@ -415,15 +605,16 @@ document.addEventListener('DOMContentLoaded', () => {
     if (currentPage === '/' || currentPage.includes('dashboard')) {
         loadDashboardStats();
         loadRecentDevices();
-        startAutoRefresh();
+        startLiveUpdates('dashboard');
     } else if (currentPage.includes('devices')) {
         loadDevices();
-        startAutoRefresh();
+        startLiveUpdates('devices');
     } else if (currentPage.includes('releases')) {
         loadReleases();
+        startLiveUpdates('releases');
     } else if (currentPage.includes('alarms')) {
         loadAlarms();
-        startAutoRefresh();
+        startLiveUpdates('alarms');
     }
 });
 
@@ -436,7 +627,14 @@ window.onclick = function(event) {
 }
 
 // Device Actions (Admin)
-async function copyApiKey(apiKey) {
+async function copyApiKey(deviceId) {
+    // lists only carry a hint; the key comes from the device detail
+    let apiKey = null;
+    try {
+        apiKey = (await fetchAPI(`/api/devices/${deviceId}`)).api_key;
+    } catch (e) {
+        return;
+    }
     if (!apiKey) {
         showToast('Este pastillero todavía no tiene API key', 'error');
         return;
@@ -0,0 +1,25 @@
+"""Every query app.py runs must use an index (see check_query_plans.py)."""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import check_query_plans
+
+
+class QueryPlanTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_no_unexpected_full_table_scans(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            failures = check_query_plans.run(os.path.join(tmp, 'plans.db'), devices=2000, alarms=20000,
+                                             verbose=False)
+        self.assertEqual([], [f"{where}: {sql}\n    {'; '.join(scans)}" for where, sql, scans in failures],
+                         'full table scans; add an index, or the query to ALLOWED_SCANS with the reason')
+
+
+if __name__ == '__main__':
+    unittest.main()